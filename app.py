@@ -5,16 +5,42 @@ from datetime import datetime, timedelta
 import re
 import logging
 from logging.handlers import RotatingFileHandler
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, abort
+from werkzeug.utils import secure_filename, safe_join
 from functools import wraps
 import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
 import uuid
-import random
-import string
+import threading
+import atexit
+import click
+from db_pool import ConnectionPool, PoolExhaustedError, pool_settings_from_env
+from cache import create_cache
+from teacher_stats import bump_teacher_stats, get_teacher_stats, reconcile_all_teacher_stats
+from student_dashboard import load_available_quizzes
+from quiz_snapshots import bump_quiz_version, get_quiz_snapshot
+from question_loader import load_quiz_questions
+from grading import grade_submission
+from regrade import enqueue_regrade, get_regrade_job, run_regrade_job, run_pending_regrade_jobs
+from video_streaming import send_video
+from chunked_uploads import (PART_SUFFIX, ChunkChecksumError, create_upload_session, get_upload_session,
+                             is_sha256_hex, purge_stale_upload_sessions, write_chunk)
+from transcoding import enqueue_transcode, run_transcode_job, run_pending_transcode_jobs, tools_available as transcoding_tools_available
+from storage import create_storage
+from media_store import (collect_unreferenced_blobs, delete_if_unreferenced, discard_unregistered, is_media_path,
+                         release_media, store_file, store_stream)
+from entitlements import EntitlementService
+from subscription_expiry import run_expiry_sweep
+from earnings import close_earnings_period
+from pagination import Keyset, fetch_page
+from teacher_search import (FULLTEXT_SESSION_SQL, backfill_search_text, check_fulltext_config, like_prefix,
+                            refresh_search_text, search_teachers)
+from teacher_suggest import TeacherNameIndex
+from password_hashing import PasswordHasherBusyError, hasher_from_env
+from otp_store import OTP_LOCKED, OTP_OK, create_otp_store
+from view_counter import ViewCounter, recover_orphaned_logs
+from avatars import InvalidImageError, avatar_thumb_key, derivative_keys, store_avatar
 
 # --- 1. Load Environment Variables ---
 load_dotenv()
@@ -51,10 +77,20 @@ ensure_directory_exists(UPLOAD_FOLDER_QUESTION_IMAGES, "Question Images Upload F
 ensure_directory_exists(UPLOAD_FOLDER_PROFILE_PICS, "Profile Pictures Upload Folder")
 
 ALLOWED_EXTENSIONS_VIDEOS = {'mp4', 'mov', 'avi', 'mkv', 'webm'}
+MAX_VIDEO_UPLOAD_BYTES = int(os.getenv('MAX_VIDEO_UPLOAD_MB', '4096')) * 1024 * 1024  # Chunked uploads only
+VIDEO_UPLOAD_CHUNK_BYTES = int(os.getenv('VIDEO_UPLOAD_CHUNK_MB', '8')) * 1024 * 1024
+VIDEO_TRANSCODING_ENABLED = os.getenv('VIDEO_TRANSCODING_ENABLED', 'True').lower() in ('true', '1', 'yes')
+if VIDEO_TRANSCODING_ENABLED and not transcoding_tools_available():
+    # Uploads are then published as-is instead of queuing jobs that can only fail
+    if hasattr(app, 'logger') and app.logger: app.logger.warning("TRANSCODE: ffmpeg/ffprobe not found; video transcoding is disabled.")
+    VIDEO_TRANSCODING_ENABLED = False
 ALLOWED_EXTENSIONS_IMAGES = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app.config['UPLOAD_FOLDER_VIDEOS'] = UPLOAD_FOLDER_VIDEOS
 app.config['UPLOAD_FOLDER_QUESTION_IMAGES'] = UPLOAD_FOLDER_QUESTION_IMAGES
 app.config['UPLOAD_FOLDER_PROFILE_PICS'] = UPLOAD_FOLDER_PROFILE_PICS
+STATIC_ROOT = os.path.join(app.root_path, 'static')  # Stored media paths are relative to this
+MEDIA_KEY_PREFIX = 'uploads/'  # Paths under this prefix live in media_storage; anything else is a bundled asset
+media_storage = create_storage(STATIC_ROOT)
 
 # --- 3. Database Connection Settings ---
 DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -63,20 +99,42 @@ DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 DB_NAME = os.getenv('DB_NAME', 'ektbariny_db')
 
 # --- 4. Database Connection Function ---
+DB_CONNECT_PARAMS = {
+    'host': DB_HOST, 'user': DB_USER, 'password': DB_PASSWORD,
+    'charset': 'utf8mb4', 'collation': 'utf8mb4_unicode_ci',
+    'autocommit': False
+}
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Returns the process-wide connection pool, creating it lazily (and again after a fork)."""
+    global _db_pool, _db_pool_pid
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                pool_params = dict(DB_CONNECT_PARAMS)
+                if DB_NAME:
+                    pool_params['database'] = DB_NAME
+                _db_pool = ConnectionPool(pool_params, **pool_settings_from_env())
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
 def get_db_connection(include_db_name=True):
-    """Establishes and returns a MySQL database connection. Returns None on failure."""
-    conn = None # Initialize conn to None to prevent NameError in finally block
+    """Checks a MySQL connection out of the pool (close() returns it). Returns None on failure.
+
+    include_db_name=False opens a one-off unpooled connection, used only for schema bootstrap."""
     try:
-        conn_params = {
-            'host': DB_HOST, 'user': DB_USER, 'password': DB_PASSWORD,
-            'charset': 'utf8mb4', 'collation': 'utf8mb4_unicode_ci',
-            'autocommit': False
-        }
-        if include_db_name and DB_NAME:
-            conn_params['database'] = DB_NAME
-
-        conn = mysql.connector.connect(**conn_params)
-        return conn
+        if not include_db_name:
+            return mysql.connector.connect(**DB_CONNECT_PARAMS)
+        return get_db_pool().acquire()
+    except PoolExhaustedError as e:
+        if hasattr(app, 'logger') and app.logger:
+            app.logger.error(f"MySQL Pool Exhausted! {e.msg} Stats: {get_db_pool().stats()}")
+        else:
+            print(f"!!! [{e.msg}] !!!")
+        return None
     except Error as e:
         log_msg = (f"MySQL Connection Error! Host:'{DB_HOST}', "
                    f"DB:'{DB_NAME if include_db_name else 'N/A'}'. "
@@ -87,7 +145,111 @@ def get_db_connection(include_db_name=True):
             print(f"!!! [{log_msg}] !!!")
         return None
 
+# --- 4b. Request-Scoped Database Handle ---
+def get_db():
+    """Returns the request's pooled connection, checking it out on first use. Returns None on failure."""
+    if 'db_conn' not in g:
+        g.db_conn = get_db_connection()
+    return g.db_conn
+
+def get_db_cursor(dictionary=True):
+    """Returns a buffered cursor on the request's connection; it is closed at teardown."""
+    conn = get_db()
+    if conn is None:
+        raise Error("Database connection unavailable.")
+    cursor = conn.cursor(dictionary=dictionary, buffered=True)
+    g.setdefault('db_cursors', []).append(cursor)
+    return cursor
+
+@app.teardown_appcontext
+def close_request_db(exception=None):
+    """Closes the request's cursors and returns its connection to the pool exactly once."""
+    for cursor in g.pop('db_cursors', []):
+        try:
+            cursor.close()
+        except Error:
+            pass
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        try:
+            if exception is not None:
+                conn.rollback()
+        except Error as e:
+            if hasattr(app, 'logger') and app.logger: app.logger.warning(f"DB_TEARDOWN: Rollback failed: {e}")
+        finally:
+            conn.close()
+
 # --- 5. Database and Tables Creation Function ---
+# Changes to tables that may already exist; CREATE TABLE IF NOT EXISTS does not alter them.
+# Each entry: (kind, table, object name, DDL). 'index'/'column' run when missing, 'drop_index' when present.
+SCHEMA_MIGRATIONS = [
+    ('index', 'quiz_attempts', 'idx_attempt_student_quiz_submitted',
+     "ALTER TABLE `quiz_attempts` ADD INDEX `idx_attempt_student_quiz_submitted` (`student_id` ASC, `quiz_id` ASC, `submitted_at` DESC)"),
+    ('drop_index', 'quiz_attempts', 'idx_attempt_student_quiz',
+     "ALTER TABLE `quiz_attempts` DROP INDEX `idx_attempt_student_quiz`"),
+    ('column', 'quizzes', 'content_version',
+     "ALTER TABLE `quizzes` ADD COLUMN `content_version` INT UNSIGNED NOT NULL DEFAULT 1 AFTER `is_active`"),
+    ('column', 'videos', 'hls_manifest_path',
+     "ALTER TABLE `videos` ADD COLUMN `hls_manifest_path` VARCHAR(512) NULL AFTER `status`"),
+    ('column', 'users', 'profile_picture_thumbs',
+     "ALTER TABLE `users` ADD COLUMN `profile_picture_thumbs` JSON NULL AFTER `profile_picture_url`"),
+    ('index', 'student_subscriptions', 'idx_subscription_status_expiry',
+     "ALTER TABLE `student_subscriptions` ADD INDEX `idx_subscription_status_expiry` (`status` ASC, `expiry_date` ASC)"),
+    ('index', 'student_subscriptions', 'idx_subscription_date',
+     "ALTER TABLE `student_subscriptions` ADD INDEX `idx_subscription_date` (`subscription_date` ASC)"),
+    ('column', 'teacher_earnings', 'payout_id',
+     "ALTER TABLE `teacher_earnings` ADD COLUMN `payout_id` INT NULL AFTER `status`"),
+    ('index', 'teacher_earnings', 'uq_earning_subscription',
+     "ALTER TABLE `teacher_earnings` ADD UNIQUE INDEX `uq_earning_subscription` (`student_subscription_id` ASC)"),
+    ('index', 'teacher_earnings', 'idx_earning_period_status_teacher',
+     "ALTER TABLE `teacher_earnings` ADD INDEX `idx_earning_period_status_teacher` (`earning_year` ASC, `earning_month` ASC, `status` ASC, `teacher_id` ASC)"),
+    ('index', 'teacher_earnings', 'idx_earning_payout',
+     "ALTER TABLE `teacher_earnings` ADD INDEX `idx_earning_payout` (`payout_id` ASC)"),
+    ('column', 'users', 'search_text',
+     "ALTER TABLE `users` ADD COLUMN `search_text` TEXT NULL AFTER `otp_expiry`"),
+    # Rebuilt without stopwords (see teacher_search.py); apply_schema_migrations() disables them first
+    ('index', 'users', 'ft_user_search_ngram',
+     "ALTER TABLE `users` ADD FULLTEXT INDEX `ft_user_search_ngram` (`search_text`) WITH PARSER ngram"),
+    ('drop_index', 'users', 'ft_user_search_text',
+     "ALTER TABLE `users` DROP INDEX `ft_user_search_text`"),
+    ('index', 'users', 'idx_user_role_active_name',
+     "ALTER TABLE `users` ADD INDEX `idx_user_role_active_name` (`role` ASC, `is_active` ASC, `first_name` ASC, `last_name` ASC, `id` ASC)"),
+    ('index', 'videos', 'idx_video_teacher_uploaded',
+     "ALTER TABLE `videos` ADD INDEX `idx_video_teacher_uploaded` (`teacher_id` ASC, `upload_timestamp` ASC)"),
+    ('index', 'quizzes', 'idx_quiz_teacher_created',
+     "ALTER TABLE `quizzes` ADD INDEX `idx_quiz_teacher_created` (`teacher_id` ASC, `created_at` ASC)"),
+    ('column', 'regrade_jobs', 'lease_token',
+     "ALTER TABLE `regrade_jobs` ADD COLUMN `lease_token` CHAR(32) NULL AFTER `error_message`"),
+    ('column', 'regrade_jobs', 'lease_expires_at',
+     "ALTER TABLE `regrade_jobs` ADD COLUMN `lease_expires_at` TIMESTAMP NULL AFTER `lease_token`"),
+    ('column', 'transcode_jobs', 'lease_token',
+     "ALTER TABLE `transcode_jobs` ADD COLUMN `lease_token` CHAR(32) NULL AFTER `error_message`"),
+    ('column', 'transcode_jobs', 'lease_expires_at',
+     "ALTER TABLE `transcode_jobs` ADD COLUMN `lease_expires_at` TIMESTAMP NULL AFTER `lease_token`"),
+    ('index', 'view_count_batches', 'idx_view_batch_applied',
+     "ALTER TABLE `view_count_batches` ADD INDEX `idx_view_batch_applied` (`applied_at` ASC)"),
+    # One 'active' row per student and teacher, any number of expired/cancelled ones (NULLs never collide)
+    ('column', 'student_subscriptions', 'active_marker',
+     "ALTER TABLE `student_subscriptions` ADD COLUMN `active_marker` TINYINT AS (IF(`status` = 'active', 1, NULL)) VIRTUAL"),
+    ('index', 'student_subscriptions', 'uq_student_teacher_active',
+     "ALTER TABLE `student_subscriptions` ADD UNIQUE INDEX `uq_student_teacher_active` (`student_id` ASC, `teacher_id` ASC, `active_marker` ASC)"),
+    ('drop_index', 'student_subscriptions', 'uq_student_teacher_active_subscription',
+     "ALTER TABLE `student_subscriptions` DROP INDEX `uq_student_teacher_active_subscription`"),
+]
+
+def apply_schema_migrations(cursor):
+    """Applies SCHEMA_MIGRATIONS idempotently against the currently selected database."""
+    cursor.execute(FULLTEXT_SESSION_SQL)
+    for kind, table_name, object_name, ddl in SCHEMA_MIGRATIONS:
+        if kind == 'column':
+            cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s", (table_name, object_name))
+        else:
+            cursor.execute("SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s", (table_name, object_name))
+        exists = cursor.fetchone()[0] > 0
+        if exists == (kind == 'drop_index'):
+            if hasattr(app, 'logger') and app.logger: app.logger.info(f"DB_MIGRATION: {kind} {table_name}.{object_name}")
+            cursor.execute(ddl)
+
 def create_tables():
     """Creates database and all necessary tables from the predefined SQL schema."""
     full_db_schema_sql = """
@@ -98,32 +260,39 @@ def create_tables():
       `password_hash` VARCHAR(255) NOT NULL, `role` ENUM('student', 'teacher') NOT NULL, `first_name` VARCHAR(50) NULL,
       `last_name` VARCHAR(50) NULL, `phone_number` VARCHAR(20) UNIQUE NULL,
       `country` VARCHAR(100) NULL,
-      `profile_picture_url` VARCHAR(255) NULL, `bio` TEXT NULL,
+      `profile_picture_url` VARCHAR(255) NULL, `profile_picture_thumbs` JSON NULL, `bio` TEXT NULL,
       `free_video_uploads_remaining` TINYINT UNSIGNED DEFAULT 3, `free_quiz_creations_remaining` TINYINT UNSIGNED DEFAULT 3,
       `is_active` BOOLEAN DEFAULT TRUE, `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
       `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
       `wallet_balance` DECIMAL(10, 2) DEFAULT 0.00,
       `otp_code` VARCHAR(8) NULL,
-      `otp_expiry` TIMESTAMP NULL
+      `otp_expiry` TIMESTAMP NULL,
+      `search_text` TEXT NULL,
+      INDEX `idx_user_role_active_name` (`role` ASC, `is_active` ASC, `first_name` ASC, `last_name` ASC, `id` ASC),
+      FULLTEXT INDEX `ft_user_search_ngram` (`search_text`) WITH PARSER ngram
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `videos` (
       `id` INT AUTO_INCREMENT PRIMARY KEY, `teacher_id` INT NOT NULL, `title` VARCHAR(255) NOT NULL, `description` TEXT NULL,
       `video_path_or_url` VARCHAR(512) NOT NULL, `thumbnail_path_or_url` VARCHAR(512) NULL, `duration_seconds` INT NULL,
       `order_in_sequence` INT DEFAULT 0, `is_viewable_free_for_student` BOOLEAN DEFAULT FALSE, `views_count` INT DEFAULT 0,
       `upload_timestamp` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `status` ENUM('processing', 'published', 'unpublished', 'error') DEFAULT 'processing',
+      `hls_manifest_path` VARCHAR(512) NULL,
       `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
       CONSTRAINT `fk_video_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
-      INDEX `idx_video_teacher` (`teacher_id` ASC)
+      INDEX `idx_video_teacher` (`teacher_id` ASC),
+      INDEX `idx_video_teacher_uploaded` (`teacher_id` ASC, `upload_timestamp` ASC)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `quizzes` (
       `id` INT AUTO_INCREMENT PRIMARY KEY, `teacher_id` INT NOT NULL, `video_id` INT NULL, `title` VARCHAR(255) NOT NULL,
       `description` TEXT NULL, `time_limit_minutes` INT NULL DEFAULT NULL,
       `passing_score_percentage` TINYINT UNSIGNED DEFAULT 70,
       `allow_answer_review` BOOLEAN DEFAULT FALSE, `shareable_link_id` VARCHAR(36) NULL UNIQUE, `is_active` BOOLEAN DEFAULT TRUE,
+      `content_version` INT UNSIGNED NOT NULL DEFAULT 1,
       `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
       CONSTRAINT `fk_quiz_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
       CONSTRAINT `fk_quiz_video` FOREIGN KEY (`video_id`) REFERENCES `videos`(`id`) ON DELETE SET NULL ON UPDATE CASCADE,
       INDEX `idx_quiz_teacher` (`teacher_id` ASC), INDEX `idx_quiz_video` (`video_id` ASC),
+      INDEX `idx_quiz_teacher_created` (`teacher_id` ASC, `created_at` ASC),
       CONSTRAINT `chk_passing_score` CHECK (`passing_score_percentage` BETWEEN 0 AND 100)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `questions` (
@@ -145,7 +314,7 @@ def create_tables():
       `is_completed` BOOLEAN DEFAULT FALSE, `passed` BOOLEAN NULL,
       CONSTRAINT `fk_attempt_student` FOREIGN KEY (`student_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
       CONSTRAINT `fk_attempt_quiz` FOREIGN KEY (`quiz_id`) REFERENCES `quizzes`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
-      INDEX `idx_attempt_student_quiz` (`student_id` ASC, `quiz_id` ASC)
+      INDEX `idx_attempt_student_quiz_submitted` (`student_id` ASC, `quiz_id` ASC, `submitted_at` DESC)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `student_answers` (
       `id` INT AUTO_INCREMENT PRIMARY KEY, `attempt_id` INT NOT NULL, `question_id` INT NOT NULL, `selected_choice_id` INT NULL,
@@ -162,11 +331,14 @@ def create_tables():
       `status` ENUM('active', 'expired', 'cancelled_by_student', 'cancelled_by_admin') DEFAULT 'active',
       `payment_transaction_id` VARCHAR(255) NULL, `amount_paid` DECIMAL(10,2) NULL, `currency_code` VARCHAR(3) DEFAULT 'USD',
       `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+      `active_marker` TINYINT AS (IF(`status` = 'active', 1, NULL)) VIRTUAL,
       CONSTRAINT `fk_subscription_student` FOREIGN KEY (`student_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
       CONSTRAINT `fk_subscription_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
-      UNIQUE INDEX `uq_student_teacher_active_subscription` (`student_id` ASC, `teacher_id` ASC, `status` ASC),
+      UNIQUE INDEX `uq_student_teacher_active` (`student_id` ASC, `teacher_id` ASC, `active_marker` ASC),
       INDEX `idx_subscription_student` (`student_id` ASC),
-      INDEX `idx_subscription_teacher` (`teacher_id` ASC)
+      INDEX `idx_subscription_teacher` (`teacher_id` ASC),
+      INDEX `idx_subscription_status_expiry` (`status` ASC, `expiry_date` ASC),
+      INDEX `idx_subscription_date` (`subscription_date` ASC)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `student_watched_videos` (
       `id` INT AUTO_INCREMENT PRIMARY KEY, `student_id` INT NOT NULL, `video_id` INT NOT NULL, `teacher_id` INT NOT NULL,
@@ -194,10 +366,14 @@ def create_tables():
         `platform_commission_amount` DECIMAL(10,2) NOT NULL, `teacher_net_earning` DECIMAL(10,2) NOT NULL,
         `earning_month` INT NOT NULL, `earning_year` INT NOT NULL,
         `status` ENUM('pending_payout', 'included_in_payout', 'on_hold') DEFAULT 'pending_payout',
+        `payout_id` INT NULL,
         `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         CONSTRAINT `fk_earning_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
         CONSTRAINT `fk_earning_subscription` FOREIGN KEY (`student_subscription_id`) REFERENCES `student_subscriptions`(`id`) ON DELETE RESTRICT ON UPDATE CASCADE,
-        INDEX `idx_earning_teacher_month_year` (`teacher_id` ASC, `earning_year` ASC, `earning_month` ASC)
+        UNIQUE INDEX `uq_earning_subscription` (`student_subscription_id` ASC),
+        INDEX `idx_earning_teacher_month_year` (`teacher_id` ASC, `earning_year` ASC, `earning_month` ASC),
+        INDEX `idx_earning_period_status_teacher` (`earning_year` ASC, `earning_month` ASC, `status` ASC, `teacher_id` ASC),
+        INDEX `idx_earning_payout` (`payout_id` ASC)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     CREATE TABLE IF NOT EXISTS `teacher_payouts` (
       `id` INT AUTO_INCREMENT PRIMARY KEY, `teacher_id` INT NOT NULL, `payout_amount` DECIMAL(10,2) NOT NULL,
@@ -207,6 +383,67 @@ def create_tables():
       CONSTRAINT `fk_payout_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE RESTRICT ON UPDATE CASCADE,
       INDEX `idx_payout_teacher` (`teacher_id` ASC)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `earning_period_closes` (
+      `id` INT AUTO_INCREMENT PRIMARY KEY, `earning_year` INT NOT NULL, `earning_month` INT NOT NULL,
+      `commission_percentage` DECIMAL(5,2) NOT NULL,
+      `status` ENUM('running', 'completed', 'failed') NOT NULL DEFAULT 'running',
+      `last_subscription_date` TIMESTAMP NULL, `last_subscription_id` INT NOT NULL DEFAULT 0, `last_teacher_id` INT NOT NULL DEFAULT 0,
+      `earnings_created` INT NOT NULL DEFAULT 0, `payouts_created` INT NOT NULL DEFAULT 0, `error_message` VARCHAR(500) NULL,
+      `started_at` TIMESTAMP NULL, `finished_at` TIMESTAMP NULL,
+      UNIQUE INDEX `uq_earning_period` (`earning_year` ASC, `earning_month` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `regrade_jobs` (
+      `id` INT AUTO_INCREMENT PRIMARY KEY, `quiz_id` INT NOT NULL, `reason` VARCHAR(255) NULL,
+      `status` ENUM('pending', 'running', 'completed', 'failed') NOT NULL DEFAULT 'pending',
+      `total_attempts` INT NULL, `processed_attempts` INT NOT NULL DEFAULT 0, `last_attempt_id` INT NOT NULL DEFAULT 0,
+      `error_message` VARCHAR(500) NULL, `lease_token` CHAR(32) NULL, `lease_expires_at` TIMESTAMP NULL,
+      `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `started_at` TIMESTAMP NULL, `finished_at` TIMESTAMP NULL,
+      CONSTRAINT `fk_regrade_quiz` FOREIGN KEY (`quiz_id`) REFERENCES `quizzes`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
+      INDEX `idx_regrade_quiz_status` (`quiz_id` ASC, `status` ASC),
+      INDEX `idx_regrade_status` (`status` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `upload_sessions` (
+      `id` CHAR(32) PRIMARY KEY, `teacher_id` INT NOT NULL, `stored_filename` VARCHAR(255) NOT NULL,
+      `total_size` BIGINT UNSIGNED NOT NULL, `received_bytes` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+      `title` VARCHAR(255) NOT NULL, `description` TEXT NULL, `is_viewable_free` BOOLEAN DEFAULT FALSE,
+      `status` ENUM('uploading', 'completed') NOT NULL DEFAULT 'uploading', `video_id` INT NULL,
+      `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+      CONSTRAINT `fk_upload_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
+      CONSTRAINT `fk_upload_video` FOREIGN KEY (`video_id`) REFERENCES `videos`(`id`) ON DELETE SET NULL ON UPDATE CASCADE,
+      INDEX `idx_upload_status_updated` (`status` ASC, `updated_at` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `transcode_jobs` (
+      `id` INT AUTO_INCREMENT PRIMARY KEY, `video_id` INT NOT NULL,
+      `status` ENUM('pending', 'running', 'completed', 'failed') NOT NULL DEFAULT 'pending',
+      `attempts` TINYINT UNSIGNED NOT NULL DEFAULT 0, `error_message` VARCHAR(500) NULL,
+      `lease_token` CHAR(32) NULL, `lease_expires_at` TIMESTAMP NULL,
+      `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `started_at` TIMESTAMP NULL, `finished_at` TIMESTAMP NULL,
+      CONSTRAINT `fk_transcode_video` FOREIGN KEY (`video_id`) REFERENCES `videos`(`id`) ON DELETE CASCADE ON UPDATE CASCADE,
+      INDEX `idx_transcode_status` (`status` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `view_count_batches` (
+      `batch_id` VARCHAR(64) PRIMARY KEY, `views` INT UNSIGNED NOT NULL, `applied_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      INDEX `idx_view_batch_applied` (`applied_at` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `media_blobs` (
+      `sha256` CHAR(64) PRIMARY KEY, `relative_path` VARCHAR(255) NOT NULL, `size_bytes` BIGINT UNSIGNED NOT NULL,
+      `ref_count` INT UNSIGNED NOT NULL DEFAULT 0, `created_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      UNIQUE INDEX `uq_media_relative_path` (`relative_path` ASC),
+      INDEX `idx_media_ref_count` (`ref_count` ASC)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `subscription_sweep_runs` (
+      `id` INT AUTO_INCREMENT PRIMARY KEY, `cutoff` TIMESTAMP NOT NULL,
+      `status` ENUM('running', 'completed', 'failed') NOT NULL DEFAULT 'running',
+      `expired_count` INT NOT NULL DEFAULT 0, `chunks` INT NOT NULL DEFAULT 0,
+      `error_message` VARCHAR(500) NULL,
+      `started_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP, `finished_at` TIMESTAMP NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    CREATE TABLE IF NOT EXISTS `teacher_stats` (
+      `teacher_id` INT PRIMARY KEY, `subscribers_count` INT NOT NULL DEFAULT 0, `total_views` BIGINT NOT NULL DEFAULT 0,
+      `quizzes_count` INT NOT NULL DEFAULT 0, `questions_count` INT NOT NULL DEFAULT 0,
+      `reconciled_at` TIMESTAMP NULL, `updated_at` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+      CONSTRAINT `fk_stats_teacher` FOREIGN KEY (`teacher_id`) REFERENCES `users`(`id`) ON DELETE CASCADE ON UPDATE CASCADE
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     """
     conn_init = None; cursor_init = None
     try:
@@ -216,6 +453,7 @@ def create_tables():
             return False
         cursor_init = conn_init.cursor()
         if hasattr(app, 'logger') and app.logger: app.logger.info("DB_INIT: Executing database schema script...")
+        cursor_init.execute(FULLTEXT_SESSION_SQL)  # `users` gets its FULLTEXT index in the script below
         for result in cursor_init.execute(full_db_schema_sql, multi=True):
             if hasattr(app, 'logger') and app.logger:
                 log_msg_part = f"Statement: {result.statement[:100]}..." if result.statement else "No statement info"
@@ -224,7 +462,11 @@ def create_tables():
                     app.logger.debug(f"DB_INIT_STATEMENT: {log_msg_part} (rows fetched).")
                 else:
                     app.logger.debug(f"DB_INIT_STATEMENT: {log_msg_part} (Affected: {result.rowcount})")
+        apply_schema_migrations(cursor_init)
         conn_init.commit()
+        if not check_fulltext_config(cursor_init, logger=app.logger):
+            if hasattr(app, 'logger') and app.logger: app.logger.error("DB_INIT: Teacher search will miss matches until the MySQL settings above are fixed and the index is rebuilt.")
+        backfill_search_text(conn_init, logger=app.logger)
         if hasattr(app, 'logger') and app.logger: app.logger.info(f"DB_INIT: Database '{DB_NAME}' schema setup/verification completed.")
         return True
     except Error as db_init_error:
@@ -243,35 +485,75 @@ def create_tables():
             conn_init.close()
 
 # --- 6. Helper Functions & Context Processors ---
+USER_PROFILE_CACHE_TTL_SECONDS = int(os.getenv('USER_PROFILE_CACHE_TTL_SECONDS', '300'))
+user_profile_cache = create_cache('user_profile', maxsize=int(os.getenv('USER_PROFILE_CACHE_SIZE', '10000')),
+                                  ttl=USER_PROFILE_CACHE_TTL_SECONDS)
+
+entitlements = EntitlementService(create_cache('entitlements', maxsize=int(os.getenv('ENTITLEMENT_CACHE_SIZE', '10000')),
+                                                ttl=int(os.getenv('ENTITLEMENT_CACHE_TTL_SECONDS', '60'))))
+
+def invalidate_user_profile_cache(user_id):
+    """Drops the cached profile row for user_id; call after committing changes to the users row."""
+    user_profile_cache.delete(user_id)
+    g.pop('current_user_row', None)
+
+def get_current_user():
+    """Returns the logged-in user's row from the profile cache, querying MySQL only on a miss."""
+    if 'current_user_row' not in g:
+        g.current_user_row = None
+        user_id = session.get('user_id')
+        if user_id:
+            user_row = user_profile_cache.get(user_id)
+            if user_row is None:
+                try:
+                    cursor = get_db_cursor()
+                    cursor.execute("SELECT id, username, email, role, first_name, last_name, phone_number, profile_picture_url, profile_picture_thumbs FROM users WHERE id = %s", (user_id,))
+                    user_row = cursor.fetchone()
+                    if user_row:
+                        user_profile_cache.set(user_id, user_row)
+                except Error as e:
+                    if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching current user {user_id}: {e}", exc_info=True)
+            g.current_user_row = user_row
+    return g.current_user_row
+
+def media_url(relative_path):
+    """URL for a stored upload (profile picture, thumbnail) or a bundled static asset."""
+    if not relative_path:
+        return None
+    if not media_storage.is_local and relative_path.startswith(MEDIA_KEY_PREFIX):
+        return media_storage.public_url(relative_path)
+    return url_for('static', filename=relative_path)
+
+def avatar_url(profile_picture_url, thumbs, size, image_format='jpeg'):
+    """URL of the avatar derivative for `size` px, falling back to the original or the default picture."""
+    thumb_key = avatar_thumb_key(thumbs, size, image_format)
+    if thumb_key:
+        return media_url(thumb_key)
+    return None if image_format == 'webp' else media_url(profile_picture_url or 'images/default_profile.png')
+
+app.jinja_env.globals['media_url'] = media_url
+app.jinja_env.globals['avatar_url'] = avatar_url
+
 @app.context_processor
 def inject_global_vars_for_templates():
     user_selected_language = session.get('current_lang', 'en')
     current_user_info = None
     user_id = session.get('user_id')
     if user_id:
-        conn = None
-        cursor = None
-        try:
-            conn = get_db_connection()
-            if conn:
-                cursor = conn.cursor(dictionary=True)
-                cursor.execute("SELECT id, username, email, role, first_name, last_name, phone_number, profile_picture_url FROM users WHERE id = %s", (user_id,))
-                user_data = cursor.fetchone() 
-                if user_data:
-                    current_user_info = {
-                        'id': user_data['id'],
-                        'username': user_data.get('first_name') or user_data.get('username', 'User'),
-                        'role': user_data['role'],
-                        'email': user_data.get('email'),
-                        'phone_number': user_data.get('phone_number'),
-                        'profile_picture_url': user_data.get('profile_picture_url') if user_data.get('profile_picture_url') else 'images/default_profile.png'
-                    }
-                session['profile_picture_url'] = current_user_info['profile_picture_url'] if current_user_info else 'images/default_profile.png'
-        except Error as e:
-            if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching user data for context processor: {e}", exc_info=True)
-        finally:
-            if cursor: cursor.close()
-            if conn and conn.is_connected(): conn.close()
+        user_data = get_current_user()
+        if user_data:
+            current_user_info = {
+                'id': user_data['id'],
+                'username': user_data.get('first_name') or user_data.get('username', 'User'),
+                'role': user_data['role'],
+                'email': user_data.get('email'),
+                'phone_number': user_data.get('phone_number'),
+                'profile_picture_url': user_data.get('profile_picture_url') if user_data.get('profile_picture_url') else 'images/default_profile.png',
+                'profile_picture_thumbs': user_data.get('profile_picture_thumbs')
+            }
+        profile_picture_url = current_user_info['profile_picture_url'] if current_user_info else 'images/default_profile.png'
+        if session.get('profile_picture_url') != profile_picture_url:  # Avoid re-serializing the cookie on every render
+            session['profile_picture_url'] = profile_picture_url
 
     return {
         'now': datetime.utcnow(),
@@ -295,6 +577,68 @@ def is_valid_phone_format_simple(phone_number_str):
 def allowed_file(filename_str, allowed_extensions_set):
     return '.' in filename_str and filename_str.rsplit('.', 1)[1].lower() in allowed_extensions_set
 
+REGRADE_CHUNK_SIZE = int(os.getenv('REGRADE_CHUNK_SIZE', '200'))
+REGRADE_LEASE_SECONDS = int(os.getenv('REGRADE_LEASE_SECONDS', '300'))
+
+def start_regrade_worker(job_id):
+    """Runs a newly created regrade job on a daemon thread with its own pooled connection.
+
+    A job interrupted by a restart keeps its 'running' lease until it expires (REGRADE_LEASE_SECONDS);
+    `flask run-regrade-jobs` then resumes it, along with jobs still 'pending'."""
+    def run_job():
+        conn = get_db_connection()
+        if conn is None:
+            app.logger.error(f"REGRADE: No DB connection for job {job_id}; leaving it for `flask run-regrade-jobs`.")
+            return
+        try:
+            run_regrade_job(conn, job_id, chunk_size=REGRADE_CHUNK_SIZE, lease_seconds=REGRADE_LEASE_SECONDS,
+                            logger=app.logger)
+        except Exception as e:
+            app.logger.error(f"REGRADE: Job {job_id} failed: {e}", exc_info=True)
+        finally:
+            conn.close()
+    threading.Thread(target=run_job, name=f"regrade-{job_id}", daemon=True).start()
+
+# ffmpeg is CPU-bound and already multi-threaded; cap concurrent encodes per web process
+_transcode_slots = threading.BoundedSemaphore(int(os.getenv('TRANSCODE_MAX_CONCURRENT', '1')))
+
+def start_transcode_worker(job_id):
+    """Transcodes a committed upload on a daemon thread, at most TRANSCODE_MAX_CONCURRENT at a time.
+
+    A job interrupted by a restart is resumed by `flask run-transcode-jobs` once its lease
+    (TRANSCODE_LEASE_SECONDS) runs out; a failed one is retried by the same command, up to
+    TRANSCODE_MAX_ATTEMPTS runs."""
+    def run_job():
+        with _transcode_slots:
+            conn = get_db_connection()
+            if conn is None:
+                app.logger.error(f"TRANSCODE: No DB connection for job {job_id}; leaving it for `flask run-transcode-jobs`.")
+                return
+            try:
+                run_transcode_job(conn, job_id, media_storage, logger=app.logger)
+            except Exception as e:
+                app.logger.error(f"TRANSCODE: Job {job_id} failed: {e}", exc_info=True)
+            finally:
+                conn.close()
+    threading.Thread(target=run_job, name=f"transcode-{job_id}", daemon=True).start()
+
+LISTING_PAGE_SIZE = int(os.getenv('LISTING_PAGE_SIZE', '24'))
+TEACHER_KEYSET = Keyset(('first_name', 'first_name', False, True), ('last_name', 'last_name', False, True),
+                        ('id', 'id', False))  # Served by idx_user_role_active_name
+VIDEO_KEYSET = Keyset(('v.upload_timestamp', 'upload_timestamp', True), ('v.id', 'id', True))
+QUIZ_KEYSET = Keyset(('q.created_at', 'created_at', True), ('q.id', 'id', True))
+
+password_hasher = hasher_from_env()
+atexit.register(password_hasher.shutdown)
+
+teacher_name_index = TeacherNameIndex(get_db_connection, refresh_seconds=float(os.getenv('TEACHER_SUGGEST_REFRESH_SECONDS', '60')),
+                                      overlap_seconds=int(os.getenv('TEACHER_SUGGEST_OVERLAP_SECONDS', '300')))
+
+VIEW_COUNTER_DIR = os.getenv('VIEW_COUNTER_DIR', os.path.join('logs', 'view_counts'))  # Must be local to this host
+view_counter = ViewCounter(VIEW_COUNTER_DIR, get_db_connection, flush_interval=float(os.getenv('VIEW_COUNTER_FLUSH_SECONDS', '10')),
+                           batch_retention_hours=int(os.getenv('VIEW_COUNTER_BATCH_RETENTION_HOURS', '168')))
+atexit.register(view_counter.close)
+
 # --- 7. Decorators for Route Protection ---
 def login_required(route_function):
     @wraps(route_function)
@@ -331,61 +675,18 @@ def student_required(route_function):
     return decorated_view_function
 
 # --- OTP Helper Functions ---
+# Codes live in otp_store (TTL, attempt limit, constant-time check), not in the users row
+otp_store = create_otp_store(app.secret_key)
+
 def generate_otp_for_user(user_id):
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        generated_otp = "".join(random.choices(string.digits, k=8))
-        otp_expiry_time = datetime.utcnow() + timedelta(minutes=10)
-        cursor.execute("UPDATE users SET otp_code = %s, otp_expiry = %s WHERE id = %s",
-                       (generated_otp, otp_expiry_time, user_id))
-        conn.commit()
-        return generated_otp
-    except Error as e:
-        if conn: conn.rollback()
-        if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error generating OTP for user {user_id}: {e}", exc_info=True)
-        return None
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+    return otp_store.issue(user_id)
 
 def is_otp_valid_for_user(user_id, provided_otp):
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id FROM users WHERE id = %s AND otp_code = %s AND otp_expiry > %s AND is_active = TRUE", 
-                       (user_id, provided_otp, datetime.utcnow()))
-        user_otp_data = cursor.fetchone() 
-        if user_otp_data:
-            return True
-        return False
-    except Error as e:
-        if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error verifying OTP for user {user_id}: {e}", exc_info=True)
-        return False
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+    return otp_store.verify(user_id, provided_otp) == OTP_OK
 
 def clear_otp_for_user(user_id):
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE users SET otp_code = NULL, otp_expiry = NULL WHERE id = %s", (user_id,))
-        conn.commit()
-        return True
-    except Error as e:
-        if conn: conn.rollback()
-        if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error clearing OTP for user {user_id}: {e}", exc_info=True)
-        return False
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+    otp_store.clear(user_id)
+    return True
 
 # --- 8. Application Routes (Authentication and Main Navigation) ---
 @app.route('/')
@@ -444,14 +745,12 @@ def signup_actual_form_page():
         if validation_errors:
             for error_message in validation_errors: flash(error_message, "danger")
             return render_template('auth/signup_actual_form.html', role=user_role_for_signup, is_minimal_layout=True, form_data=form_data_repopulate)
-
-        db_conn_signup = None; db_cursor_signup = None
         try:
-            db_conn_signup = get_db_connection()
+            db_conn_signup = get_db()
             if db_conn_signup is None:
                 raise Error("Database connection failed. Cannot register at this moment.")
             
-            db_cursor_signup = db_conn_signup.cursor(dictionary=True)
+            db_cursor_signup = get_db_cursor()
             db_cursor_signup.execute("SELECT id FROM users WHERE email = %s", (email,))
             _ = db_cursor_signup.fetchone() 
             if _:
@@ -465,7 +764,7 @@ def signup_actual_form_page():
                     flash(f"The phone number '{phone_number_input}' is already in use by another account.", "warning")
                     return render_template('auth/signup_actual_form.html', role=user_role_for_signup, is_minimal_layout=True, form_data=form_data_repopulate)
 
-            hashed_user_password = generate_password_hash(password_input)
+            hashed_user_password = password_hasher.hash(password_input)
             base_username_for_generation = f"{first_name.lower().replace(' ', '_')}{last_name.lower()[0] if last_name else ''}"
             unique_generated_username = f"{base_username_for_generation[:20]}_{uuid.uuid4().hex[:8]}"[:100]
 
@@ -478,12 +777,21 @@ def signup_actual_form_page():
                 first_name, last_name, phone_number_input if phone_number_input else None, country_selected
             )
             db_cursor_signup.execute(sql_insert_user_query, user_data_tuple_for_insert)
+            new_user_id = db_cursor_signup.lastrowid
+            if user_role_for_signup == 'teacher':
+                refresh_search_text(db_cursor_signup, new_user_id)
             db_conn_signup.commit() 
+            if user_role_for_signup == 'teacher':
+                teacher_name_index.upsert(new_user_id, first_name, last_name, unique_generated_username)
             
             session.pop('signup_attempt_role', None) 
             flash(f"Congratulations, {first_name}! Your account as a {user_role_for_signup.capitalize()} has been successfully created. You can now log in.", "success")
             return redirect(url_for('login_page'))
         
+        except PasswordHasherBusyError:
+            if db_conn_signup: db_conn_signup.rollback()
+            flash("The server is busy right now. Please try again in a moment.", "warning")
+            return render_template('auth/signup_actual_form.html', role=user_role_for_signup, is_minimal_layout=True, form_data=form_data_repopulate), 503
         except Error as db_signup_err:
             if db_conn_signup: db_conn_signup.rollback()
             if hasattr(app, 'logger') and app.logger: app.logger.error(f"SIGNUP_DB_ERROR for email {email}: {db_signup_err.errno} - {db_signup_err.msg}", exc_info=False)
@@ -492,9 +800,6 @@ def signup_actual_form_page():
             if db_conn_signup: db_conn_signup.rollback()
             if hasattr(app, 'logger') and app.logger: app.logger.critical(f"SIGNUP_GENERAL_ERROR: An unexpected error occurred: {general_signup_err}", exc_info=True)
             flash("An unexpected error occurred during the registration process. Please try again. (Code: REG-GEN)", "danger")
-        finally:
-            if db_cursor_signup: db_cursor_signup.close()
-            if db_conn_signup and db_conn_signup.is_connected(): db_conn_signup.close()
         
         return render_template('auth/signup_actual_form.html', role=user_role_for_signup, is_minimal_layout=True, form_data=form_data_repopulate)
 
@@ -536,14 +841,12 @@ def login_page():
         if validation_errors:
             for error_message in validation_errors: flash(error_message, "danger")
             return render_template('auth/login_form.html', is_minimal_layout=True, form_data=form_data_repopulate, next=next_redirect_url)
-
-        db_conn_login = None; db_cursor_login = None
         try:
-            db_conn_login = get_db_connection()
+            db_conn_login = get_db()
             if db_conn_login is None:
                 raise Error("Database connection unavailable. Please try again shortly.")
             
-            db_cursor_login = db_conn_login.cursor(dictionary=True)
+            db_cursor_login = get_db_cursor()
             user_record_from_db = None
             if is_phone_login_attempt:
                 sql_query = """
@@ -561,7 +864,15 @@ def login_page():
             db_cursor_login.execute(sql_query, query_params)
             user_record_from_db = db_cursor_login.fetchone() 
 
-            if user_record_from_db and check_password_hash(user_record_from_db['password_hash'], password_input):
+            if user_record_from_db and password_hasher.verify(user_record_from_db['password_hash'], password_input):
+                if password_hasher.needs_rehash(user_record_from_db['password_hash']):
+                    try:
+                        db_cursor_login.execute("UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                                                (password_hasher.hash(password_input), user_record_from_db['id'], user_record_from_db['password_hash']))
+                        db_conn_login.commit()
+                    except (Error, PasswordHasherBusyError) as rehash_err:  # Upgrade next time; the login itself succeeded
+                        db_conn_login.rollback()
+                        if hasattr(app, 'logger') and app.logger: app.logger.warning(f"LOGIN_REHASH_FAILED for user {user_record_from_db['id']}: {rehash_err}")
                 session.clear() 
                 session['user_id'] = user_record_from_db['id']
                 session['username'] = user_record_from_db.get('first_name') or user_record_from_db.get('username', 'Valued User')
@@ -588,15 +899,15 @@ def login_page():
             else:
                 flash("Invalid identifier or password, or your account may be inactive. Please check and try again.", "danger")
         
+        except PasswordHasherBusyError:
+            flash("The server is busy right now. Please try again in a moment.", "warning")
+            return render_template('auth/login_form.html', is_minimal_layout=True, form_data=form_data_repopulate, next=next_redirect_url), 503
         except Error as db_login_err:
             if hasattr(app, 'logger') and app.logger: app.logger.error(f"LOGIN_DB_ERROR for identifier {login_identifier}: {db_login_err.errno} - {db_login_err.msg}", exc_info=False)
             flash("A database error occurred during login. (Code: LOGIN-DBE)", "danger")
         except Exception as general_login_err:
             if hasattr(app, 'logger') and app.logger: app.logger.critical(f"LOGIN_GENERAL_ERROR for identifier {login_identifier}: {general_login_err}", exc_info=True)
             flash("An unexpected error occurred. (Code: LOGIN-GEN)", "danger")
-        finally:
-            if db_cursor_login: db_cursor_login.close()
-            if db_conn_login and db_conn_login.is_connected(): db_conn_login.close()
         
         return render_template('auth/login_form.html', is_minimal_layout=True, form_data=form_data_repopulate, next=next_redirect_url)
 
@@ -623,22 +934,18 @@ def api_request_otp():
     phone_number_input = data.get('phone_number', '').strip()
     if not is_valid_phone_format_simple(phone_number_input):
         return jsonify({'success': False, 'message': 'رقم الموبايل المدخل غير صالح.'}), 400
-    conn = None; cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             if hasattr(app, 'logger') and app.logger: app.logger.error("OTP_REQUEST_FAIL: DB Connection Error")
             return jsonify({'success': False, 'message': 'خطأ في الاتصال بقاعدة البيانات.'}), 500
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         cursor.execute("SELECT id FROM users WHERE phone_number = %s AND is_active = TRUE", (phone_number_input,))
         user = cursor.fetchone() 
         if not user:
             if hasattr(app, 'logger') and app.logger: app.logger.info(f"OTP_REQUEST_INFO: Phone {phone_number_input} not found. Generic success sent.")
             return jsonify({'success': True, 'message': 'إذا كان الرقم مسجلاً، سيتم إرسال رمز التأكيد.'}), 200
-        otp_code_generated = "".join(random.choices("0123456789", k=8))
-        otp_expiry_time = datetime.utcnow() + timedelta(minutes=10)
-        cursor.execute("UPDATE users SET otp_code = %s, otp_expiry = %s WHERE id = %s",(otp_code_generated, otp_expiry_time, user['id']))
-        conn.commit()
+        otp_code_generated = generate_otp_for_user(user['id'])
         if hasattr(app, 'logger') and app.logger: app.logger.info(f"OTP_SENT (simulated): To {phone_number_input}, OTP: {otp_code_generated}")
         print(f"DEBUG - OTP for {phone_number_input}: {otp_code_generated}") 
         return jsonify({'success': True, 'message': 'تم إرسال رمز التأكيد إلى رقم موبايلك.'}), 200
@@ -650,9 +957,6 @@ def api_request_otp():
         if conn: conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"OTP_REQUEST_GENERAL_ERROR: {e}", exc_info=True)
         return jsonify({'success': False, 'message': 'خطأ غير متوقع عند طلب الرمز.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/auth/verify-otp', methods=['POST'])
 def api_verify_otp():
@@ -663,15 +967,18 @@ def api_verify_otp():
     otp_code_input = data.get('otp_code', '').strip()
     if not is_valid_phone_format_simple(phone_number_input) or not otp_code_input.isdigit() or len(otp_code_input) != 8:
         return jsonify({'success': False, 'message': 'بيانات الإدخال غير صالحة.'}), 400
-    conn = None; cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None: return jsonify({'success': False, 'message': 'خطأ اتصال قاعدة البيانات.'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id FROM users WHERE phone_number = %s AND otp_code = %s AND otp_expiry > %s AND is_active = TRUE",
-                       (phone_number_input, otp_code_input, datetime.utcnow()))
+        cursor = get_db_cursor()
+        cursor.execute("SELECT id FROM users WHERE phone_number = %s AND is_active = TRUE", (phone_number_input,))
         user = cursor.fetchone() 
-        if user:
+        otp_result = otp_store.verify(user['id'], otp_code_input) if user else None
+        if otp_result == OTP_LOCKED:
+            if hasattr(app, 'logger') and app.logger: app.logger.warning(f"OTP_VERIFY_LOCKED: Too many attempts for {phone_number_input}")
+            session.pop(f'otp_verified_for_phone_{phone_number_input}', None)
+            return jsonify({'success': False, 'message': 'تم تجاوز عدد المحاولات المسموح بها. يرجى طلب رمز جديد.'}), 429
+        if otp_result == OTP_OK:
             session[f'otp_verified_for_phone_{phone_number_input}'] = True
             session['login_identifier_for_otp_prefill'] = phone_number_input 
             if hasattr(app, 'logger') and app.logger: app.logger.info(f"OTP_VERIFIED: For {phone_number_input}")
@@ -688,9 +995,6 @@ def api_verify_otp():
         if conn: conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"OTP_VERIFY_GENERAL_ERROR: {e}", exc_info=True)
         return jsonify({'success': False, 'message': 'خطأ غير متوقع عند التحقق.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/auth/reset-password', methods=['POST'])
 def api_reset_password():
@@ -704,13 +1008,12 @@ def api_reset_password():
     if not session.get(f'otp_verified_for_phone_{phone_number_input}'):
         if hasattr(app, 'logger') and app.logger: app.logger.warning(f"RESET_PASS_UNAUTHORIZED: For {phone_number_input} - No OTP session flag.")
         return jsonify({'success': False, 'message': 'غير مصرح به أو انتهت الجلسة. يرجى التحقق من الرمز أولاً.'}), 403
-    conn = None; cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None: return jsonify({'success': False, 'message': 'خطأ اتصال قاعدة البيانات.'}), 500
-        cursor = conn.cursor()
-        new_password_hashed = generate_password_hash(new_password_input)
-        cursor.execute("UPDATE users SET password_hash = %s, otp_code = NULL, otp_expiry = NULL WHERE phone_number = %s AND is_active = TRUE",
+        cursor = get_db_cursor(dictionary=False)
+        new_password_hashed = password_hasher.hash(new_password_input)
+        cursor.execute("UPDATE users SET password_hash = %s WHERE phone_number = %s AND is_active = TRUE",
                        (new_password_hashed, phone_number_input))
         if cursor.rowcount > 0:
             conn.commit()
@@ -724,6 +1027,8 @@ def api_reset_password():
             session.pop(f'otp_verified_for_phone_{phone_number_input}', None) 
             session.pop(f'login_identifier_for_otp_prefill', None)
             return jsonify({'success': False, 'message': 'فشل إعادة تعيين كلمة المرور (مستخدم غير موجود/نشط).'}), 404
+    except PasswordHasherBusyError:
+        return jsonify({'success': False, 'message': 'الخادم مشغول حالياً. يرجى المحاولة مرة أخرى بعد قليل.'}), 503
     except Error as db_err:
         if conn: conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"RESET_PASS_DB_ERROR: {db_err.msg}", exc_info=False)
@@ -732,62 +1037,59 @@ def api_reset_password():
         if conn: conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"RESET_PASS_GENERAL_ERROR: {e}", exc_info=True)
         return jsonify({'success': False, 'message': 'خطأ غير متوقع عند إعادة التعيين.'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 # --- Public Routes ---
 @app.route('/explore/teachers')
 def explore_teachers_page():
     search_query = request.args.get('search_query', '').strip()
     teachers_list = []
-    db_conn = None; db_cursor = None
+    next_cursor = None
     try:
-        db_conn = get_db_connection()
+        db_conn = get_db()
         if db_conn is None:
             if hasattr(app, 'logger') and app.logger: app.logger.error("EXPLORE_TEACHERS_DB_ERROR: Failed to connect to database.")
             flash("Database connection error. Please try again later.", "danger")
             return render_template('public/explore_teachers.html', teachers=[], search_query=search_query)
-        db_cursor = db_conn.cursor(dictionary=True)
-        sql_query = "SELECT id, first_name, last_name, username, profile_picture_url, bio FROM users WHERE role = 'teacher' AND is_active = TRUE"
-        query_params = []
-        if search_query:
-            sql_query += " AND (first_name LIKE %s OR last_name LIKE %s OR username LIKE %s OR bio LIKE %s)"
-            search_pattern = f"%{search_query}%"
-            query_params.extend([search_pattern, search_pattern, search_pattern, search_pattern])
-        sql_query += " ORDER BY first_name ASC, last_name ASC"
-        db_cursor.execute(sql_query, tuple(query_params))
-        teachers_list = db_cursor.fetchall()
+        db_cursor = get_db_cursor()
+        teacher_columns = "id, first_name, last_name, username, profile_picture_url, profile_picture_thumbs, bio"
+        # Relevance-ranked results are one bounded page; browsing by name pages with a cursor
+        teachers_list = search_teachers(db_cursor, search_query, teacher_columns, limit=LISTING_PAGE_SIZE * 2) if search_query else None
+        if teachers_list is None:
+            # No query, or only a single character, which the ngram index cannot match
+            sql_query = f"""SELECT {teacher_columns}
+                FROM users WHERE role = 'teacher' AND is_active = TRUE"""
+            query_params = []
+            if search_query:
+                sql_query += " AND (first_name LIKE %s OR last_name LIKE %s)"
+                query_params.extend([like_prefix(search_query)] * 2)
+            teachers_list, next_cursor = fetch_page(db_cursor, sql_query, query_params, TEACHER_KEYSET,
+                                                    request.args.get('cursor'), LISTING_PAGE_SIZE)
     except Error as e_db:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"EXPLORE_TEACHERS_DB_ERROR: {e_db.msg}", exc_info=True)
         flash("An error occurred while fetching teachers. Please try again.", "danger")
     except Exception as e_general:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"EXPLORE_TEACHERS_GENERAL_ERROR: {e_general}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if db_cursor: db_cursor.close()
-        if db_conn and db_conn.is_connected(): db_conn.close()
-    return render_template('public/explore_teachers.html', teachers=teachers_list, search_query=search_query, current_lang=session.get('current_lang', 'en'))
+    return render_template('public/explore_teachers.html', teachers=teachers_list, search_query=search_query, next_cursor=next_cursor,
+                           current_lang=session.get('current_lang', 'en'))
 
 @app.route('/teacher_profile/<int:teacher_id>')
 def public_teacher_profile_page(teacher_id):
     teacher_profile = None
     teacher_videos = []
     teacher_quizzes = []
+    next_videos_cursor = next_quizzes_cursor = None
     is_subscribed = False # Assume not subscribed by default
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return render_template('public/teacher_profile.html', teacher_profile=None)
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         cursor.execute("""
-            SELECT id, first_name, last_name, bio, country, profile_picture_url
+            SELECT id, first_name, last_name, bio, country, profile_picture_url, profile_picture_thumbs
             FROM users WHERE id = %s AND role = 'teacher' AND is_active = TRUE
         """, (teacher_id,))
         teacher_profile = cursor.fetchone() 
@@ -795,38 +1097,24 @@ def public_teacher_profile_page(teacher_id):
             flash("Teacher not found or is inactive.", "warning")
             return redirect(url_for('explore_teachers_page'))
         
-        current_user_id = session.get('user_id')
-        if current_user_id and session.get('role') == 'student':
-            cursor.execute("""
-                SELECT id FROM student_subscriptions
-                WHERE student_id = %s AND teacher_id = %s AND status = 'active'
-            """, (current_user_id, teacher_id))
-            _ = cursor.fetchone() 
-            if _:
-                is_subscribed = True
+        # Only students hold subscriptions; other visitors see free videos only
+        student_id = session.get('user_id') if session.get('role') == 'student' else None
+        is_subscribed = entitlements.is_subscribed(cursor, student_id, teacher_id) if student_id else False
         
-        cursor.execute("""
-            SELECT id, title, description, thumbnail_path_or_url, is_viewable_free_for_student
-            FROM videos WHERE teacher_id = %s AND status = 'published' ORDER BY upload_timestamp DESC
-        """, (teacher_id,))
-        videos_raw = cursor.fetchall()
-
-        for video in videos_raw:
-            video['has_access'] = is_subscribed or video['is_viewable_free_for_student']
-            teacher_videos.append(video)
-
-        cursor.execute("""
-            SELECT q.id, q.title, q.description, q.time_limit_minutes, q.passing_score_percentage, q.allow_answer_review, v.title AS video_title,
-                   (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id) AS question_count
+        teacher_videos, next_videos_cursor = fetch_page(cursor, """
+            SELECT v.id, v.title, v.description, v.thumbnail_path_or_url, v.is_viewable_free_for_student, v.upload_timestamp
+            FROM videos v WHERE v.teacher_id = %s AND v.status = 'published'
+        """, (teacher_id,), VIDEO_KEYSET, request.args.get('videos_cursor'), LISTING_PAGE_SIZE)
+        entitlements.annotate_access(cursor, student_id, teacher_videos, teacher_id=teacher_id)
+
+        teacher_quizzes, next_quizzes_cursor = fetch_page(cursor, """
+            SELECT q.id, q.title, q.description, q.time_limit_minutes, q.passing_score_percentage, q.allow_answer_review, q.created_at,
+                   v.title AS video_title, (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id) AS question_count
             FROM quizzes q
             LEFT JOIN videos v ON q.video_id = v.id
-            WHERE q.teacher_id = %s AND q.is_active = TRUE ORDER BY q.created_at DESC
-        """, (teacher_id,))
-        quizzes_raw = cursor.fetchall()
-
-        for quiz in quizzes_raw:
-            quiz['has_access'] = is_subscribed 
-            teacher_quizzes.append(quiz)
+            WHERE q.teacher_id = %s AND q.is_active = TRUE
+        """, (teacher_id,), QUIZ_KEYSET, request.args.get('quizzes_cursor'), LISTING_PAGE_SIZE)
+        entitlements.annotate_access(cursor, student_id, teacher_quizzes, teacher_id=teacher_id)  # Quizzes have no free flag
 
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"Error loading teacher profile {teacher_id}: {e}", exc_info=True)
@@ -836,14 +1124,13 @@ def public_teacher_profile_page(teacher_id):
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"EXPLORE_TEACHERS_GENERAL_ERROR: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
         return redirect(url_for('explore_teachers_page'))
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('public/teacher_profile.html',
                            teacher_profile=teacher_profile,
                            teacher_videos=teacher_videos,
                            teacher_quizzes=teacher_quizzes,
+                           next_videos_cursor=next_videos_cursor,
+                           next_quizzes_cursor=next_quizzes_cursor,
                            is_subscribed=is_subscribed,
                            current_user_id=session.get('user_id'),
                            current_lang=session.get('current_lang', 'en'))
@@ -855,61 +1142,35 @@ def teacher_dashboard_placeholder():
     user_id = session.get('user_id')
     username = session.get('username')
 
-    subscribers = 0
-    total_views = 0
-    quizzes_count = 0
-    questions_count = 0
-
-    conn = None
-    cursor = None
+    stats = {'subscribers_count': 0, 'total_views': 0, 'quizzes_count': 0, 'questions_count': 0}
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT COUNT(*) AS count FROM student_subscriptions WHERE teacher_id = %s AND status = 'active'", (user_id,))
-            subscribers = cursor.fetchone()['count']
-
-            cursor.execute("SELECT SUM(views_count) AS total FROM videos WHERE teacher_id = %s", (user_id,))
-            total_views_result = cursor.fetchone()['total']
-            total_views = total_views_result if total_views_result is not None else 0
-
-            cursor.execute("SELECT COUNT(*) AS count FROM quizzes WHERE teacher_id = %s", (user_id,))
-            quizzes_count = cursor.fetchone()['count']
-
-            cursor.execute("""
-                SELECT COUNT(q.id) AS count FROM questions q
-                JOIN quizzes quiz ON q.quiz_id = quiz.id
-                WHERE quiz.teacher_id = %s
-            """, (user_id,))
-            questions_count = cursor.fetchone()['count']
+            stats = get_teacher_stats(get_db_cursor(), user_id)
+            conn.commit()  # Keeps the counters row if it was seeded by this lookup
 
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching teacher dashboard stats for user {user_id}: {e}", exc_info=True)
         flash("Could not load some dashboard statistics.", "warning")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/dashboard.html',
                            username=username,
-                           subscribers=subscribers,
-                           total_views=total_views,
-                           quizzes_count=quizzes_count,
-                           questions_count=questions_count)
+                           subscribers=stats['subscribers_count'],
+                           total_views=stats['total_views'],
+                           quizzes_count=stats['quizzes_count'],
+                           questions_count=stats['questions_count'])
 
 @app.route('/teacher/upload_video', methods=['GET', 'POST'])
 @teacher_required
 def upload_video_page():
     user_id = session.get('user_id')
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Cannot upload video at this time.", "danger")
             return render_template('teacher/upload_video.html', request_form=request.form)
 
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         cursor.execute("SELECT free_video_uploads_remaining FROM users WHERE id = %s", (user_id,))
         user_limits = cursor.fetchone() 
         free_uploads_remaining = user_limits['free_video_uploads_remaining'] if user_limits else 0
@@ -933,41 +1194,40 @@ def upload_video_page():
                 for error_message in validation_errors: flash(error_message, "danger")
                 return render_template('teacher/upload_video.html', request_form=request.form)
 
-            filename = secure_filename(video_file.filename)
-            unique_filename = f"{uuid.uuid4().hex}_{filename}"
-            video_path = os.path.join(app.config['UPLOAD_FOLDER_VIDEOS'], unique_filename)
-            
-            try:
-                video_file.save(video_path)
-            except Exception as e:
-                if hasattr(app, 'logger') and app.logger: app.logger.critical(f"Failed to save video file {unique_filename}: {e}", exc_info=True)
-                flash("Failed to save video file on server. Please try again.", "danger")
-                return render_template('teacher/upload_video.html', request_form=request.form)
-
+            video_path = None
             try:
+                video_path = store_stream(cursor, video_file.stream, media_storage, video_file.filename.rsplit('.', 1)[1])
                 cursor.execute("""
                     INSERT INTO videos (teacher_id, title, description, video_path_or_url, is_viewable_free_for_student, status)
-                    VALUES (%s, %s, %s, %s, %s, 'published')
-                """, (user_id, title, description, os.path.join('uploads', 'videos', unique_filename), is_viewable_free))
-                conn.commit()
-
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (user_id, title, description, video_path, is_viewable_free,
+                      'processing' if VIDEO_TRANSCODING_ENABLED else 'published'))
+                transcode_job_id = enqueue_transcode(cursor, cursor.lastrowid) if VIDEO_TRANSCODING_ENABLED else None
                 if not is_viewable_free:
                      cursor.execute("UPDATE users SET free_video_uploads_remaining = free_video_uploads_remaining - 1 WHERE id = %s", (user_id,))
-                     conn.commit()
+                conn.commit()
 
-                flash("Video uploaded and published successfully!", "success")
+                if transcode_job_id:
+                    start_transcode_worker(transcode_job_id)
+                    flash("Video uploaded successfully! It will be published once processing finishes.", "success")
+                else:
+                    flash("Video uploaded and published successfully!", "success")
                 return redirect(url_for('teacher_videos_list_page'))
             except Error as e:
                 conn.rollback()
                 if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error during video upload for user {user_id}: {e}", exc_info=True)
-                if os.path.exists(video_path):
-                    os.remove(video_path)
+                if video_path:
+                    discard_unregistered(conn, media_storage, video_path)
                 flash("A database error occurred during video upload. Please try again.", "danger")
+            except OSError as e:
+                conn.rollback()
+                if hasattr(app, 'logger') and app.logger: app.logger.critical(f"Failed to save video file for user {user_id}: {e}", exc_info=True)
+                flash("Failed to save video file on server. Please try again.", "danger")
             except Exception as e:
                 conn.rollback()
                 if hasattr(app, 'logger') and app.logger: app.logger.critical(f"Unexpected error during video upload for user {user_id}: {e}", exc_info=True)
-                if os.path.exists(video_path):
-                    os.remove(video_path)
+                if video_path:
+                    discard_unregistered(conn, media_storage, video_path)
                 flash("An unexpected error occurred. Please try again.", "danger")
 
         return render_template('teacher/upload_video.html', request_form=request.form, free_uploads_remaining=free_uploads_remaining)
@@ -975,57 +1235,204 @@ def upload_video_page():
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on upload_video_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
         return redirect(url_for('teacher_dashboard_placeholder'))
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+
+# --- Resumable chunked video uploads (init -> PUT chunks -> finalize) ---
+@app.route('/teacher/uploads/videos', methods=['POST'])
+@teacher_required
+def api_init_video_upload():
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename', '')).strip()
+    title = str(data.get('title', '')).strip()
+    description = str(data.get('description', '')).strip()
+    is_viewable_free = bool(data.get('is_viewable_free'))
+    try:
+        total_size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        total_size = 0
+
+    validation_errors = []
+    if not title: validation_errors.append("Video title is required.")
+    if not filename or not allowed_file(filename, ALLOWED_EXTENSIONS_VIDEOS): validation_errors.append("Invalid video file format. Allowed: MP4, MOV, AVI, MKV, WebM.")
+    if total_size <= 0: validation_errors.append("File size is required.")
+    elif total_size > MAX_VIDEO_UPLOAD_BYTES: validation_errors.append(f"Video exceeds the {MAX_VIDEO_UPLOAD_BYTES // (1024 * 1024)} MB limit.")
+    if validation_errors:
+        return jsonify({'success': False, 'message': ' '.join(validation_errors)}), 400
+    try:
+        conn = get_db()
+        cursor = get_db_cursor()
+        cursor.execute("SELECT free_video_uploads_remaining FROM users WHERE id = %s", (user_id,))
+        user_limits = cursor.fetchone()
+        if not user_limits or user_limits['free_video_uploads_remaining'] <= 0:
+            return jsonify({'success': False, 'message': 'You have used all your free video uploads.'}), 403
+        stored_filename = f"{uuid.uuid4().hex}_{secure_filename(filename)}"
+        upload_id = create_upload_session(cursor, user_id, stored_filename, total_size, title, description, is_viewable_free)
+        conn.commit()
+    except Error as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"UPLOAD_INIT_DB_ERROR for user {user_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Database error starting the upload.'}), 500
+    return jsonify({'success': True, 'upload_id': upload_id, 'received_bytes': 0,
+                    'total_size': total_size, 'chunk_size': VIDEO_UPLOAD_CHUNK_BYTES}), 201
+
+@app.route('/teacher/uploads/videos/<string:upload_id>', methods=['GET'])
+@teacher_required
+def api_video_upload_status(upload_id):
+    """Tells a resuming client how many bytes the server already has."""
+    try:
+        upload = get_upload_session(get_db_cursor(), upload_id, session.get('user_id'))
+    except Error as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"UPLOAD_STATUS_DB_ERROR for upload {upload_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Database error.'}), 500
+    if not upload:
+        return jsonify({'success': False, 'message': 'Upload not found.'}), 404
+    return jsonify({'success': True, 'upload_id': upload_id, 'status': upload['status'],
+                    'received_bytes': upload['received_bytes'], 'total_size': upload['total_size'],
+                    'chunk_size': VIDEO_UPLOAD_CHUNK_BYTES})
+
+def upload_part_path(stored_filename):
+    """Where a chunked upload's partial file lives: the media store's scratch directory, which Flask
+    does not serve. Sessions begun while partial files were kept in the videos folder finish there."""
+    legacy_path = os.path.join(app.config['UPLOAD_FOLDER_VIDEOS'], stored_filename + PART_SUFFIX)
+    if os.path.exists(legacy_path):
+        return legacy_path
+    return os.path.join(media_storage.temp_dir(), stored_filename + PART_SUFFIX)
+
+@app.route('/teacher/uploads/videos/<string:upload_id>', methods=['PUT'])
+@teacher_required
+def api_put_video_chunk(upload_id):
+    """Writes the request body at ?offset=N. Offsets must be sequential; the X-Chunk-SHA256 header is required and verified."""
+    user_id = session.get('user_id')
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    chunk_sha256 = request.headers.get('X-Chunk-SHA256')
+    if offset is None or length is None or length <= 0:
+        return jsonify({'success': False, 'message': 'offset and Content-Length are required.'}), 400
+    if not is_sha256_hex(chunk_sha256):
+        return jsonify({'success': False, 'message': 'X-Chunk-SHA256 header with the chunk\'s hex SHA-256 is required.'}), 400
+    try:
+        conn = get_db()
+        cursor = get_db_cursor()
+        upload = get_upload_session(cursor, upload_id, user_id)
+        conn.commit()  # Don't hold a transaction open while the chunk is transferred
+        if not upload or upload['status'] != 'uploading':
+            return jsonify({'success': False, 'message': 'Upload not found or already finalized.'}), 404
+        if offset != upload['received_bytes']:
+            return jsonify({'success': False, 'message': 'Unexpected offset.', 'received_bytes': upload['received_bytes']}), 409
+        if offset + length > upload['total_size']:
+            return jsonify({'success': False, 'message': 'Chunk extends past the declared file size.'}), 400
+
+        part_path = upload_part_path(upload['stored_filename'])
+        try:
+            write_chunk(part_path, offset, request.stream, length, chunk_sha256)
+        except ChunkChecksumError as e:
+            return jsonify({'success': False, 'message': str(e), 'received_bytes': offset}), 422
+        except EOFError as e:
+            return jsonify({'success': False, 'message': str(e), 'received_bytes': offset}), 400
+
+        cursor.execute("""
+            UPDATE upload_sessions SET received_bytes = %s
+            WHERE id = %s AND received_bytes = %s AND status = 'uploading'
+        """, (offset + length, upload_id, offset))
+        if cursor.rowcount == 0:  # Another request for the same offset won the race
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Concurrent chunk upload detected.'}), 409
+        conn.commit()
+    except Error as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"UPLOAD_CHUNK_DB_ERROR for upload {upload_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Database error saving the chunk.'}), 500
+    except OSError as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.critical(f"UPLOAD_CHUNK_FS_ERROR for upload {upload_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to store the chunk on the server.'}), 500
+    return jsonify({'success': True, 'received_bytes': offset + length, 'total_size': upload['total_size']})
+
+@app.route('/teacher/uploads/videos/<string:upload_id>/finalize', methods=['POST'])
+@teacher_required
+def api_finalize_video_upload(upload_id):
+    """Creates the videos row once every byte has arrived, charging the upload quota like the form path."""
+    user_id = session.get('user_id')
+    conn = None
+    part_path = None
+    video_path = None
+    try:
+        conn = get_db()
+        cursor = get_db_cursor()
+        upload = get_upload_session(cursor, upload_id, user_id, for_update=True)
+        if not upload or upload['status'] != 'uploading':
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Upload not found or already finalized.'}), 404
+        if upload['received_bytes'] != upload['total_size']:
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Upload is incomplete.', 'received_bytes': upload['received_bytes']}), 409
+        cursor.execute("SELECT free_video_uploads_remaining FROM users WHERE id = %s FOR UPDATE", (user_id,))
+        user_limits = cursor.fetchone()
+        if not user_limits or user_limits['free_video_uploads_remaining'] <= 0:
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'You have used all your free video uploads.'}), 403
+
+        part_path = upload_part_path(upload['stored_filename'])
+        video_path = store_file(cursor, part_path, media_storage, upload['stored_filename'].rsplit('.', 1)[1])
+        cursor.execute("""
+            INSERT INTO videos (teacher_id, title, description, video_path_or_url, is_viewable_free_for_student, status)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (user_id, upload['title'], upload['description'], video_path,
+              upload['is_viewable_free'], 'processing' if VIDEO_TRANSCODING_ENABLED else 'published'))
+        video_id = cursor.lastrowid
+        transcode_job_id = enqueue_transcode(cursor, video_id) if VIDEO_TRANSCODING_ENABLED else None
+        if not upload['is_viewable_free']:
+            cursor.execute("UPDATE users SET free_video_uploads_remaining = free_video_uploads_remaining - 1 WHERE id = %s", (user_id,))
+        cursor.execute("UPDATE upload_sessions SET status = 'completed', video_id = %s WHERE id = %s", (video_id, upload_id))
+        conn.commit()
+    except (Error, OSError) as e:
+        if conn: conn.rollback()
+        if video_path:
+            discard_unregistered(conn, media_storage, video_path, restore_to=part_path)  # Keep the bytes so the client can retry finalize
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"UPLOAD_FINALIZE_ERROR for upload {upload_id}: {e}", exc_info=True)
+        return jsonify({'success': False, 'message': 'Failed to finalize the upload. Please retry.'}), 500
+    if transcode_job_id:
+        start_transcode_worker(transcode_job_id)
+        flash("Video uploaded successfully! It will be published once processing finishes.", "success")
+    else:
+        flash("Video uploaded and published successfully!", "success")
+    return jsonify({'success': True, 'video_id': video_id, 'redirect_url': url_for('teacher_videos_list_page')}), 201
 
 @app.route('/teacher/videos')
 @teacher_required
 def teacher_videos_list_page():
     user_id = session.get('user_id')
     videos = []
-    conn = None
-    cursor = None
+    next_cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT id, title, description, video_path_or_url, thumbnail_path_or_url, upload_timestamp, status FROM videos WHERE teacher_id = %s ORDER BY upload_timestamp DESC", (user_id,))
-            videos = cursor.fetchall()
+            cursor = get_db_cursor()
+            videos, next_cursor = fetch_page(
+                cursor, "SELECT v.id, v.title, v.description, v.video_path_or_url, v.thumbnail_path_or_url, v.upload_timestamp, v.status FROM videos v WHERE v.teacher_id = %s",
+                (user_id,), VIDEO_KEYSET, request.args.get('cursor'), LISTING_PAGE_SIZE)
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching teacher videos for user {user_id}: {e}", exc_info=True)
         flash("An error occurred while fetching your videos. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
-    return render_template('teacher/videos_list.html', videos=videos)
+    return render_template('teacher/videos_list.html', videos=videos, next_cursor=next_cursor)
 
 @app.route('/teacher/quizzes')
 @teacher_required
 def teacher_quizzes_list_page():
     user_id = session.get('user_id')
     quizzes = []
-    conn = None
-    cursor = None
+    next_cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("""
+            cursor = get_db_cursor()
+            quizzes, next_cursor = fetch_page(cursor, """
                 SELECT q.id, q.title, q.description, q.created_at, q.is_active, v.title AS video_title
                 FROM quizzes q
                 LEFT JOIN videos v ON q.video_id = v.id
                 WHERE q.teacher_id = %s
-                ORDER BY q.created_at DESC
-            """, (user_id,))
-            quizzes = cursor.fetchall()
+            """, (user_id,), QUIZ_KEYSET, request.args.get('cursor'), LISTING_PAGE_SIZE)
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching teacher quizzes for user {user_id}: {e}", exc_info=True)
         flash("An error occurred while fetching your quizzes. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
-    return render_template('teacher/quizzes_list.html', quizzes=quizzes)
+    return render_template('teacher/quizzes_list.html', quizzes=quizzes, next_cursor=next_cursor)
 
 @app.route('/teacher/quiz/create', methods=['GET', 'POST'])
 @teacher_required
@@ -1034,13 +1441,10 @@ def create_quiz_page():
     teacher_videos = []
     can_create_quiz = False
     free_quizzes_left = 0
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
+            cursor = get_db_cursor()
             cursor.execute("SELECT id, title FROM videos WHERE teacher_id = %s AND status = 'published' ORDER BY title ASC", (user_id,))
             teacher_videos = cursor.fetchall()
 
@@ -1088,6 +1492,7 @@ def create_quiz_page():
                     quiz_id = cursor.lastrowid 
                     
                     cursor.execute("UPDATE users SET free_quiz_creations_remaining = free_quiz_creations_remaining - 1 WHERE id = %s", (user_id,))
+                    bump_teacher_stats(cursor, user_id, quizzes=1)
                     conn.commit()
 
                     flash(f"Quiz '{title}' created successfully! Now add some questions.", "success")
@@ -1108,9 +1513,6 @@ def create_quiz_page():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on create_quiz_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/create_quiz.html', teacher_videos=teacher_videos, can_create_quiz=can_create_quiz, free_quizzes_left=free_quizzes_left, video_id_preselected=request.args.get('video_id'))
 
@@ -1121,16 +1523,13 @@ def edit_quiz_page(quiz_id):
     quiz = None
     teacher_videos = []
     submitted_data = None
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('teacher_quizzes_list_page'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         
         cursor.execute("SELECT id, title, description, video_id, time_limit_minutes, passing_score_percentage, allow_answer_review, is_active FROM quizzes WHERE id = %s AND teacher_id = %s", (quiz_id, user_id))
         quiz = cursor.fetchone() 
@@ -1174,12 +1573,17 @@ def edit_quiz_page(quiz_id):
                     UPDATE quizzes SET
                     title = %s, description = %s, video_id = %s,
                     time_limit_minutes = %s, passing_score_percentage = %s, allow_answer_review = %s,
-                    updated_at = CURRENT_TIMESTAMP
+                    content_version = content_version + 1, updated_at = CURRENT_TIMESTAMP
                     WHERE id = %s AND teacher_id = %s
                 """, (title, description, linked_video_id if linked_video_id else None,
                       time_limit_minutes, passing_score_percentage, allow_answer_review,
                       quiz_id, user_id))
+                regrade_job_id, regrade_job_created = None, False
+                if passing_score_percentage != quiz['passing_score_percentage']:
+                    regrade_job_id, regrade_job_created = enqueue_regrade(cursor, quiz_id, reason="Passing score changed")
                 conn.commit()
+                if regrade_job_created:
+                    start_regrade_worker(regrade_job_id)
                 flash("Quiz updated successfully!", "success")
                 return redirect(url_for('teacher_quizzes_list_page'))
             except Error as e:
@@ -1197,9 +1601,6 @@ def edit_quiz_page(quiz_id):
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on edit_quiz_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/edit_quiz.html', quiz=quiz, teacher_videos=teacher_videos, submitted_data=submitted_data)
 
@@ -1207,19 +1608,22 @@ def edit_quiz_page(quiz_id):
 @teacher_required
 def delete_quiz_page(quiz_id):
     user_id = session.get('user_id')
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Could not delete quiz.", "danger")
             return redirect(url_for('teacher_quizzes_list_page'))
         
-        cursor = conn.cursor()
+        cursor = get_db_cursor(dictionary=False)
+        cursor.execute("SELECT COUNT(*) FROM questions WHERE quiz_id = %s", (quiz_id,))
+        deleted_questions_count = cursor.fetchone()[0]
         cursor.execute("DELETE FROM quizzes WHERE id = %s AND teacher_id = %s", (quiz_id, user_id))
+        quiz_deleted = cursor.rowcount > 0
+        if quiz_deleted:
+            bump_teacher_stats(cursor, user_id, quizzes=-1, questions=-deleted_questions_count)
         conn.commit()
 
-        if cursor.rowcount > 0:
+        if quiz_deleted:
             flash("Quiz and all associated data deleted successfully!", "success")
         else:
             flash("Quiz not found or you don't have permission to delete it.", "danger")
@@ -1231,9 +1635,6 @@ def delete_quiz_page(quiz_id):
         conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"Unexpected error deleting quiz {quiz_id} for user {user_id}: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
     return redirect(url_for('teacher_quizzes_list_page'))
 
 @app.route('/teacher/quiz/<int:quiz_id>/add_question', methods=['GET', 'POST'])
@@ -1242,16 +1643,13 @@ def add_question_to_quiz_page(quiz_id):
     user_id = session.get('user_id')
     quiz = None
     existing_questions = []
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('teacher_quizzes_list_page'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         
         cursor.execute("SELECT id, title FROM quizzes WHERE id = %s AND teacher_id = %s", (quiz_id, user_id))
         quiz = cursor.fetchone() 
@@ -1260,22 +1658,7 @@ def add_question_to_quiz_page(quiz_id):
             flash("Quiz not found or you don't have permission.", "danger")
             return redirect(url_for('teacher_quizzes_list_page'))
         
-        cursor.execute("""
-            SELECT q.id, q.question_text, q.points, q.question_type,
-                   GROUP_CONCAT(c.choice_text ORDER BY c.id ASC) AS choices_text_concat,
-                   GROUP_CONCAT(c.is_correct ORDER BY c.id ASC) AS is_correct_concat
-            FROM questions q
-            LEFT JOIN choices c ON q.id = c.question_id
-            WHERE q.quiz_id = %s
-            GROUP BY q.id
-            ORDER BY q.display_order ASC
-        """, (quiz_id,))
-        
-        raw_questions = cursor.fetchall()
-        for q in raw_questions:
-            q['choices_text'] = q['choices_text_concat'].split(',') if q['choices_text_concat'] else []
-            q['is_correct_list'] = [bool(int(x)) for x in q['is_correct_concat'].split(',')] if q['is_correct_concat'] else []
-            existing_questions.append(q)
+        existing_questions = load_quiz_questions(cursor, quiz_id)
 
         if request.method == 'POST':
             question_text = request.form.get('question_text', '').strip()
@@ -1325,9 +1708,11 @@ def add_question_to_quiz_page(quiz_id):
                             INSERT INTO choices (question_id, choice_text, is_correct)
                             VALUES (%s, %s, %s)
                         """, (question_id, choice_text, is_correct))
+                bump_teacher_stats(cursor, user_id, questions=1)
+                bump_quiz_version(cursor, quiz_id)
                 conn.commit()
                 flash("Question added successfully!", "success")
-                return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz.id))
+                return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz_id))
             except Error as e:
                 conn.rollback()
                 if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error adding question to quiz {quiz_id} for user {user_id}: {e}", exc_info=True)
@@ -1343,9 +1728,6 @@ def add_question_to_quiz_page(quiz_id):
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on add_question_to_quiz_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/add_question_to_quiz.html', quiz=quiz, existing_questions=existing_questions)
 
@@ -1358,16 +1740,13 @@ def edit_question_page(quiz_id, question_id):
     choices = []
     submitted_question_text = None
     submitted_points = None
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('teacher_quizzes_list_page'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         
         cursor.execute("SELECT id, title FROM quizzes WHERE id = %s AND teacher_id = %s", (quiz_id, user_id))
         quiz = cursor.fetchone() 
@@ -1379,7 +1758,7 @@ def edit_question_page(quiz_id, question_id):
         question = cursor.fetchone() 
         if not question:
             flash("Question not found in this quiz.", "danger")
-            return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz.id))
+            return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz_id))
         
         cursor.execute("SELECT id, choice_text, is_correct FROM choices WHERE question_id = %s ORDER BY id ASC", (question_id,))
         choices = cursor.fetchall()
@@ -1396,10 +1775,10 @@ def edit_question_page(quiz_id, question_id):
 
             validation_errors = []
             if not submitted_question_text: validation_errors.append("Question text is required.")
-            if question.question_type == 'mc' and sum(1 for ct in submitted_choices_texts if ct) < 2: 
+            if question['question_type'] == 'mc' and sum(1 for ct in submitted_choices_texts if ct) < 2: 
                 validation_errors.append("At least two choices are required for an MCQ.")
             
-            if question.question_type == 'mc':
+            if question['question_type'] == 'mc':
                 if correct_choice_index is None: 
                     validation_errors.append("A correct answer must be selected.")
                 elif not (0 <= int(correct_choice_index) < len(submitted_choices_texts) and submitted_choices_texts[int(correct_choice_index)]):
@@ -1419,26 +1798,46 @@ def edit_question_page(quiz_id, question_id):
                                        submitted_points=submitted_points,
                                        lang_code=session.get('current_lang', 'en'))
 
+            regrade_job_id, regrade_job_created = None, False
             try:
                 cursor.execute("""
                     UPDATE questions SET
-                    question_text = %s, points = %s, updated_at = CURRENT_TIMESTAMP
+                    question_text = %s, points = %s
                     WHERE id = %s
                 """, (submitted_question_text, submitted_points, question_id))
+                grading_changed = submitted_points != question['points']
 
-                if question.question_type == 'mc':
-                    cursor.execute("DELETE FROM choices WHERE question_id = %s", (question_id,))
-                    
-                    for i, choice_text in enumerate(choices_texts):
-                        if choice_text: 
-                            is_correct = (i == int(correct_choice_index))
+                if question['question_type'] == 'mc':
+                    # Slot i of the form edits the i-th existing choice (both ordered by id), so choice ids
+                    # and students' selected_choice_id references survive the edit.
+                    for i, choice_text in enumerate(submitted_choices_texts):
+                        is_correct = (i == int(correct_choice_index))
+                        existing_choice = choices[i] if i < len(choices) else None
+                        if existing_choice and choice_text:
+                            if choice_text != existing_choice['choice_text'] or is_correct != bool(existing_choice['is_correct']):
+                                cursor.execute("UPDATE choices SET choice_text = %s, is_correct = %s WHERE id = %s",
+                                               (choice_text, is_correct, existing_choice['id']))
+                                grading_changed = grading_changed or is_correct != bool(existing_choice['is_correct'])
+                        elif existing_choice:
+                            cursor.execute("DELETE FROM choices WHERE id = %s", (existing_choice['id'],))
+                            grading_changed = grading_changed or bool(existing_choice['is_correct'])
+                        elif choice_text:
                             cursor.execute("""
                                 INSERT INTO choices (question_id, choice_text, is_correct)
                                 VALUES (%s, %s, %s)
                             """, (question_id, choice_text, is_correct))
+                            grading_changed = grading_changed or is_correct
+                bump_quiz_version(cursor, quiz_id)
+                if grading_changed:
+                    regrade_job_id, regrade_job_created = enqueue_regrade(cursor, quiz_id, reason=f"Question {question_id} edited")
                 conn.commit()
-                flash("Question updated successfully!", "success")
-                return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz.id))
+                if regrade_job_id:
+                    if regrade_job_created:
+                        start_regrade_worker(regrade_job_id)
+                    flash("Question updated successfully! Existing attempts are being re-graded in the background.", "success")
+                else:
+                    flash("Question updated successfully!", "success")
+                return redirect(url_for('add_question_to_quiz_page', quiz_id=quiz_id))
             except Error as e:
                 conn.rollback()
                 if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error updating question {question_id} for quiz {quiz_id}: {e}", exc_info=True)
@@ -1454,9 +1853,6 @@ def edit_question_page(quiz_id, question_id):
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on edit_question_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/edit_question.html',
                            quiz=quiz,
@@ -1470,16 +1866,13 @@ def edit_teacher_profile():
     user_id = session.get('user_id')
     teacher_profile_data = {}
     current_profile_pic_url = None
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('teacher_dashboard_placeholder'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         if request.method == 'POST':
             first_name = request.form.get('first_name', '').strip()
@@ -1505,14 +1898,13 @@ def edit_teacher_profile():
             if len(bio) > 1000: validation_errors.append("Bio cannot exceed 1000 characters.")
 
             new_profile_pic_path = None
+            new_profile_pic_thumbs = None
             if profile_picture_file and profile_picture_file.filename != '':
                 if allowed_file(profile_picture_file.filename, ALLOWED_EXTENSIONS_IMAGES):
-                    filename = secure_filename(profile_picture_file.filename)
-                    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                    upload_path = os.path.join(app.config['UPLOAD_FOLDER_PROFILE_PICS'], unique_filename)
                     try:
-                        profile_picture_file.save(upload_path)
-                        new_profile_pic_path = os.path.join('uploads', 'profile_pics', unique_filename)
+                        new_profile_pic_path, new_profile_pic_thumbs = store_avatar(cursor, profile_picture_file.stream, media_storage)
+                    except InvalidImageError:
+                        validation_errors.append("The profile picture could not be read as an image.")
                     except Exception as e:
                         if hasattr(app, 'logger') and app.logger: app.logger.error(f"Failed to save profile picture for user {user_id}: {e}", exc_info=True)
                         validation_errors.append("Failed to save profile picture.")
@@ -1527,11 +1919,12 @@ def edit_teacher_profile():
 
             if validation_errors:
                 for error_message in validation_errors: flash(error_message, "danger")
-                if new_profile_pic_path and os.path.exists(os.path.join('static', new_profile_pic_path)):
-                    os.remove(os.path.join('static', new_profile_pic_path))
+                conn.rollback()
+                if new_profile_pic_path:
+                    discard_unregistered(conn, media_storage, new_profile_pic_path, derived_keys=derivative_keys)
                 return render_template('teacher/edit_profile.html', form_data=form_data, teacher_id_for_preview=user_id)
             
-            cursor.execute("SELECT profile_picture_url FROM users WHERE id = %s", (user_id,))
+            cursor.execute("SELECT profile_picture_url, username FROM users WHERE id = %s", (user_id,))
             old_profile_pic_result = cursor.fetchone() 
             old_profile_pic_url = old_profile_pic_result['profile_picture_url'] if old_profile_pic_result else None
 
@@ -1544,20 +1937,27 @@ def edit_teacher_profile():
             update_params = [first_name, last_name, phone_number if phone_number else None, country if country else None, bio if bio else None]
 
             if new_profile_pic_path:
-                update_sql += ", profile_picture_url = %s"
-                update_params.append(new_profile_pic_path)
+                update_sql += ", profile_picture_url = %s, profile_picture_thumbs = %s"
+                update_params.extend([new_profile_pic_path, new_profile_pic_thumbs])
             
             update_sql += " WHERE id = %s"
             update_params.append(user_id)
             
             cursor.execute(update_sql, tuple(update_params))
+            refresh_search_text(cursor, user_id)
+            released_blob = release_media(cursor, old_profile_pic_url) if new_profile_pic_path and old_profile_pic_url else None
             conn.commit()
+            invalidate_user_profile_cache(user_id)
+            if old_profile_pic_result:
+                teacher_name_index.upsert(user_id, first_name, last_name, old_profile_pic_result['username'])
 
             session['username'] = first_name
             session['phone_number_session'] = phone_number
 
-            if new_profile_pic_path and old_profile_pic_url and os.path.basename(old_profile_pic_url) != 'default_profile.png':
-                old_path_full = os.path.join(app.root_path, 'static', old_profile_pic_url)
+            if released_blob:
+                delete_if_unreferenced(conn, media_storage, released_blob, derived_keys=derivative_keys)
+            elif new_profile_pic_path and old_profile_pic_url and not is_media_path(old_profile_pic_url) and os.path.basename(old_profile_pic_url) != 'default_profile.png':
+                old_path_full = os.path.join(STATIC_ROOT, old_profile_pic_url)
                 if os.path.exists(old_path_full):
                     try:
                         os.remove(old_path_full)
@@ -1586,9 +1986,6 @@ def edit_teacher_profile():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on edit_teacher_profile: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('teacher/edit_profile.html', form_data=teacher_profile_data, current_profile_pic_url=current_profile_pic_url, teacher_id_for_preview=user_id)
 
@@ -1604,13 +2001,10 @@ def student_dashboard_placeholder():
     latest_quiz_attempts = []
     available_videos = []
     available_quizzes = []
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
+            cursor = get_db_cursor()
 
             cursor.execute("""
                 SELECT swv.video_id, v.title AS video_title, v.thumbnail_path_or_url,
@@ -1635,44 +2029,26 @@ def student_dashboard_placeholder():
             """, (user_id,))
             latest_quiz_attempts = cursor.fetchall()
 
-            cursor.execute("""
-                SELECT DISTINCT v.id, v.title, v.description, v.thumbnail_path_or_url,
+            subscribed_teacher_ids = sorted(entitlements.teacher_ids(cursor, user_id))
+            subscribed_filter = f" OR v.teacher_id IN ({', '.join(['%s'] * len(subscribed_teacher_ids))})" if subscribed_teacher_ids else ""
+            cursor.execute(f"""
+                SELECT v.id, v.title, v.description, v.thumbnail_path_or_url,
                        u.first_name AS teacher_first_name, u.last_name AS teacher_last_name,
                        CASE WHEN swv.video_id IS NOT NULL THEN TRUE ELSE FALSE END AS is_watched
                 FROM videos v
                 JOIN users u ON v.teacher_id = u.id
                 LEFT JOIN student_watched_videos swv ON v.id = swv.video_id AND swv.student_id = %s
-                LEFT JOIN student_subscriptions ss ON v.teacher_id = ss.teacher_id AND ss.student_id = %s AND ss.status = 'active'
-                WHERE v.status = 'published' AND (v.is_viewable_free_for_student = TRUE OR ss.student_id IS NOT NULL)
+                WHERE v.status = 'published' AND (v.is_viewable_free_for_student = TRUE{subscribed_filter})
                 ORDER BY v.upload_timestamp DESC
                 LIMIT 6
-            """, (user_id, user_id))
+            """, (user_id, *subscribed_teacher_ids))
             available_videos = cursor.fetchall()
 
-            cursor.execute("""
-                SELECT DISTINCT q.id, q.title, q.description, q.time_limit_minutes, q.passing_score_percentage,
-                       u.first_name AS teacher_first_name, u.last_name AS teacher_last_name,
-                       (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id) AS question_count,
-                       (SELECT qa2.score FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_score,
-                       (SELECT qa2.max_possible_score FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_max_score,
-                       (SELECT qa2.passed FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_passed,
-                       (SELECT qa2.submitted_at FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_date,
-                       (SELECT qa2.id FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_id
-                FROM quizzes q
-                JOIN users u ON q.teacher_id = u.id
-                LEFT JOIN student_subscriptions ss ON q.teacher_id = ss.teacher_id AND ss.student_id = %s AND ss.status = 'active'
-                WHERE q.is_active = TRUE AND ss.student_id IS NOT NULL
-                ORDER BY q.created_at DESC
-                LIMIT 6
-            """, (user_id, user_id, user_id, user_id, user_id, user_id)) 
-            available_quizzes = cursor.fetchall()
+            available_quizzes = load_available_quizzes(cursor, user_id, subscribed_teacher_ids, limit=6)
 
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error fetching student dashboard data for user {user_id}: {e}", exc_info=True)
         flash("Could not load some dashboard information.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/dashboard.html',
                            username=username,
@@ -1687,16 +2063,13 @@ def student_profile_page():
     user_id = session.get('user_id')
     student_profile = None
     student_subscriptions = []
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         
         cursor.execute("SELECT first_name, last_name, email, phone_number, country, profile_picture_url, wallet_balance FROM users WHERE id = %s AND role = 'student'", (user_id,))
         student_profile = cursor.fetchone() 
@@ -1720,9 +2093,6 @@ def student_profile_page():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on student_profile_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/student_profile.html',
                            student_profile=student_profile,
@@ -1735,16 +2105,13 @@ def edit_student_profile():
     user_id = session.get('user_id')
     student_profile_data = {}
     current_profile_pic_url = None
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_profile_page'))
 
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         if request.method == 'POST':
             first_name = request.form.get('first_name', '').strip()
@@ -1767,14 +2134,13 @@ def edit_student_profile():
             if phone_number and not is_valid_phone_format_simple(phone_number): validation_errors.append("Phone number format is invalid.")
 
             new_profile_pic_path = None
+            new_profile_pic_thumbs = None
             if profile_picture_file and profile_picture_file.filename != '':
                 if allowed_file(profile_picture_file.filename, ALLOWED_EXTENSIONS_IMAGES):
-                    filename = secure_filename(profile_picture_file.filename)
-                    unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                    upload_path = os.path.join(app.config['UPLOAD_FOLDER_PROFILE_PICS'], unique_filename)
                     try:
-                        profile_picture_file.save(upload_path)
-                        new_profile_pic_path = os.path.join('uploads', 'profile_pics', unique_filename)
+                        new_profile_pic_path, new_profile_pic_thumbs = store_avatar(cursor, profile_picture_file.stream, media_storage)
+                    except InvalidImageError:
+                        validation_errors.append("The profile picture could not be read as an image.")
                     except Exception as e:
                         if hasattr(app, 'logger') and app.logger: app.logger.error(f"Failed to save profile picture for user {user_id}: {e}", exc_info=True)
                         validation_errors.append("Failed to save profile picture.")
@@ -1789,8 +2155,9 @@ def edit_student_profile():
 
             if validation_errors:
                 for error_message in validation_errors: flash(error_message, "danger")
-                if new_profile_pic_path and os.path.exists(os.path.join('static', new_profile_pic_path)):
-                    os.remove(os.path.join('static', new_profile_pic_path))
+                conn.rollback()
+                if new_profile_pic_path:
+                    discard_unregistered(conn, media_storage, new_profile_pic_path, derived_keys=derivative_keys)
                 return render_template('student/edit_profile.html', form_data=form_data)
 
             cursor.execute("SELECT profile_picture_url FROM users WHERE id = %s", (user_id,))
@@ -1805,20 +2172,24 @@ def edit_student_profile():
             update_params = [first_name, last_name, phone_number if phone_number else None, country if country else None]
 
             if new_profile_pic_path:
-                update_sql += ", profile_picture_url = %s"
-                update_params.append(new_profile_pic_path)
+                update_sql += ", profile_picture_url = %s, profile_picture_thumbs = %s"
+                update_params.extend([new_profile_pic_path, new_profile_pic_thumbs])
 
             update_sql += " WHERE id = %s"
             update_params.append(user_id)
 
             cursor.execute(update_sql, tuple(update_params))
+            released_blob = release_media(cursor, old_profile_pic_url) if new_profile_pic_path and old_profile_pic_url else None
             conn.commit()
+            invalidate_user_profile_cache(user_id)
 
             session['username'] = first_name
             session['phone_number_session'] = phone_number
 
-            if new_profile_pic_path and old_profile_pic_url and os.path.basename(old_profile_pic_url) != 'default_profile.png':
-                old_path_full = os.path.join(app.root_path, 'static', old_profile_pic_url)
+            if released_blob:
+                delete_if_unreferenced(conn, media_storage, released_blob, derived_keys=derivative_keys)
+            elif new_profile_pic_path and old_profile_pic_url and not is_media_path(old_profile_pic_url) and os.path.basename(old_profile_pic_url) != 'default_profile.png':
+                old_path_full = os.path.join(STATIC_ROOT, old_profile_pic_url)
                 if os.path.exists(old_path_full):
                     try:
                         os.remove(old_path_full)
@@ -1847,9 +2218,6 @@ def edit_student_profile():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on edit_student_profile: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/edit_profile.html', form_data=student_profile_data, current_profile_pic_url=current_profile_pic_url)
 
@@ -1859,16 +2227,13 @@ def edit_student_profile():
 def add_wallet_balance():
     user_id = session.get('user_id')
     current_balance = 0.00
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_profile_page'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
         cursor.execute("SELECT wallet_balance FROM users WHERE id = %s", (user_id,))
         user_wallet = cursor.fetchone() 
         if user_wallet:
@@ -1907,9 +2272,6 @@ def add_wallet_balance():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on add_wallet_balance: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
         
     return render_template('student/add_wallet_balance.html', current_balance=current_balance)
 
@@ -1919,20 +2281,17 @@ def student_view_video_page(video_id):
     user_id = session.get('user_id')
     video = None
     quizzes_for_video = []
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         cursor.execute("""
             SELECT v.id, v.title, v.description, v.video_path_or_url, v.teacher_id, v.is_viewable_free_for_student,
-                   u.first_name AS teacher_first_name, u.last_name AS teacher_last_name
+                   v.thumbnail_path_or_url, v.hls_manifest_path, u.first_name AS teacher_first_name, u.last_name AS teacher_last_name
             FROM videos v
             JOIN users u ON v.teacher_id = u.id
             WHERE v.id = %s AND v.status = 'published'
@@ -1943,25 +2302,15 @@ def student_view_video_page(video_id):
             flash("Video not found or is unavailable.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        is_subscribed_to_teacher = False
-        cursor.execute("""
-            SELECT id FROM student_subscriptions
-            WHERE student_id = %s AND teacher_id = %s AND status = 'active'
-        """, (user_id, video['teacher_id']))
-        _ = cursor.fetchone() 
-        if _:
-            is_subscribed_to_teacher = True
-
-        if not video['is_viewable_free_for_student'] and not is_subscribed_to_teacher:
+        if not entitlements.can_access(cursor, user_id, video['teacher_id'], video['is_viewable_free_for_student']):
             flash("Access Denied: This video is premium content. Please subscribe to the teacher.", "danger")
             return redirect(url_for('public_teacher_profile_page', teacher_id=video['teacher_id']))
 
-        cursor.execute("SELECT id FROM student_watched_videos WHERE student_id = %s AND video_id = %s", (user_id, video_id))
-        _ = cursor.fetchone() 
-        if not _:
-            cursor.execute("INSERT INTO student_watched_videos (student_id, video_id, teacher_id) VALUES (%s, %s, %s)", (user_id, video_id, video['teacher_id']))
-            cursor.execute("UPDATE videos SET views_count = views_count + 1 WHERE id = %s", (video_id,))
+        # uq_student_video_watch makes repeat visits a no-op; the view count itself is buffered
+        cursor.execute("INSERT IGNORE INTO student_watched_videos (student_id, video_id, teacher_id) VALUES (%s, %s, %s)", (user_id, video_id, video['teacher_id']))
+        if cursor.rowcount == 1:
             conn.commit()
+            view_counter.record(video_id, video['teacher_id'])
 
         cursor.execute("""
             SELECT q.id, q.title, q.description
@@ -1977,12 +2326,74 @@ def student_view_video_page(video_id):
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on student_view_video_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/student_view_video.html', video=video, quizzes=quizzes_for_video)
 
+def _load_streamable_video(video_id):
+    """Returns the video row if the current user may stream it; aborts with 404/403/503 otherwise."""
+    user_id = session.get('user_id')
+    try:
+        cursor = get_db_cursor()
+        cursor.execute("SELECT id, teacher_id, video_path_or_url, hls_manifest_path, is_viewable_free_for_student, status FROM videos WHERE id = %s", (video_id,))
+        video = cursor.fetchone()
+        if not video:
+            abort(404)
+        if session.get('role') == 'teacher':
+            has_access = video['teacher_id'] == user_id
+        else:
+            has_access = video['status'] == 'published' and entitlements.can_access(
+                cursor, user_id, video['teacher_id'], video['is_viewable_free_for_student'])
+    except Error as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"DB Error authorizing stream of video {video_id} for user {user_id}: {e}", exc_info=True)
+        abort(503)
+    if not has_access:
+        abort(403)
+    return video
+
+def _send_upload_file(video_id, relative_path):
+    """Streams the stored object at relative_path, refusing anything outside the uploads folder.
+
+    With object storage the browser is redirected to a short-lived presigned URL, except for HLS
+    playlists: those are proxied so their relative segment URIs keep resolving against this app."""
+    if not media_storage.is_local:
+        if not relative_path.startswith(MEDIA_KEY_PREFIX) or not media_storage.exists(relative_path):
+            if hasattr(app, 'logger') and app.logger: app.logger.warning(f"STREAM: Object for video {video_id} is missing: {relative_path}")
+            abort(404)
+        if relative_path.endswith('.m3u8'):
+            response = app.response_class(media_storage.get_bytes(relative_path), mimetype='application/vnd.apple.mpegurl')
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return redirect(media_storage.presign(relative_path))
+
+    uploads_root = os.path.join(app.root_path, UPLOAD_FOLDER_BASE)
+    file_path = safe_join(STATIC_ROOT, relative_path)
+    if file_path is None or not file_path.startswith(uploads_root + os.sep) or not os.path.isfile(file_path):
+        if hasattr(app, 'logger') and app.logger: app.logger.warning(f"STREAM: File for video {video_id} is missing: {relative_path}")
+        abort(404)
+    return send_video(file_path, os.path.relpath(file_path, uploads_root))
+
+@app.route('/videos/<int:video_id>/stream')
+@login_required
+def stream_video(video_id):
+    """Streams the original upload with HTTP Range support to its owner or to students allowed to watch it."""
+    video = _load_streamable_video(video_id)
+    return _send_upload_file(video_id, video['video_path_or_url'])
+
+@app.route('/videos/<int:video_id>/hls/<path:asset>')
+@login_required
+def stream_video_hls(video_id, asset):
+    """Serves the HLS master playlist, rendition playlists and segments under the same access rules.
+
+    Playlists reference their children by relative path, so every request the player makes lands here."""
+    video = _load_streamable_video(video_id)
+    if not video['hls_manifest_path']:
+        abort(404)
+    hls_dir = video['hls_manifest_path'].rsplit('/', 1)[0]
+    asset_path = safe_join(hls_dir, asset)  # Keep '..' from reaching another video's renditions
+    if asset_path is None:
+        abort(404)
+    return _send_upload_file(video_id, asset_path)
+
 @app.route('/student/take_quiz/<int:quiz_id>', methods=['GET', 'POST'])
 @student_required
 def student_take_quiz_page(quiz_id):
@@ -1990,20 +2401,17 @@ def student_take_quiz_page(quiz_id):
     quiz = None
     questions = []
     attempt = None
-    
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         cursor.execute("""
             SELECT qz.id, qz.title, qz.description, qz.time_limit_minutes, qz.passing_score_percentage, qz.allow_answer_review, qz.teacher_id,
-                   u.first_name AS teacher_first_name, u.last_name AS teacher_last_name
+                   qz.content_version, u.first_name AS teacher_first_name, u.last_name AS teacher_last_name
             FROM quizzes qz
             JOIN users u ON qz.teacher_id = u.id
             WHERE qz.id = %s AND qz.is_active = TRUE
@@ -2014,16 +2422,7 @@ def student_take_quiz_page(quiz_id):
             flash("Quiz not found or is inactive.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        is_subscribed_to_teacher = False
-        cursor.execute("""
-            SELECT id FROM student_subscriptions
-            WHERE student_id = %s AND teacher_id = %s AND status = 'active'
-        """, (user_id, quiz['teacher_id']))
-        _ = cursor.fetchone() 
-        if _:
-            is_subscribed_to_teacher = True
-        
-        if not is_subscribed_to_teacher:
+        if not entitlements.is_subscribed(cursor, user_id, quiz['teacher_id']):
             flash("Access Denied: This quiz is premium content. Please subscribe to the teacher.", "danger")
             return redirect(url_for('public_teacher_profile_page', teacher_id=quiz['teacher_id']))
 
@@ -2044,102 +2443,52 @@ def student_take_quiz_page(quiz_id):
                 attempt_id = cursor.lastrowid
                 attempt = {'id': attempt_id, 'start_time': datetime.utcnow(), 'time_taken_seconds': 0}
             
-            cursor.execute("""
-                SELECT q.id AS question_id, q.question_text, q.question_type, q.points,
-                       GROUP_CONCAT(c.id ORDER BY c.id ASC) AS choice_ids,
-                       GROUP_CONCAT(c.choice_text ORDER BY c.id ASC) AS choice_texts
-                FROM questions q
-                LEFT JOIN choices c ON q.id = c.question_id
-                WHERE q.quiz_id = %s
-                GROUP BY q.id
-                ORDER BY q.display_order ASC
-            """, (quiz_id,))
-            
-            raw_questions = cursor.fetchall()
-            for q_row in raw_questions:
-                if q_row['question_type'] == 'mc':
-                    choices_list = []
-                    if q_row['choice_ids'] and q_row['choice_texts']:
-                        ids = [int(x) for x in q_row['choice_ids'].split(',')]
-                        texts = q_row['choice_texts'].split(',')
-                        for i in range(len(ids)):
-                            choices_list.append({'id': ids[i], 'choice_text': texts[i]})
-                    q_row['choices'] = choices_list
-                questions.append(q_row)
+            snapshot = get_quiz_snapshot(cursor, quiz_id, quiz['content_version'])
+            if snapshot:
+                questions = list(snapshot.questions)
 
         elif request.method == 'POST':
             if not attempt:
                 flash("No active quiz attempt found. Please start the quiz again.", "danger")
-                return redirect(url_for('student_take_quiz_page', quiz_id=quiz.id))
+                return redirect(url_for('student_take_quiz_page', quiz_id=quiz['id']))
 
-            total_score = 0
-            max_possible_score = 0
-            
-            cursor.execute("""
-                SELECT q.id AS question_id, q.question_type, q.points, c.id AS choice_id, c.is_correct
-                FROM questions q
-                LEFT JOIN choices c ON q.id = c.question_id
-                WHERE q.quiz_id = %s
-            """, (quiz_id,))
-            quiz_questions_data = cursor.fetchall()
-            
-            questions_map = {}
-            for q_data in quiz_questions_data:
-                q_id = q_data['question_id']
-                if q_id not in questions_map:
-                    questions_map[q_id] = {'points': q_data['points'], 'type': q_data['question_type'], 'choices': {}}
-                if q_data['choice_id']:
-                    questions_map[q_id]['choices'][q_data['choice_id']] = q_data['is_correct']
+            snapshot = get_quiz_snapshot(cursor, quiz_id, quiz['content_version'])
+            if snapshot is None:
+                flash("Quiz not found or is inactive.", "danger")
+                return redirect(url_for('student_dashboard_placeholder'))
 
-            cursor.execute("DELETE FROM student_answers WHERE attempt_id = %s", (attempt['id'],))
-            
+            submitted_answers = {}
             for question_id_str in request.form:
                 if question_id_str.startswith('question_'):
                     q_id = int(question_id_str.replace('question_', ''))
-                    
-                    if q_id not in questions_map:
-                        if hasattr(app, 'logger') and app.logger: app.logger.warning(f"Attempting to answer non-existent question {q_id} for quiz {quiz_id}.")
-                        continue
-
-                    question_info = questions_map[q_id]
-                    max_possible_score += question_info['points']
-
-                    if question_info['type'] == 'mc':
-                        selected_choice_id = request.form.get(question_id_str)
-                        if selected_choice_id:
-                            selected_choice_id = int(selected_choice_id)
-                            is_mc_correct = question_info['choices'].get(selected_choice_id, False)
-                            points_awarded = question_info['points'] if is_mc_correct else 0
-                            total_score += points_awarded
-                            
-                            cursor.execute("""
-                                INSERT INTO student_answers (attempt_id, question_id, selected_choice_id, is_mc_correct, points_awarded)
-                                VALUES (%s, %s, %s, %s, %s)
-                            """, (attempt['id'], q_id, selected_choice_id, is_mc_correct, points_awarded))
-                        else:
-                            cursor.execute("""
-                                INSERT INTO student_answers (attempt_id, question_id, selected_choice_id, is_mc_correct, points_awarded)
-                                VALUES (%s, %s, NULL, FALSE, 0)
-                            """, (attempt['id'], q_id))
-                    elif question_info['type'] == 'essay':
-                        essay_answer_text = request.form.get(question_id_str, '').strip()
-                        cursor.execute("""
-                            INSERT INTO student_answers (attempt_id, question_id, essay_answer_text, points_awarded)
-                            VALUES (%s, %s, %s, 0)
-                        """, (attempt['id'], q_id, essay_answer_text if essay_answer_text else None))
+                    answer_value = request.form.get(question_id_str, '').strip()
+                    question_info = snapshot.questions_by_id.get(q_id)
+                    if question_info is not None and question_info.question_type == 'mc':
+                        answer_value = int(answer_value) if answer_value else None
+                    submitted_answers[q_id] = answer_value
+
+            grade = grade_submission(snapshot, submitted_answers)
+            for unknown_question_id in grade.unknown_question_ids:
+                if hasattr(app, 'logger') and app.logger: app.logger.warning(f"Attempting to answer non-existent question {unknown_question_id} for quiz {quiz_id}.")
+            answer_rows = [(attempt['id'], r.question_id, r.selected_choice_id, r.essay_answer_text, r.is_mc_correct, r.points_awarded)
+                           for r in grade.results]
 
             time_taken_seconds = (datetime.utcnow() - attempt['start_time']).total_seconds() if attempt['start_time'] else None
-            
-            passed = (total_score >= (max_possible_score * (quiz['passing_score_percentage'] / 100))) if max_possible_score > 0 else False
-            if max_possible_score == 0 and total_score == 0: passed = True
 
+            # Everything is graded in memory above; the transaction below is just three statements.
+            cursor.execute("DELETE FROM student_answers WHERE attempt_id = %s", (attempt['id'],))
+            if answer_rows:
+                cursor.executemany("""
+                    INSERT INTO student_answers (attempt_id, question_id, selected_choice_id, essay_answer_text, is_mc_correct, points_awarded)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, answer_rows)  # Sent as one multi-row INSERT by the driver
             cursor.execute("""
                 UPDATE quiz_attempts SET
                 end_time = %s, score = %s, max_possible_score = %s, time_taken_seconds = %s,
                 submitted_at = %s, is_completed = TRUE, passed = %s
                 WHERE id = %s
-            """, (datetime.utcnow(), total_score, max_possible_score, time_taken_seconds,
-                  datetime.utcnow(), passed, attempt['id']))
+            """, (datetime.utcnow(), grade.score, grade.max_possible_score, time_taken_seconds,
+                  datetime.utcnow(), grade.passed, attempt['id']))
             conn.commit()
 
             flash("Quiz submitted successfully! See your results below.", "success")
@@ -2153,9 +2502,6 @@ def student_take_quiz_page(quiz_id):
         conn.rollback()
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on student_take_quiz_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/student_take_quiz.html', quiz=quiz, questions=questions, attempt=attempt)
 
@@ -2166,16 +2512,13 @@ def student_quiz_result_page(attempt_id):
     user_id = session.get('user_id')
     attempt = None
     answers_data = []
-
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn is None:
             flash("Database connection error. Please try again later.", "danger")
             return redirect(url_for('student_dashboard_placeholder'))
         
-        cursor = conn.cursor(dictionary=True)
+        cursor = get_db_cursor()
 
         cursor.execute("""
             SELECT qa.id, qa.quiz_id, qa.score, qa.max_possible_score, qa.submitted_at, qa.passed, qa.time_taken_seconds,
@@ -2212,9 +2555,6 @@ def student_quiz_result_page(attempt_id):
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"General error on student_quiz_result_page: {e}", exc_info=True)
         flash("An unexpected error occurred. Please try again.", "danger")
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
     return render_template('student/student_quiz_result.html', attempt=attempt, answers_data=answers_data)
 
@@ -2227,6 +2567,19 @@ def switch_lang(lang_code):
     return redirect(request.referrer or url_for('home'))
 
 # --- API Endpoints (for JS dashboard stats animation) ---
+@app.route('/api/teachers/suggest')
+def api_teacher_suggest():
+    """Autocomplete for the explore page, answered from the in-memory name index."""
+    prefix = request.args.get('prefix', '').strip()[:100]
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    teacher_name_index.ensure_fresh()
+    suggestions = [
+        {'id': teacher_id, 'name': name, 'username': username,
+         'profile_url': url_for('public_teacher_profile_page', teacher_id=teacher_id)}
+        for teacher_id, name, username in teacher_name_index.suggest(prefix, limit)
+    ]
+    return jsonify({'prefix': prefix, 'suggestions': suggestions})
+
 @app.route('/api/teacher/dashboard_stats')
 @teacher_required
 def api_teacher_dashboard_stats():
@@ -2237,28 +2590,17 @@ def api_teacher_dashboard_stats():
         'quizzes_count': 0,
         'questions_count': 0
     }
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
+        conn = get_db()
         if conn:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT COUNT(*) AS count FROM student_subscriptions WHERE teacher_id = %s AND status = 'active'", (user_id,))
-            stats['subscribers'] = cursor.fetchone()['count']
-
-            cursor.execute("SELECT SUM(views_count) AS total FROM videos WHERE teacher_id = %s", (user_id,))
-            total_views_result = cursor.fetchone()['total']
-            stats['total_views'] = total_views_result if total_views_result is not None else 0
-
-            cursor.execute("SELECT COUNT(*) AS count FROM quizzes WHERE teacher_id = %s", (user_id,))
-            stats['quizzes_count'] = cursor.fetchone()['count']
-
-            cursor.execute("""
-                SELECT COUNT(q.id) AS count FROM questions q
-                JOIN quizzes quiz ON q.quiz_id = quiz.id
-                WHERE quiz.teacher_id = %s
-            """, (user_id,))
-            stats['questions_count'] = cursor.fetchone()['count']
+            counters = get_teacher_stats(get_db_cursor(), user_id)
+            conn.commit()
+            stats = {
+                'subscribers': counters['subscribers_count'],
+                'total_views': counters['total_views'],
+                'quizzes_count': counters['quizzes_count'],
+                'questions_count': counters['questions_count']
+            }
 
     except Error as e:
         if hasattr(app, 'logger') and app.logger: app.logger.error(f"API_ERROR: DB Error fetching teacher dashboard stats for user {user_id}: {e}", exc_info=True)
@@ -2266,11 +2608,181 @@ def api_teacher_dashboard_stats():
     except Exception as e:
         if hasattr(app, 'logger') and app.logger: app.logger.critical(f"API_ERROR: Unexpected error fetching teacher dashboard stats for user {user_id}: {e}", exc_info=True)
         return jsonify({'error': 'Unexpected server error'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
     return jsonify(stats)
 
+@app.route('/api/teacher/regrade_jobs/<int:job_id>')
+@teacher_required
+def api_regrade_job_status(job_id):
+    user_id = session.get('user_id')
+    try:
+        cursor = get_db_cursor()
+        job = get_regrade_job(cursor, job_id)
+        if job:
+            cursor.execute("SELECT teacher_id FROM quizzes WHERE id = %s", (job['quiz_id'],))
+            quiz_owner = cursor.fetchone()
+            if not quiz_owner or quiz_owner['teacher_id'] != user_id:
+                job = None
+        if not job:
+            return jsonify({'error': 'Regrade job not found'}), 404
+    except Error as e:
+        if hasattr(app, 'logger') and app.logger: app.logger.error(f"API_ERROR: DB Error fetching regrade job {job_id}: {e}", exc_info=True)
+        return jsonify({'error': 'Database error fetching regrade job'}), 500
+    return jsonify({
+        'id': job['id'], 'quiz_id': job['quiz_id'], 'status': job['status'],
+        'total_attempts': job['total_attempts'], 'processed_attempts': job['processed_attempts'],
+        'error_message': job['error_message']
+    })
+
+
+# --- 12. Maintenance Commands (run from cron via `flask <command>`) ---
+@app.cli.command('reconcile-teacher-stats')
+def reconcile_teacher_stats_command():
+    """Recomputes every teacher_stats row from the source tables to correct counter drift."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("TEACHER_STATS_RECONCILE: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        teachers_processed, rows_affected = reconcile_all_teacher_stats(conn, logger=app.logger)
+        app.logger.info(f"TEACHER_STATS_RECONCILE: Done. Teachers: {teachers_processed}, rows affected: {rows_affected}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"TEACHER_STATS_RECONCILE_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('run-regrade-jobs')
+def run_regrade_jobs_command():
+    """Runs pending regrade jobs and resumes ones whose worker stopped renewing its lease."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("REGRADE: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        jobs_processed = run_pending_regrade_jobs(conn, chunk_size=REGRADE_CHUNK_SIZE,
+                                                  lease_seconds=REGRADE_LEASE_SECONDS, logger=app.logger)
+        app.logger.info(f"REGRADE: Done. Jobs processed: {jobs_processed}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"REGRADE_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('purge-stale-uploads')
+def purge_stale_uploads_command():
+    """Deletes chunked uploads abandoned for more than UPLOAD_SESSION_MAX_AGE_HOURS and their partial files."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("UPLOAD_PURGE: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        purged = purge_stale_upload_sessions(conn, (media_storage.temp_dir(), app.config['UPLOAD_FOLDER_VIDEOS']),
+                                             max_age_hours=int(os.getenv('UPLOAD_SESSION_MAX_AGE_HOURS', '48')), logger=app.logger)
+        app.logger.info(f"UPLOAD_PURGE: Done. Sessions purged: {purged}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"UPLOAD_PURGE_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('run-transcode-jobs')
+def run_transcode_jobs_command():
+    """Transcodes pending uploads to HLS and resumes jobs interrupted by a restart."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("TRANSCODE: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        published, failed = run_pending_transcode_jobs(conn, media_storage, logger=app.logger)
+        app.logger.info(f"TRANSCODE: Done. Published: {published}, failed: {failed}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"TRANSCODE_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('flush-view-counts')
+def flush_view_counts_command():
+    """Applies buffered view counts left on disk by workers that have exited."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("VIEW_COUNTER: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        applied = recover_orphaned_logs(conn, VIEW_COUNTER_DIR)
+        app.logger.info(f"VIEW_COUNTER: Done. Views applied: {applied}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"VIEW_COUNTER_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('gc-media')
+def gc_media_command():
+    """Deletes media blobs that no video or profile references any more."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("MEDIA_GC: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        collect_unreferenced_blobs(conn, media_storage, derived_keys=derivative_keys, logger=app.logger)
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"MEDIA_GC_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('expire-subscriptions')
+def expire_subscriptions_command():
+    """Marks active subscriptions past their expiry_date as expired and drops the students' cached entitlements.
+
+    The invalidation only reaches web workers with CACHE_BACKEND=redis; the in-process cache of a
+    worker is separate from this CLI process. Access is not affected either way, because a cached
+    entry never outlives the earliest expiry_date it was built from."""
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("SUBSCRIPTION_SWEEP: Cannot connect to MySQL. Aborting.")
+        return
+    def invalidate_students(student_ids):
+        for student_id in student_ids:
+            entitlements.invalidate(student_id)
+    try:
+        run_id, expired = run_expiry_sweep(conn, chunk_size=int(os.getenv('SUBSCRIPTION_SWEEP_CHUNK_SIZE', '500')),
+                                           on_expired=invalidate_students, logger=app.logger)
+        app.logger.info(f"SUBSCRIPTION_SWEEP: Done. Run {run_id}, subscriptions expired: {expired}.")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"SUBSCRIPTION_SWEEP_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
+@app.cli.command('close-earnings-period')
+@click.option('--year', type=int, default=None, help='Defaults to the previous month.')
+@click.option('--month', type=int, default=None)
+def close_earnings_period_command(year, month):
+    """Creates teacher earnings and pending payouts for a finished month (safe to re-run)."""
+    if year is None or month is None:
+        last_month_end = datetime.now().replace(day=1) - timedelta(days=1)
+        year, month = last_month_end.year, last_month_end.month
+    conn = get_db_connection()
+    if conn is None:
+        app.logger.critical("EARNINGS_CLOSE: Cannot connect to MySQL. Aborting.")
+        return
+    try:
+        result = close_earnings_period(conn, year, month, os.getenv('PLATFORM_COMMISSION_PERCENTAGE', '20.00'),
+                                       chunk_size=int(os.getenv('EARNINGS_CLOSE_CHUNK_SIZE', '5000')), logger=app.logger)
+        if result is None:
+            app.logger.info(f"EARNINGS_CLOSE: {year}-{month:02d} is already closed.")
+        else:
+            app.logger.info(f"EARNINGS_CLOSE: Done. {year}-{month:02d}: earnings created: {result[0]}, payouts created: {result[1]}.")
+    except ValueError as e:
+        app.logger.error(f"EARNINGS_CLOSE: {e}")
+    except Error as e:
+        conn.rollback()
+        app.logger.error(f"EARNINGS_CLOSE_DB_ERROR: {e}", exc_info=True)
+    finally:
+        conn.close()
+
 
 # --- 13. Application Runner and Logger Setup ---
 if __name__ == '__main__':
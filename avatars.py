@@ -0,0 +1,94 @@
+# avatars.py
+"""Profile picture processing: EXIF-free originals plus fixed-size WebP/JPEG derivatives.
+
+store_avatar() decodes the upload once with Pillow, applies and then drops the EXIF orientation
+(along with GPS and camera metadata), stores a bounded original through the media store, and
+renders square 64/128/256 px derivatives in WebP with a JPEG fallback next to it. Derivative keys
+are derived from the original's content-addressed key, so identical uploads share them and they
+are deleted together with the original. Pillow is required: storing an upload unprocessed would
+publish its GPS and camera metadata."""
+
+import json
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+from media_store import store_file
+
+AVATAR_SIZES = (64, 128, 256)
+AVATAR_FORMATS = ('webp', 'jpeg')
+ORIGINAL_MAX_SIDE = 1024
+_SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+}
+_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+class InvalidImageError(ValueError):
+    """Raised when the upload cannot be decoded as an image."""
+
+
+def derivative_key(original_key, size, image_format):
+    """uploads/media/ab/cd/<hash>.png -> uploads/media/ab/cd/<hash>_128.webp"""
+    return f"{os.path.splitext(original_key)[0]}_{size}.{_EXTENSIONS[image_format]}"
+
+
+def derivative_keys(original_key):
+    return [derivative_key(original_key, size, image_format) for size in AVATAR_SIZES for image_format in AVATAR_FORMATS]
+
+
+def _flatten(image):
+    """RGB for formats without alpha, compositing transparent pixels onto white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _save_temp(image, storage, image_format):
+    handle, temp_path = tempfile.mkstemp(dir=storage.temp_dir(), suffix='.' + _EXTENSIONS[image_format])
+    os.close(handle)
+    image.save(temp_path, **_SAVE_OPTIONS[image_format])  # No exif= argument: metadata is not written
+    return temp_path
+
+
+def store_avatar(cursor, stream, storage):
+    """Stores a profile picture. Returns (original key, derivatives JSON).
+
+    The derivatives JSON maps size to {format: key} and goes in users.profile_picture_thumbs."""
+    try:
+        with Image.open(stream) as uploaded:
+            uploaded.load()
+            image = _flatten(ImageOps.exif_transpose(uploaded))
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(f"Could not read the image: {e}") from e
+
+    image.thumbnail((ORIGINAL_MAX_SIDE, ORIGINAL_MAX_SIDE), Image.LANCZOS)
+    original_key = store_file(cursor, _save_temp(image, storage, 'jpeg'), storage, 'jpg')
+
+    thumbs = {}
+    for size in AVATAR_SIZES:
+        square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        thumbs[str(size)] = {}
+        for image_format in AVATAR_FORMATS:
+            key = derivative_key(original_key, size, image_format)
+            if not storage.exists(key):  # Already rendered for an identical upload
+                storage.put_file(_save_temp(square, storage, image_format), key)
+            thumbs[str(size)][image_format] = key
+    return original_key, json.dumps(thumbs)
+
+
+def avatar_thumb_key(thumbs, size, image_format='jpeg'):
+    """Key of the smallest derivative at least `size` px, or None if the user has none."""
+    if not thumbs:
+        return None
+    if isinstance(thumbs, (str, bytes)):
+        thumbs = json.loads(thumbs)
+    for available in AVATAR_SIZES:
+        if available >= size and str(available) in thumbs:
+            return thumbs[str(available)].get(image_format)
+    return None
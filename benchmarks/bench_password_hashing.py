@@ -0,0 +1,53 @@
+# benchmarks/bench_password_hashing.py
+"""Reports login (password verify) throughput per hash method: inline on one core and through
+the PasswordHasher process pool, as logins/sec and logins/sec per core.
+
+No database is needed: python benchmarks/bench_password_hashing.py
+BENCH_METHODS lists Werkzeug method strings to compare (default: the configured method and the
+pbkdf2 default); BENCH_LOGINS is the number of verifies per measurement."""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hashing import DEFAULT_METHOD, PasswordHasher  # noqa: E402
+
+METHODS = [m for m in os.getenv('BENCH_METHODS', f"{os.getenv('PASSWORD_HASH_METHOD', DEFAULT_METHOD)},pbkdf2:sha256:600000").split(',') if m]
+LOGINS = int(os.getenv('BENCH_LOGINS', '200'))
+WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+PASSWORD = 'correct horse battery staple'
+
+
+def measure(hasher, password_hash, concurrency):
+    """Runs LOGINS verifies from `concurrency` request threads; returns logins/sec."""
+    with ThreadPoolExecutor(max_workers=concurrency) as request_threads:
+        started = time.perf_counter()
+        results = list(request_threads.map(lambda _: hasher.verify(password_hash, PASSWORD), range(LOGINS)))
+        elapsed = time.perf_counter() - started
+    if not all(results):
+        print("WARNING: a verify returned False.")
+    return LOGINS / elapsed
+
+
+def main():
+    print(f"{LOGINS} logins per run, pool of {WORKERS} processes on {os.cpu_count()} CPUs.")
+    print(f"{'method':<28} {'inline/s':>10} {'pool/s':>10} {'pool/s/core':>12}")
+    for method in METHODS:
+        inline = PasswordHasher(method=method, workers=0)
+        password_hash = inline.hash(PASSWORD)
+        inline_rate = measure(inline, password_hash, concurrency=1)
+
+        pooled = PasswordHasher(method=method, workers=WORKERS)
+        pooled.warm()
+        try:
+            pool_rate = measure(pooled, password_hash, concurrency=WORKERS * 2)
+        finally:
+            pooled.shutdown()
+        print(f"{method:<28} {inline_rate:10.1f} {pool_rate:10.1f} {pool_rate / WORKERS:12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# benchmarks/bench_quiz_submit.py
+"""Times persisting a graded submission: one INSERT per answer versus one executemany batch.
+
+Seeds a quiz with the largest question count in BENCH_QUESTION_COUNTS plus one attempt in the
+database configured by the usual DB_* variables, then reports submit latency per question count
+and deletes the seed rows. Run against a scratch database: python benchmarks/bench_quiz_submit.py"""
+
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import get_db_connection  # noqa: E402
+
+QUESTION_COUNTS = [int(n) for n in os.getenv('BENCH_QUESTION_COUNTS', '10,50,100,200').split(',')]
+REPEAT = int(os.getenv('BENCH_REPEAT', '20'))
+
+INSERT_ANSWER_SQL = """
+    INSERT INTO student_answers (attempt_id, question_id, selected_choice_id, essay_answer_text, is_mc_correct, points_awarded)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+
+def seed(cursor, question_count):
+    tag = uuid.uuid4().hex[:8]
+    user_ids = []
+    for role in ('teacher', 'student'):
+        cursor.execute("INSERT INTO users (username, email, password_hash, role) VALUES (%s, %s, 'x', %s)",
+                       (f"bench_{role}_{tag}", f"bench_{role}_{tag}@example.invalid", role))
+        user_ids.append(cursor.lastrowid)
+    teacher_id, student_id = user_ids
+    cursor.execute("INSERT INTO quizzes (teacher_id, title) VALUES (%s, 'Bench submit quiz')", (teacher_id,))
+    quiz_id = cursor.lastrowid
+    question_ids = []
+    for i in range(question_count):
+        cursor.execute("INSERT INTO questions (quiz_id, question_text, display_order) VALUES (%s, %s, %s)", (quiz_id, f"Q{i}", i))
+        question_ids.append(cursor.lastrowid)
+    cursor.execute("INSERT INTO quiz_attempts (student_id, quiz_id) VALUES (%s, %s)", (student_id, quiz_id))
+    return (teacher_id, student_id), cursor.lastrowid, question_ids
+
+
+def submit(conn, cursor, attempt_id, answer_rows, batched):
+    cursor.execute("DELETE FROM student_answers WHERE attempt_id = %s", (attempt_id,))
+    if batched:
+        cursor.executemany(INSERT_ANSWER_SQL, answer_rows)
+    else:
+        for row in answer_rows:
+            cursor.execute(INSERT_ANSWER_SQL, row)
+    cursor.execute("UPDATE quiz_attempts SET submitted_at = %s, is_completed = TRUE WHERE id = %s", (datetime.utcnow(), attempt_id))
+    conn.commit()
+
+
+def main():
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit("Cannot connect to MySQL; check DB_* environment variables.")
+    cursor = conn.cursor()
+    user_ids = None
+    try:
+        user_ids, attempt_id, question_ids = seed(cursor, max(QUESTION_COUNTS))
+        conn.commit()
+        print(f"{'questions':>9} {'per-row ms':>11} {'batched ms':>11} {'speedup':>8}")
+        for question_count in QUESTION_COUNTS:
+            answer_rows = [(attempt_id, question_id, None, None, False, 0) for question_id in question_ids[:question_count]]
+            timings = []
+            for batched in (False, True):
+                submit(conn, cursor, attempt_id, answer_rows, batched)  # Warm-up
+                started = time.perf_counter()
+                for _ in range(REPEAT):
+                    submit(conn, cursor, attempt_id, answer_rows, batched)
+                timings.append((time.perf_counter() - started) * 1000 / REPEAT)
+            print(f"{question_count:>9} {timings[0]:>11.2f} {timings[1]:>11.2f} {timings[0] / timings[1]:>7.1f}x")
+    finally:
+        if user_ids is not None:
+            cursor.execute("DELETE FROM users WHERE id IN (%s, %s)", user_ids)
+            conn.commit()
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
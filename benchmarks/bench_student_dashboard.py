@@ -0,0 +1,109 @@
+# benchmarks/bench_student_dashboard.py
+"""Compares the old correlated-subquery quiz loader with load_available_quizzes().
+
+Seeds one student with ATTEMPTS_PER_STUDENT attempts spread over QUIZ_COUNT quizzes in the
+database configured by the usual DB_* variables, times both loaders, then deletes the seed rows.
+Run against a scratch database: python benchmarks/bench_student_dashboard.py"""
+
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import get_db_connection  # noqa: E402
+from student_dashboard import load_available_quizzes  # noqa: E402
+
+QUIZ_COUNT = int(os.getenv('BENCH_QUIZ_COUNT', '50'))
+ATTEMPTS_PER_STUDENT = int(os.getenv('BENCH_ATTEMPTS_PER_STUDENT', '10000'))
+REPEAT = int(os.getenv('BENCH_REPEAT', '20'))
+
+LEGACY_SQL = """
+    SELECT DISTINCT q.id, q.title, q.description, q.time_limit_minutes, q.passing_score_percentage,
+           u.first_name AS teacher_first_name, u.last_name AS teacher_last_name,
+           (SELECT COUNT(*) FROM questions WHERE quiz_id = q.id) AS question_count,
+           (SELECT qa2.score FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_score,
+           (SELECT qa2.max_possible_score FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_max_score,
+           (SELECT qa2.passed FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_passed,
+           (SELECT qa2.submitted_at FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_date,
+           (SELECT qa2.id FROM quiz_attempts qa2 WHERE qa2.quiz_id = q.id AND qa2.student_id = %s ORDER BY qa2.submitted_at DESC LIMIT 1) AS last_attempt_id
+    FROM quizzes q
+    JOIN users u ON q.teacher_id = u.id
+    LEFT JOIN student_subscriptions ss ON q.teacher_id = ss.teacher_id AND ss.student_id = %s AND ss.status = 'active'
+    WHERE q.is_active = TRUE AND ss.student_id IS NOT NULL
+    ORDER BY q.created_at DESC
+    LIMIT 6
+"""
+
+
+def seed(cursor):
+    tag = uuid.uuid4().hex[:8]
+    user_ids = []
+    for role in ('teacher', 'student'):
+        cursor.execute("INSERT INTO users (username, email, password_hash, role, first_name) VALUES (%s, %s, 'x', %s, %s)",
+                       (f"bench_{role}_{tag}", f"bench_{role}_{tag}@example.invalid", role, f"Bench{role.title()}"))
+        user_ids.append(cursor.lastrowid)
+    teacher_id, student_id = user_ids
+    cursor.execute("INSERT INTO student_subscriptions (student_id, teacher_id, status) VALUES (%s, %s, 'active')", (student_id, teacher_id))
+
+    quiz_ids = []
+    for i in range(QUIZ_COUNT):
+        cursor.execute("INSERT INTO quizzes (teacher_id, title) VALUES (%s, %s)", (teacher_id, f"Bench quiz {i}"))
+        quiz_ids.append(cursor.lastrowid)
+        cursor.executemany("INSERT INTO questions (quiz_id, question_text) VALUES (%s, %s)",
+                           [(quiz_ids[-1], f"Q{j}") for j in range(10)])
+
+    started = datetime.utcnow() - timedelta(days=365)
+    attempt_rows = [(student_id, random.choice(quiz_ids), random.randint(0, 10), 10,
+                     started + timedelta(minutes=n), True, random.random() > 0.5)
+                    for n in range(ATTEMPTS_PER_STUDENT)]
+    for offset in range(0, len(attempt_rows), 1000):
+        cursor.executemany("""
+            INSERT INTO quiz_attempts (student_id, quiz_id, score, max_possible_score, submitted_at, is_completed, passed)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, attempt_rows[offset:offset + 1000])
+    return teacher_id, student_id
+
+
+def time_loader(label, load):
+    load()  # Warm the buffer pool so both loaders are measured hot
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        rows = load()
+    elapsed_ms = (time.perf_counter() - started) * 1000 / REPEAT
+    print(f"{label:<28} {elapsed_ms:9.2f} ms/page  ({len(rows)} quizzes)")
+    return rows
+
+
+def main():
+    conn = get_db_connection()
+    if conn is None:
+        sys.exit("Cannot connect to MySQL; check DB_* environment variables.")
+    cursor = conn.cursor(dictionary=True, buffered=True)
+    teacher_id = student_id = None
+    try:
+        teacher_id, student_id = seed(cursor)
+        conn.commit()
+        print(f"Seeded {ATTEMPTS_PER_STUDENT} attempts over {QUIZ_COUNT} quizzes for student {student_id}.")
+
+        def legacy():
+            cursor.execute(LEGACY_SQL, (student_id,) * 6)
+            return cursor.fetchall()
+
+        legacy_rows = time_loader("correlated subqueries", legacy)
+        window_rows = time_loader("ROW_NUMBER() loader", lambda: load_available_quizzes(cursor, student_id, [teacher_id]))
+        if [r['last_attempt_id'] for r in legacy_rows] != [r['last_attempt_id'] for r in window_rows]:
+            print("WARNING: loaders disagree on the latest attempt per quiz.")
+    finally:
+        if teacher_id is not None:
+            cursor.execute("DELETE FROM users WHERE id IN (%s, %s)", (teacher_id, student_id))
+            conn.commit()
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# cache.py
+"""Small key/value caches with TTL: an in-process LRU by default, Redis when configured."""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+    from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+    _REDIS_UNAVAILABLE = (RedisConnectionError, RedisTimeoutError)
+except ImportError:  # Optional dependency, only needed for CACHE_BACKEND=redis
+    redis = None
+    _REDIS_UNAVAILABLE = ()
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache:
+    """Shared cache for multi-worker deployments; values are stored as JSON under a namespace.
+
+    The cache is never the source of truth, so a Redis outage or timeout is logged and treated as
+    a miss (get) or a no-op (set/delete) instead of failing the request."""
+
+    def __init__(self, client, namespace, ttl=300):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def _log_unavailable(self, operation, error):
+        logger.warning(f"CACHE: Redis unavailable during {operation} on '{self.namespace}': {error}")
+
+    def get(self, key, default=None):
+        try:
+            raw = self.client.get(self._key(key))
+        except _REDIS_UNAVAILABLE as e:
+            self._log_unavailable('get', e)
+            return default
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        payload = json.dumps(value, default=str)
+        try:
+            if ttl:
+                self.client.set(self._key(key), payload, ex=max(1, int(ttl)))
+            else:
+                self.client.set(self._key(key), payload)
+        except _REDIS_UNAVAILABLE as e:
+            self._log_unavailable('set', e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self._key(key))
+        except _REDIS_UNAVAILABLE as e:
+            self._log_unavailable('delete', e)
+
+    def clear(self):
+        try:
+            for redis_key in self.client.scan_iter(match=f"{self.namespace}:*"):
+                self.client.delete(redis_key)
+        except _REDIS_UNAVAILABLE as e:
+            self._log_unavailable('clear', e)
+
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Returns the shared Redis client for CACHE_REDIS_URL, or None when Redis is unavailable."""
+    global _redis_client
+    if redis is None:
+        return None
+    if _redis_client is None:
+        with _redis_client_lock:
+            if _redis_client is None:
+                _redis_client = redis.Redis.from_url(os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    return _redis_client
+
+
+def create_cache(namespace, maxsize=1024, ttl=300):
+    """Builds a cache for `namespace` using the backend selected by CACHE_BACKEND ('memory' or 'redis')."""
+    backend = os.getenv('CACHE_BACKEND', 'memory').lower()
+    if backend == 'redis':
+        client = get_redis_client()
+        if client is not None:
+            return RedisCache(client, f"ektbariny:{namespace}", ttl=ttl)
+        logger.warning(f"CACHE: CACHE_BACKEND=redis but the 'redis' package is not installed; "
+                       f"using in-process cache for '{namespace}'.")
+    return LRUCache(maxsize=maxsize, ttl=ttl)
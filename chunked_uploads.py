@@ -0,0 +1,100 @@
+# chunked_uploads.py
+"""Resumable chunked uploads: init, PUT chunk at offset, finalize.
+
+Each chunk is streamed from the request body straight into `<final name>.part` (kept in the media
+store's scratch directory, outside the static folder) with pwrite at its
+offset, hashing as it goes, so memory stays bounded by CHUNK_READ_SIZE and there is no temp-file
+spool or second copy. Finalize hands the completed file to the media store, which moves it into
+place; the upload's progress lives in the `upload_sessions` table so any worker can accept the
+next chunk."""
+
+import hashlib
+import hmac
+import os
+import re
+import uuid
+
+CHUNK_READ_SIZE = 1024 * 1024
+PART_SUFFIX = '.part'
+_SHA256_HEX = re.compile(r'^[0-9a-fA-F]{64}$')
+
+
+class ChunkChecksumError(ValueError):
+    """Raised when a chunk's SHA-256 does not match the digest the client sent."""
+
+
+def create_upload_session(cursor, teacher_id, stored_filename, total_size, title, description, is_viewable_free):
+    """Records a new upload session and returns its id."""
+    upload_id = uuid.uuid4().hex
+    cursor.execute("""
+        INSERT INTO upload_sessions (id, teacher_id, stored_filename, total_size, title, description, is_viewable_free)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, (upload_id, teacher_id, stored_filename, total_size, title, description, is_viewable_free))
+    return upload_id
+
+
+def is_sha256_hex(value):
+    """True if value looks like a hex SHA-256 digest (the X-Chunk-SHA256 header format)."""
+    return bool(value) and _SHA256_HEX.match(value) is not None
+
+
+def get_upload_session(cursor, upload_id, teacher_id, for_update=False):
+    """Returns the teacher's upload session as a dict, or None. for_update locks the row."""
+    cursor.execute(f"""
+        SELECT id, teacher_id, stored_filename, total_size, received_bytes, title, description, is_viewable_free, status
+        FROM upload_sessions WHERE id = %s AND teacher_id = %s{' FOR UPDATE' if for_update else ''}
+    """, (upload_id, teacher_id))
+    return cursor.fetchone()
+
+
+def write_chunk(part_path, offset, stream, length, expected_sha256):
+    """Writes `length` bytes from `stream` into part_path at `offset`. Returns the chunk's hex SHA-256.
+
+    Raises ChunkChecksumError if the data does not match expected_sha256, and EOFError if the
+    stream ends early; in both cases the caller must not advance the session's received_bytes,
+    so the client simply re-sends the same chunk."""
+    digest = hashlib.sha256()
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        written = 0
+        while written < length:
+            block = stream.read(min(CHUNK_READ_SIZE, length - written))
+            if not block:
+                raise EOFError(f"Chunk ended after {written} of {length} bytes.")
+            digest.update(block)
+            view = memoryview(block)
+            while view:
+                count = os.pwrite(fd, view, offset + written)
+                view = view[count:]
+                written += count
+    finally:
+        os.close(fd)
+    chunk_sha256 = digest.hexdigest()
+    if not hmac.compare_digest(chunk_sha256, expected_sha256.lower()):
+        raise ChunkChecksumError(f"Chunk checksum mismatch at offset {offset}.")
+    return chunk_sha256
+
+
+def purge_stale_upload_sessions(conn, upload_folders, max_age_hours=48, logger=None):
+    """Deletes unfinished sessions idle for more than max_age_hours together with their .part files,
+    looked up in each of upload_folders."""
+    cursor = conn.cursor(buffered=True)
+    purged = 0
+    try:
+        cursor.execute("""
+            SELECT id, stored_filename FROM upload_sessions
+            WHERE status = 'uploading' AND updated_at < NOW() - INTERVAL %s HOUR
+        """, (max_age_hours,))
+        for upload_id, stored_filename in cursor.fetchall():
+            for upload_folder in upload_folders:
+                part_path = os.path.join(upload_folder, stored_filename + PART_SUFFIX)
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            cursor.execute("DELETE FROM upload_sessions WHERE id = %s", (upload_id,))
+            conn.commit()
+            purged += 1
+            if logger:
+                logger.info(f"UPLOAD_PURGE: Removed stale upload session {upload_id}.")
+    finally:
+        cursor.close()
+    return purged
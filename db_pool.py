@@ -0,0 +1,202 @@
+# db_pool.py
+"""Thread-safe MySQL connection pool used by app.get_db_connection()."""
+
+import logging
+import os
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import InterfaceError, PoolError
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(PoolError):
+    """Raised when no connection could be checked out within the pool timeout."""
+
+
+class PooledConnection:
+    """Proxy around a raw connection; close() hands it back to the pool instead of the socket."""
+
+    def __init__(self, pool, raw_conn, created_at):
+        self._pool = pool
+        self._raw_conn = raw_conn
+        self._created_at = created_at
+        self._returned = False
+
+    def __getattr__(self, name):
+        if self._returned:
+            # The raw connection may already be checked out by another request
+            raise InterfaceError(msg=f"Pooled connection used after close() (attribute '{name}').")
+        return getattr(self._raw_conn, name)
+
+    def is_connected(self):
+        # A checked-out handle counts as connected until it is returned, so callers'
+        # `if conn.is_connected(): conn.close()` always releases the slot; dead sockets
+        # are detected by the pool on release and on the next checkout.
+        return not self._returned
+
+    def close(self):
+        if self._returned:
+            return
+        self._returned = True
+        self._pool._release(self._raw_conn, self._created_at)
+
+
+class ConnectionPool:
+    """Fixed-size pool with bounded overflow, pre-ping health checks, recycling and wait metrics."""
+
+    def __init__(self, connect_params, pool_size=5, max_overflow=10, timeout=5.0,
+                 recycle_seconds=1800, pre_ping=True):
+        self.connect_params = dict(connect_params)
+        self.pool_size = max(1, int(pool_size))
+        self.max_overflow = max(0, int(max_overflow))
+        self.timeout = float(timeout)
+        self.recycle_seconds = int(recycle_seconds)
+        self.pre_ping = pre_ping
+
+        self._idle = []  # LIFO stack of (raw_conn, created_at); guarded by _lock
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)  # Notified whenever a connection goes idle or is closed
+        self._open_count = 0
+        self._checked_out = 0
+        self._metrics = {
+            'checkouts': 0, 'connects': 0, 'recycled': 0, 'ping_failures': 0,
+            'timeouts': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+        }
+
+    # --- Public API ---
+    def acquire(self):
+        """Checks out a healthy connection, waiting up to `timeout` seconds when the pool is saturated."""
+        wait_started = time.monotonic()
+        raw_conn, created_at = self._checkout_slot(wait_started)
+        try:
+            raw_conn, created_at = self._ensure_healthy(raw_conn, created_at)
+        except Error:
+            with self._lock:
+                self._open_count -= 1
+                self._checked_out -= 1
+                self._slot_freed.notify()
+            raise
+
+        waited = time.monotonic() - wait_started
+        with self._lock:
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_seconds_total'] += waited
+            if waited > self._metrics['wait_seconds_max']:
+                self._metrics['wait_seconds_max'] = waited
+        return PooledConnection(self, raw_conn, created_at)
+
+    def stats(self):
+        """Returns a snapshot of pool occupancy and checkout/wait counters."""
+        with self._lock:
+            snapshot = dict(self._metrics)
+            snapshot.update({
+                'pool_size': self.pool_size, 'max_overflow': self.max_overflow,
+                'open': self._open_count, 'checked_out': self._checked_out,
+                'idle': len(self._idle),
+            })
+        checkouts = snapshot['checkouts']
+        snapshot['wait_seconds_avg'] = (snapshot['wait_seconds_total'] / checkouts) if checkouts else 0.0
+        return snapshot
+
+    def dispose(self):
+        """Closes every idle connection; checked-out connections are closed when returned."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self._slot_freed.notify_all()
+        for raw_conn, _ in idle:
+            self._close_quietly(raw_conn)
+
+    # --- Internals ---
+    def _checkout_slot(self, wait_started):
+        deadline = wait_started + self.timeout
+        with self._slot_freed:
+            while True:
+                if self._idle:
+                    self._checked_out += 1
+                    return self._idle.pop()
+                if self._open_count < self.pool_size + self.max_overflow:
+                    self._open_count += 1
+                    self._checked_out += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics['timeouts'] += 1
+                    raise PoolExhaustedError(
+                        msg=(f"MySQL connection pool saturated: {self._checked_out}/{self._open_count} connections "
+                             f"in use (pool_size={self.pool_size}, max_overflow={self.max_overflow}); "
+                             f"no connection freed within {self.timeout:.1f}s."))
+                self._slot_freed.wait(remaining)
+        try:
+            return self._connect(), time.monotonic()
+        except Error:
+            with self._lock:
+                self._open_count -= 1
+                self._checked_out -= 1
+                self._slot_freed.notify()
+            raise
+
+    def _ensure_healthy(self, raw_conn, created_at):
+        if self.recycle_seconds > 0 and time.monotonic() - created_at > self.recycle_seconds:
+            self._close_quietly(raw_conn)
+            with self._lock:
+                self._metrics['recycled'] += 1
+            return self._connect(), time.monotonic()
+        if self.pre_ping:
+            try:
+                raw_conn.ping(reconnect=False)
+            except Error:
+                self._close_quietly(raw_conn)
+                with self._lock:
+                    self._metrics['ping_failures'] += 1
+                return self._connect(), time.monotonic()
+        return raw_conn, created_at
+
+    def _connect(self):
+        raw_conn = mysql.connector.connect(**self.connect_params)
+        with self._lock:
+            self._metrics['connects'] += 1
+        return raw_conn
+
+    def _release(self, raw_conn, created_at):
+        keep = False
+        try:
+            if raw_conn.is_connected():
+                raw_conn.rollback()  # Never hand out a connection with a half-finished transaction
+                keep = True
+        except Error as e:
+            logger.warning(f"DB_POOL: Discarding connection that failed to reset on release: {e}")
+
+        with self._lock:
+            self._checked_out -= 1
+            if keep and len(self._idle) >= self.pool_size:
+                keep = False  # Overflow connection: close it rather than grow the idle set
+            if keep:
+                self._idle.append((raw_conn, created_at))
+            else:
+                self._open_count -= 1  # Frees capacity for a waiter to open a new connection
+            self._slot_freed.notify()
+        if not keep:
+            self._close_quietly(raw_conn)
+
+    @staticmethod
+    def _close_quietly(raw_conn):
+        try:
+            raw_conn.close()
+        except Error:
+            pass
+
+
+def pool_settings_from_env():
+    """Reads DB_POOL_* environment variables into ConnectionPool keyword arguments."""
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', '10')),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT_SECONDS', '5')),
+        'recycle_seconds': int(os.getenv('DB_POOL_RECYCLE_SECONDS', '1800')),
+        'pre_ping': os.getenv('DB_POOL_PRE_PING', 'True').lower() in ('true', '1', 'yes'),
+    }
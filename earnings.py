@@ -0,0 +1,167 @@
+# earnings.py
+"""Month-end close: subscription payments -> teacher_earnings -> teacher_payouts.
+
+close_earnings_period() runs in two phases, each in committed chunks with its checkpoint stored in
+`earning_period_closes`, so an interrupted close resumes where it stopped.
+
+1. Earnings: paid subscriptions whose subscription_date falls in the month are read in keyset
+   order on (subscription_date, id). The commission and net amount are computed with Decimal
+   (cent rounding, half up), and the rows are inserted with INSERT IGNORE. Because
+   uq_earning_subscription allows one earnings row per subscription, a rerun creates nothing twice.
+2. Payouts: for each teacher, in keyset order on teacher_id, the pending_payout earnings of the
+   month are summed into one 'pending' teacher_payouts row. In the same transaction they are
+   marked included_in_payout with its payout_id, so an earnings row can never be paid twice."""
+
+import calendar
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+CENT = Decimal('0.01')
+# A subscription cancelled by an admin is treated as refunded and earns nothing
+EARNING_SUBSCRIPTION_STATUSES = ('active', 'expired', 'cancelled_by_student')
+
+
+def split_payment(amount, commission_percentage):
+    """Returns (platform commission, teacher net) in cents; the two always add up to amount."""
+    amount = Decimal(amount).quantize(CENT, rounding=ROUND_HALF_UP)
+    commission = (amount * Decimal(commission_percentage) / 100).quantize(CENT, rounding=ROUND_HALF_UP)
+    return commission, amount - commission
+
+
+def period_bounds(year, month):
+    """[first instant of the month, first instant of the next month)."""
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return datetime(year, month, 1), datetime(next_year, next_month, 1)
+
+
+def _create_earnings(conn, cursor, close_id, year, month, commission_percentage, chunk_size, logger):
+    cursor.execute("""
+        SELECT last_subscription_date, last_subscription_id, earnings_created FROM earning_period_closes WHERE id = %s
+    """, (close_id,))
+    last_date, last_id, created = cursor.fetchone()
+    start, end = period_bounds(year, month)
+    status_placeholders = ', '.join(['%s'] * len(EARNING_SUBSCRIPTION_STATUSES))
+    while True:
+        if last_date is None:
+            cursor.execute(f"""
+                SELECT id, teacher_id, amount_paid, subscription_date FROM student_subscriptions
+                WHERE subscription_date >= %s AND subscription_date < %s
+                  AND amount_paid > 0 AND status IN ({status_placeholders})
+                ORDER BY subscription_date ASC, id ASC LIMIT %s
+            """, (start, end) + EARNING_SUBSCRIPTION_STATUSES + (chunk_size,))
+        else:
+            cursor.execute(f"""
+                SELECT id, teacher_id, amount_paid, subscription_date FROM student_subscriptions
+                WHERE subscription_date >= %s AND subscription_date < %s
+                  AND (subscription_date > %s OR (subscription_date = %s AND id > %s))
+                  AND amount_paid > 0 AND status IN ({status_placeholders})
+                ORDER BY subscription_date ASC, id ASC LIMIT %s
+            """, (last_date, end, last_date, last_date, last_id) + EARNING_SUBSCRIPTION_STATUSES + (chunk_size,))
+        rows = cursor.fetchall()
+        if not rows:
+            return created
+        earning_rows = []
+        for subscription_id, teacher_id, amount_paid, _ in rows:
+            commission, net = split_payment(amount_paid, commission_percentage)
+            earning_rows.append((teacher_id, subscription_id, amount_paid, commission_percentage, commission, net, month, year))
+        cursor.executemany("""
+            INSERT IGNORE INTO teacher_earnings
+            (teacher_id, student_subscription_id, total_subscription_amount, platform_commission_percentage,
+             platform_commission_amount, teacher_net_earning, earning_month, earning_year)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, earning_rows)
+        created += cursor.rowcount
+        last_id, last_date = rows[-1][0], rows[-1][3]
+        cursor.execute("""
+            UPDATE earning_period_closes SET last_subscription_date = %s, last_subscription_id = %s, earnings_created = %s
+            WHERE id = %s
+        """, (last_date, last_id, created, close_id))
+        conn.commit()
+        if logger:
+            logger.info(f"EARNINGS_CLOSE: {year}-{month:02d}: {created} earnings rows created.")
+
+
+def _create_payouts(conn, cursor, close_id, year, month, chunk_size, logger):
+    cursor.execute("SELECT last_teacher_id, payouts_created FROM earning_period_closes WHERE id = %s", (close_id,))
+    last_teacher_id, created = cursor.fetchone()
+    period_start = date(year, month, 1)
+    period_end = date(year, month, calendar.monthrange(year, month)[1])
+    while True:
+        # Locks the summed rows so a concurrent close cannot include them in a second payout
+        cursor.execute("""
+            SELECT teacher_id, SUM(teacher_net_earning) FROM teacher_earnings
+            WHERE earning_year = %s AND earning_month = %s AND status = 'pending_payout' AND teacher_id > %s
+            GROUP BY teacher_id ORDER BY teacher_id ASC LIMIT %s
+            FOR UPDATE
+        """, (year, month, last_teacher_id, chunk_size))
+        totals = cursor.fetchall()
+        if not totals:
+            conn.commit()
+            return created
+        for teacher_id, total in totals:
+            total = Decimal(total).quantize(CENT, rounding=ROUND_HALF_UP)
+            if total <= 0:
+                continue
+            cursor.execute("""
+                INSERT INTO teacher_payouts (teacher_id, payout_amount, payout_period_start_date, payout_period_end_date)
+                VALUES (%s, %s, %s, %s)
+            """, (teacher_id, total, period_start, period_end))
+            payout_id = cursor.lastrowid
+            cursor.execute("""
+                UPDATE teacher_earnings SET status = 'included_in_payout', payout_id = %s
+                WHERE teacher_id = %s AND earning_year = %s AND earning_month = %s AND status = 'pending_payout'
+            """, (payout_id, teacher_id, year, month))
+            created += 1
+        last_teacher_id = totals[-1][0]
+        cursor.execute("""
+            UPDATE earning_period_closes SET last_teacher_id = %s, payouts_created = %s WHERE id = %s
+        """, (last_teacher_id, created, close_id))
+        conn.commit()
+        if logger:
+            logger.info(f"EARNINGS_CLOSE: {year}-{month:02d}: {created} payouts created.")
+
+
+def close_earnings_period(conn, year, month, commission_percentage, chunk_size=5000, logger=None):
+    """Creates the month's earnings and payouts, resuming an interrupted close.
+
+    Returns (earnings created, payouts created), or None if the month is already closed. A month
+    can only be closed once it has ended."""
+    if period_bounds(year, month)[1] > datetime.now():
+        raise ValueError(f"{year}-{month:02d} has not ended yet.")
+    commission_percentage = Decimal(commission_percentage).quantize(CENT)
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute("""
+            INSERT INTO earning_period_closes (earning_year, earning_month, commission_percentage) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+        """, (year, month, commission_percentage))
+        close_id = cursor.lastrowid
+        cursor.execute("SELECT status, commission_percentage FROM earning_period_closes WHERE id = %s", (close_id,))
+        status, commission_percentage = cursor.fetchone()  # A resumed close keeps its original rate
+        if status == 'completed':
+            conn.commit()
+            return None
+        cursor.execute("""
+            UPDATE earning_period_closes SET status = 'running', error_message = NULL, started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = %s
+        """, (close_id,))
+        conn.commit()
+
+        earnings_created = _create_earnings(conn, cursor, close_id, year, month, commission_percentage, chunk_size, logger)
+        payouts_created = _create_payouts(conn, cursor, close_id, year, month, max(1, chunk_size // 10), logger)
+
+        cursor.execute("""
+            UPDATE earning_period_closes SET status = 'completed', finished_at = CURRENT_TIMESTAMP WHERE id = %s
+        """, (close_id,))
+        conn.commit()
+        return earnings_created, payouts_created
+    except Exception as e:
+        conn.rollback()
+        cursor.execute("""
+            UPDATE earning_period_closes SET status = 'failed', error_message = %s
+            WHERE earning_year = %s AND earning_month = %s AND status <> 'completed'
+        """, (str(e)[:500], year, month))
+        conn.commit()
+        raise
+    finally:
+        cursor.close()
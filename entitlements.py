@@ -0,0 +1,70 @@
+# entitlements.py
+"""Which teachers' premium content a student may access, cached per student.
+
+A student's active, unexpired subscriptions are loaded with one indexed query into a frozenset of
+teacher ids. After that, every access check is a set-membership test, and lists of videos or
+quizzes are checked in one pass. A cache entry lives for at most the cache TTL and never past the
+earliest expiry_date among the subscriptions it holds, so a subscription stops granting access
+the moment it expires, even while its row still says 'active'. Write paths that change a student's subscriptions call
+invalidate(). With CACHE_BACKEND=redis that takes effect in every worker at once, including calls
+made from CLI commands. The in-process cache is private to each process: other workers see the
+change within the TTL, and invalidate() from a CLI command such as `flask expire-subscriptions`
+reaches none of them."""
+
+import time
+
+# Seconds left are computed by MySQL so the result does not depend on the session time zone
+ACTIVE_SUBSCRIPTIONS_SQL = """
+    SELECT teacher_id, TIMESTAMPDIFF(SECOND, NOW(), expiry_date) AS seconds_left FROM student_subscriptions
+    WHERE student_id = %s AND status = 'active' AND (expiry_date IS NULL OR expiry_date > NOW())
+"""
+
+
+class EntitlementService:
+    """Per-student subscription sets on top of a cache.py cache keyed by student id."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load(self, cursor, student_id):
+        cursor.execute(ACTIVE_SUBSCRIPTIONS_SQL, (student_id,))
+        teacher_ids = []
+        seconds_left = []
+        for row in cursor.fetchall():
+            teacher_id, seconds = (row['teacher_id'], row['seconds_left']) if isinstance(row, dict) else row
+            teacher_ids.append(teacher_id)
+            if seconds is not None:
+                seconds_left.append(seconds)
+        return {'teacher_ids': teacher_ids, 'valid_until': time.time() + min(seconds_left) if seconds_left else None}
+
+    def teacher_ids(self, cursor, student_id):
+        """frozenset of teacher ids the student is actively subscribed to."""
+        if not student_id:
+            return frozenset()
+        entry = self.cache.get(student_id)
+        if entry is None or (entry['valid_until'] is not None and entry['valid_until'] <= time.time()):
+            entry = self.load(cursor, student_id)
+            self.cache.set(student_id, entry)
+        return frozenset(entry['teacher_ids'])
+
+    def is_subscribed(self, cursor, student_id, teacher_id):
+        return teacher_id in self.teacher_ids(cursor, student_id)
+
+    def can_access(self, cursor, student_id, teacher_id, is_free=False):
+        """Free content is open to every student; everything else needs an active subscription."""
+        return bool(is_free) or self.is_subscribed(cursor, student_id, teacher_id)
+
+    def annotate_access(self, cursor, student_id, items, teacher_id=None, free_key='is_viewable_free_for_student'):
+        """Sets item['has_access'] on each row of a video/quiz list using one lookup.
+
+        Rows without a teacher_id column can pass the owning teacher_id instead. A falsy student_id
+        (anonymous visitors, teachers) grants free items only."""
+        subscribed = self.teacher_ids(cursor, student_id)
+        for item in items:
+            owner_id = item.get('teacher_id', teacher_id)
+            item['has_access'] = bool(item.get(free_key)) or owner_id in subscribed
+        return items
+
+    def invalidate(self, student_id):
+        """Call after committing any change to the student's subscriptions."""
+        self.cache.delete(student_id)
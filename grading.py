@@ -0,0 +1,112 @@
+# grading.py
+"""Quiz grading engine: scores submissions against a QuizSnapshot without touching the database.
+
+grade_submission() grades one submission; grade_attempts_batch() re-grades many stored attempts
+at once, comparing answers against the answer key with NumPy arrays when NumPy is installed."""
+
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # Optional dependency; grade_attempts_batch falls back to the per-attempt loop
+    np = None
+
+QuestionResult = namedtuple('QuestionResult', 'question_id selected_choice_id essay_answer_text is_mc_correct points_awarded')
+GradeResult = namedtuple('GradeResult', 'score max_possible_score passed results unknown_question_ids')
+
+# Sentinels in the batch selection matrix
+_NOT_ANSWERED = -2  # Question absent from the submission: counts towards neither score nor maximum
+_NO_CHOICE = -1     # Question present but no (valid) choice selected, or an essay
+
+
+def compute_passed(score, max_possible_score, passing_score_percentage):
+    """An empty quiz passes; otherwise the score must reach the passing percentage of the maximum."""
+    if max_possible_score > 0:
+        return score >= max_possible_score * (passing_score_percentage / 100)
+    return score == 0
+
+
+def grade_submission(snapshot, answers):
+    """Grades one submission.
+
+    `answers` maps question id to the submitted value: a choice id (or None) for MC questions,
+    the answer text for essays. Only questions present in `answers` count towards the maximum,
+    and ids not in the snapshot are reported in `unknown_question_ids` rather than graded."""
+    score = 0
+    max_possible_score = 0
+    results = []
+    unknown_question_ids = []
+    for question_id, value in answers.items():
+        question = snapshot.questions_by_id.get(question_id)
+        if question is None:
+            unknown_question_ids.append(question_id)
+            continue
+        max_possible_score += question.points
+        if question.question_type == 'mc':
+            if value is None:
+                results.append(QuestionResult(question_id, None, None, False, 0))
+                continue
+            is_mc_correct = value in snapshot.answer_key[question_id]
+            points_awarded = question.points if is_mc_correct else 0
+            score += points_awarded
+            results.append(QuestionResult(question_id, value, None, is_mc_correct, points_awarded))
+        elif question.question_type == 'essay':
+            results.append(QuestionResult(question_id, None, value or None, None, 0))
+    passed = compute_passed(score, max_possible_score, snapshot.passing_score_percentage)
+    return GradeResult(score, max_possible_score, passed, tuple(results), tuple(unknown_question_ids))
+
+
+def grade_attempts_batch(snapshot, attempts):
+    """Re-grades many stored attempts against one snapshot.
+
+    `attempts` maps attempt id to {question_id: selected_choice_id or None}, as stored in
+    student_answers. Returns {attempt_id: GradeResult}; essay text is not carried through."""
+    if np is None or not attempts:
+        return {attempt_id: grade_submission(snapshot, answers) for attempt_id, answers in attempts.items()}
+
+    questions = snapshot.questions
+    column_of = {question.id: column for column, question in enumerate(questions)}
+    choice_ids = [choice.id for question in questions for choice in question.choices]
+    choice_index = {choice_id: index for index, choice_id in enumerate(choice_ids)}
+    # Per choice: the column of the question it belongs to and whether it is correct
+    choice_column = np.array([column_of[q.id] for q in questions for _ in q.choices] or [0], dtype=np.int32)
+    choice_correct = np.array([c.is_correct for q in questions for c in q.choices] or [False], dtype=bool)
+    is_mc = np.array([q.question_type == 'mc' for q in questions], dtype=bool)
+    points = np.array([q.points for q in questions], dtype=np.int64)
+
+    attempt_ids = list(attempts)
+    selections = np.full((len(attempt_ids), len(questions)), _NOT_ANSWERED, dtype=np.int64)
+    unknown = {}
+    for row, attempt_id in enumerate(attempt_ids):
+        for question_id, selected_choice_id in attempts[attempt_id].items():
+            column = column_of.get(question_id)
+            if column is None:
+                unknown.setdefault(attempt_id, []).append(question_id)
+                continue
+            selections[row, column] = choice_index.get(selected_choice_id, _NO_CHOICE) if selected_choice_id is not None else _NO_CHOICE
+
+    answered = selections != _NOT_ANSWERED
+    picked = selections >= 0
+    safe_choice = np.where(picked, selections, 0)
+    # Correct only if the choice belongs to this question and is marked correct in the key
+    correct = picked & is_mc & choice_correct[safe_choice] & (choice_column[safe_choice] == np.arange(len(questions)))
+    awarded = np.where(correct, points, 0)
+    scores = awarded.sum(axis=1)
+    maxima = np.where(answered, points, 0).sum(axis=1)
+
+    graded = {}
+    for row, attempt_id in enumerate(attempt_ids):
+        score, max_possible_score = int(scores[row]), int(maxima[row])
+        results = []
+        for question_id in attempts[attempt_id]:
+            column = column_of.get(question_id)
+            if column is None:
+                continue
+            selected_choice_id = attempts[attempt_id][question_id]
+            if is_mc[column]:
+                results.append(QuestionResult(question_id, selected_choice_id, None, bool(correct[row, column]), int(awarded[row, column])))
+            else:
+                results.append(QuestionResult(question_id, None, None, None, 0))
+        passed = compute_passed(score, max_possible_score, snapshot.passing_score_percentage)
+        graded[attempt_id] = GradeResult(score, max_possible_score, passed, tuple(results), tuple(unknown.get(attempt_id, ())))
+    return graded
@@ -0,0 +1,176 @@
+# media_store.py
+"""Content-addressed, deduplicated storage for uploaded media.
+
+Files are keyed by the SHA-256 of their bytes (computed while streaming the upload to a temporary
+file) and live at `uploads/media/ab/cd/<hash>.<ext>` in the storage backend (see storage.py), so no directory grows past a few hundred
+entries and identical uploads share one copy. `media_blobs` counts the rows referencing each file.
+store_*() and release_media() run inside the caller's transaction; once the caller has committed,
+delete_if_unreferenced() removes a blob whose count dropped to zero. It re-checks the count under a
+row lock, so a concurrent upload of the same bytes either keeps the file alive or recreates it."""
+
+import hashlib
+import os
+import tempfile
+
+MEDIA_SUBDIR = 'media'
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def blob_relative_path(sha256_hex, extension, uploads_subdir='uploads'):
+    """Path of a blob relative to the static folder, e.g. uploads/media/ab/cd/abcd….mp4."""
+    suffix = f".{extension.lower()}" if extension else ''
+    return '/'.join([uploads_subdir, MEDIA_SUBDIR, sha256_hex[:2], sha256_hex[2:4], sha256_hex + suffix])
+
+
+def is_media_path(relative_path, uploads_subdir='uploads'):
+    return bool(relative_path) and relative_path.replace(os.sep, '/').startswith(f"{uploads_subdir}/{MEDIA_SUBDIR}/")
+
+
+def _spool_and_hash(stream, temp_path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(temp_path, 'wb') as temp_file:
+        while True:
+            block = stream.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            temp_file.write(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _temp_path(storage):
+    handle, temp_path = tempfile.mkstemp(dir=storage.temp_dir())
+    os.close(handle)
+    return temp_path
+
+
+def _register(cursor, storage, temp_path, sha256_hex, size, extension, uploads_subdir):
+    """Adds a reference to the blob, moving temp_path into place if the blob is new or its file is missing."""
+    relative_path = blob_relative_path(sha256_hex, extension, uploads_subdir)
+    cursor.execute("""
+        INSERT INTO media_blobs (sha256, relative_path, size_bytes, ref_count) VALUES (%s, %s, %s, 1)
+        ON DUPLICATE KEY UPDATE ref_count = ref_count + 1
+    """, (sha256_hex, relative_path, size))
+    inserted = cursor.rowcount == 1  # MySQL reports 2 when the duplicate-key branch updated a row
+    if not inserted:
+        cursor.execute("SELECT relative_path FROM media_blobs WHERE sha256 = %s", (sha256_hex,))
+        row = cursor.fetchone()
+        relative_path = row['relative_path'] if isinstance(row, dict) else row[0]
+    if inserted or not storage.exists(relative_path):
+        storage.put_file(temp_path, relative_path)
+    else:
+        os.remove(temp_path)
+    return relative_path
+
+
+def store_stream(cursor, stream, storage, extension, uploads_subdir='uploads'):
+    """Streams an upload into the store and returns its storage key (a static-relative path)."""
+    temp_path = _temp_path(storage)
+    try:
+        sha256_hex, size = _spool_and_hash(stream, temp_path)
+        return _register(cursor, storage, temp_path, sha256_hex, size, extension, uploads_subdir)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def store_file(cursor, source_path, storage, extension, uploads_subdir='uploads'):
+    """Moves an already-written local file (e.g. a finished chunked upload) into the store."""
+    sha256_hex = _hash_file(source_path)
+    size = os.path.getsize(source_path)
+    temp_path = source_path + '.storing'
+    os.replace(source_path, temp_path)
+    try:
+        return _register(cursor, storage, temp_path, sha256_hex, size, extension, uploads_subdir)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.replace(temp_path, source_path)  # Leave the caller's file where it was
+        raise
+
+
+def release_media(cursor, relative_path):
+    """Drops one reference to the blob at relative_path. Returns its hash if no references remain,
+    or None (also for paths that predate the store)."""
+    cursor.execute("SELECT sha256 FROM media_blobs WHERE relative_path = %s", (relative_path,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    sha256_hex = row['sha256'] if isinstance(row, dict) else row[0]
+    cursor.execute("UPDATE media_blobs SET ref_count = GREATEST(ref_count - 1, 0) WHERE sha256 = %s", (sha256_hex,))
+    cursor.execute("SELECT ref_count FROM media_blobs WHERE sha256 = %s", (sha256_hex,))
+    row = cursor.fetchone()
+    remaining = row['ref_count'] if isinstance(row, dict) else row[0]
+    return sha256_hex if remaining == 0 else None
+
+
+def delete_if_unreferenced(conn, storage, sha256_hex, derived_keys=None):
+    """Deletes the blob's file and row if it still has no references. Call after committing the
+    transaction that released it. `derived_keys(relative_path)` lists files rendered from the blob
+    (e.g. avatar thumbnails) to delete with it. Returns True if the blob was deleted."""
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute("SELECT relative_path, ref_count FROM media_blobs WHERE sha256 = %s FOR UPDATE", (sha256_hex,))
+        row = cursor.fetchone()
+        if row is None or row[1] > 0:
+            conn.rollback()
+            return False
+        for key in [row[0]] + (derived_keys(row[0]) if derived_keys else []):
+            storage.delete(key)
+        cursor.execute("DELETE FROM media_blobs WHERE sha256 = %s", (sha256_hex,))
+        conn.commit()
+        return True
+    finally:
+        cursor.close()
+
+
+def collect_unreferenced_blobs(conn, storage, derived_keys=None, logger=None):
+    """Deletes every blob left at zero references (e.g. by a crash between commit and delete)."""
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute("SELECT sha256 FROM media_blobs WHERE ref_count = 0")
+        candidates = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        cursor.close()
+    deleted = sum(1 for sha256_hex in candidates if delete_if_unreferenced(conn, storage, sha256_hex, derived_keys))
+    if logger:
+        logger.info(f"MEDIA_GC: Deleted {deleted} of {len(candidates)} unreferenced blobs.")
+    return deleted
+
+
+def discard_unregistered(conn, storage, relative_path, restore_to=None, derived_keys=None):
+    """After a rollback, removes (or moves back to restore_to) a file that no committed blob row
+    claims, so a failed request does not leave an orphan in the store.
+
+    The check is a locking read held until the file is gone: a concurrent upload of the same bytes
+    that already inserted its row makes this wait and then keep the file, and one that has not yet
+    inserted waits for this to finish and then writes the file again."""
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute("SELECT 1 FROM media_blobs WHERE relative_path = %s FOR UPDATE", (relative_path,))
+        if cursor.fetchone() is not None:
+            conn.rollback()
+            return
+        for key in derived_keys(relative_path) if derived_keys else []:
+            storage.delete(key)
+        if storage.exists(relative_path):
+            if restore_to:
+                storage.take(relative_path, restore_to)
+            else:
+                storage.delete(relative_path)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
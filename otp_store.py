@@ -0,0 +1,148 @@
+# otp_store.py
+"""Short-lived one-time passwords, kept out of the `users` table.
+
+A code is stored as an HMAC-SHA256 of (user id, code) under the app's secret key. It expires
+after `ttl` seconds, is consumed by the first successful verify, and is locked after
+`max_attempts` wrong guesses. Candidates are compared with hmac.compare_digest. MemoryOTPStore
+suits a single process only. RedisOTPStore shares codes across workers and hosts, and relies on Redis
+key expiry plus an atomic HINCRBY for the attempt counter."""
+
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+
+from cache import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+OTP_OK = 'ok'
+OTP_INVALID = 'invalid'
+OTP_MISSING = 'missing'  # Never issued, expired, already used, or locked out earlier
+OTP_LOCKED = 'locked'  # This guess exhausted the attempts; the code is gone
+
+
+def generate_code(length=8):
+    return ''.join(secrets.choice('0123456789') for _ in range(length))
+
+
+class _BaseOTPStore:
+
+    def __init__(self, secret, ttl=600, max_attempts=5, code_length=8):
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.code_length = code_length
+
+    def _digest(self, user_id, code):
+        return hmac.new(self.secret, f"{user_id}:{code}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id):
+        """Creates a new code for user_id, replacing any pending one, and returns it."""
+        code = generate_code(self.code_length)
+        self._put(user_id, self._digest(user_id, code))
+        return code
+
+
+class MemoryOTPStore(_BaseOTPStore):
+    """Process-local store; use only with a single web process."""
+
+    def __init__(self, secret, **kwargs):
+        super().__init__(secret, **kwargs)
+        self._entries = {}  # user id -> [digest, attempts, expires_at]
+        self._lock = threading.Lock()
+
+    def _purge_expired(self, now):
+        for user_id in [uid for uid, entry in self._entries.items() if entry[2] <= now]:
+            del self._entries[user_id]
+
+    def _put(self, user_id, digest):
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            self._entries[user_id] = [digest, 0, now + self.ttl]
+
+    def verify(self, user_id, code):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[2] <= time.monotonic():
+                self._entries.pop(user_id, None)
+                return OTP_MISSING
+            if hmac.compare_digest(entry[0], self._digest(user_id, code)):
+                del self._entries[user_id]
+                return OTP_OK
+            entry[1] += 1
+            if entry[1] >= self.max_attempts:
+                del self._entries[user_id]
+                return OTP_LOCKED
+            return OTP_INVALID
+
+    def clear(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+class RedisOTPStore(_BaseOTPStore):
+    """Shared store: one Redis hash per user with fields digest and attempts, expiring after ttl."""
+
+    def __init__(self, client, secret, namespace='ektbariny:otp', **kwargs):
+        super().__init__(secret, **kwargs)
+        self.client = client
+        self.namespace = namespace
+
+    def _key(self, user_id):
+        return f"{self.namespace}:{user_id}"
+
+    def _put(self, user_id, digest):
+        pipeline = self.client.pipeline()
+        pipeline.delete(self._key(user_id))
+        pipeline.hset(self._key(user_id), mapping={'digest': digest, 'attempts': 0})
+        pipeline.expire(self._key(user_id), int(self.ttl))
+        pipeline.execute()
+
+    def verify(self, user_id, code):
+        key = self._key(user_id)
+        stored = self.client.hget(key, 'digest')
+        if stored is None:
+            return OTP_MISSING
+        if isinstance(stored, bytes):
+            stored = stored.decode('ascii')
+        if hmac.compare_digest(stored, self._digest(user_id, code)):
+            # DELETE returns 0 if a concurrent verify consumed the code first
+            return OTP_OK if self.client.delete(key) else OTP_MISSING
+        # Counted atomically; if the key just expired, HINCRBY would recreate it without a TTL
+        attempts = self.client.hincrby(key, 'attempts', 1)
+        if self.client.ttl(key) < 0:
+            self.client.delete(key)
+            return OTP_MISSING
+        if attempts >= self.max_attempts:
+            self.client.delete(key)
+            return OTP_LOCKED
+        return OTP_INVALID
+
+    def clear(self, user_id):
+        self.client.delete(self._key(user_id))
+
+
+def create_otp_store(secret):
+    """Builds the store selected by OTP_STORE_BACKEND ('memory' or 'redis', which uses CACHE_REDIS_URL).
+
+    When OTP_STORE_BACKEND is unset it follows CACHE_BACKEND, so a deployment that already shares
+    its caches through Redis shares OTPs too. A code issued by one worker must verify in another,
+    so the in-process store logs a warning when WEB_CONCURRENCY (gunicorn's worker count) is above 1."""
+    options = {'ttl': int(os.getenv('OTP_TTL_SECONDS', '600')),
+               'max_attempts': int(os.getenv('OTP_MAX_ATTEMPTS', '5'))}
+    backend = (os.getenv('OTP_STORE_BACKEND') or os.getenv('CACHE_BACKEND', 'memory')).lower()
+    if backend == 'redis':
+        client = get_redis_client()
+        if client is not None:
+            return RedisOTPStore(client, secret, **options)
+        logger.warning("OTP_STORE: Redis selected but the 'redis' package is not installed; using the in-process store.")
+    workers = int(os.getenv('WEB_CONCURRENCY', '1') or '1')
+    if workers > 1:
+        logger.warning(f"OTP_STORE: In-process store with WEB_CONCURRENCY={workers}; OTPs issued by one worker "
+                       f"will fail to verify in the others. Set OTP_STORE_BACKEND=redis.")
+    return MemoryOTPStore(secret, **options)
@@ -0,0 +1,118 @@
+# pagination.py
+"""Keyset (seek) pagination for listing pages.
+
+A Keyset lists the ORDER BY columns, and the last of them must be unique (the row id). Instead
+of OFFSET, the next page continues WHERE (sort_key, id) is past the last row already shown, so
+with an index on the sort columns every page costs the same as the first. The position is
+handed to the client as an opaque, URL-safe cursor token. A token that does not decode is
+treated as the first page.
+
+Nullable sort columns are compared on their raw values, so an index on them still serves the
+seek. They follow MySQL's own NULL ordering: NULLs first ascending, last descending."""
+
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a cursor token was not produced by this Keyset."""
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'dec': str(value)}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+        if 'dec' in value:
+            return Decimal(value['dec'])
+        raise InvalidCursorError("Unknown cursor value.")
+    return value
+
+
+def _after(expr, value, descending, nullable):
+    """Condition and params for `expr` strictly past value in the column's order."""
+    if value is None:
+        # NULLs sort first ascending (every non-NULL is after) and last descending (nothing is)
+        return ('FALSE' if descending else f"{expr} IS NOT NULL"), []
+    comparison = f"{expr} {'<' if descending else '>'} %s"
+    if descending and nullable:
+        return f"({comparison} OR {expr} IS NULL)", [value]
+    return comparison, [value]
+
+
+def _equal(expr, value):
+    if value is None:
+        return f"{expr} IS NULL", []
+    return f"{expr} = %s", [value]
+
+
+class Keyset:
+    """Seek order over (expression, row key, descending[, nullable]) columns; the last column must be unique."""
+
+    def __init__(self, *columns):
+        self.columns = tuple(column if len(column) == 4 else column + (False,) for column in columns)
+
+    def order_by(self):
+        return ', '.join(f"{expr} {'DESC' if descending else 'ASC'}" for expr, _, descending, _ in self.columns)
+
+    def seek(self, values):
+        """SQL condition and params selecting rows strictly after `values` in this order."""
+        # (a, b, id) > (x, y, z) expanded as a > x OR (a = x AND (b > y OR (b = y AND id > z)))
+        condition, params = None, []
+        for (expr, _, descending, nullable), value in reversed(list(zip(self.columns, values))):
+            after, after_params = _after(expr, value, descending, nullable)
+            if condition is None:
+                condition, params = after, after_params
+            else:
+                equal, equal_params = _equal(expr, value)
+                condition = f"{after} OR ({equal} AND ({condition}))"
+                params = after_params + equal_params + params
+        return f"({condition})", params
+
+    def encode(self, row):
+        payload = json.dumps([_encode_value(row[key]) for _, key, _, _ in self.columns], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode(self, token):
+        try:
+            payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            values = [_decode_value(value) for value in json.loads(payload)]
+        except (ValueError, TypeError) as e:
+            raise InvalidCursorError("Malformed cursor.") from e
+        if not isinstance(values, list) or len(values) != len(self.columns):
+            raise InvalidCursorError("Cursor does not match this listing.")
+        return values
+
+
+def fetch_page(cursor, sql, params, keyset, token=None, limit=24):
+    """Runs `sql` for one page. Returns (rows, next cursor token or None).
+
+    `sql` is the query up to and including its WHERE clause, ending in a condition that the
+    seek predicate can be ANDed onto. ORDER BY and LIMIT are appended here."""
+    params = list(params)
+    if token:
+        try:
+            condition, seek_params = keyset.seek(keyset.decode(token))
+            sql = f"{sql} AND {condition}"
+            params += seek_params
+        except InvalidCursorError:
+            pass
+    cursor.execute(f"{sql} ORDER BY {keyset.order_by()} LIMIT %s", tuple(params) + (limit + 1,))
+    rows = cursor.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, keyset.encode(rows[-1])
+    return rows, None
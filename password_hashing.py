@@ -0,0 +1,111 @@
+# password_hashing.py
+"""Password hashing off the request threads.
+
+PasswordHasher sends Werkzeug's generate_password_hash/check_password_hash to a process pool
+(`spawn` workers, so none inherits locks held by request threads at fork time). A burst of logins
+then runs on up to `workers` cores in parallel, and the web worker's own threads keep serving other
+requests while they wait.
+
+The algorithm and cost come from one Werkzeug method string, e.g. 'scrypt:32768:8:1' or
+'pbkdf2:sha256:600000'. Stored hashes carry the method they were made with, so needs_rehash()
+detects hashes from an older or weaker setting. Login upgrades them once the password is known
+to be correct.
+
+A call that gets no answer within `timeout` raises PasswordHasherBusyError. The task is cancelled
+if it is still queued; one already running in a worker finishes there and its result is dropped."""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+class PasswordHasherBusyError(RuntimeError):
+    """Raised when the worker pool does not answer within the timeout; the caller should ask the user to retry."""
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(password_hash, password):
+    return check_password_hash(password_hash, password)
+
+
+class PasswordHasher:
+    """`workers=0` hashes inline on the calling thread (development and tests)."""
+
+    def __init__(self, method=DEFAULT_METHOD, workers=None, timeout=10.0):
+        self.method = method
+        # Werkzeug expands short forms ('scrypt', 'pbkdf2:sha256') into the prefix it stores, so
+        # compare against a real hash's prefix; this also rejects an invalid method at startup.
+        self.method_prefix = _hash('', method).split('$', 1)[0]
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            # A pool created before a fork (e.g. gunicorn --preload) is unusable in the child
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+        try:
+            future = self._get_executor().submit(function, *args)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            logger.warning(f"PASSWORD_HASHING: No worker answered within {self.timeout:.1f}s.")
+            raise PasswordHasherBusyError("Password hashing is overloaded; try again shortly.") from None
+        except BrokenProcessPool:
+            logger.error("PASSWORD_HASHING: Worker pool died; recreating it and hashing inline this time.")
+            with self._lock:
+                self._executor = None
+            return function(*args)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self._run(_verify, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if password_hash was made with a different method or cost than the configured one."""
+        return bool(password_hash) and password_hash.split('$', 1)[0] != self.method_prefix
+
+    def warm(self):
+        """Starts the pool's processes now instead of on the first login."""
+        if self.workers:
+            executor = self._get_executor()
+            for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def hasher_from_env():
+    return PasswordHasher(method=os.getenv('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+                          workers=int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1))),
+                          timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT_SECONDS', '10')))
@@ -0,0 +1,59 @@
+# question_loader.py
+"""Loads quiz questions and their choices as compact, typed tuples.
+
+Questions and choices are fetched with two queries and stitched together by question id, so
+choice text is never packed into a delimited string (no group_concat_max_len truncation, no
+breakage on commas) and nothing is re-parsed in Python."""
+
+from collections import namedtuple
+
+Choice = namedtuple('Choice', 'id choice_text is_correct')
+
+
+class Question(namedtuple('Question', 'id question_text question_type points display_order choices')):
+    __slots__ = ()
+
+    @property
+    def question_id(self):
+        return self.id
+
+
+_QUESTION_COLUMNS = ('id', 'question_text', 'question_type', 'points', 'display_order')
+_CHOICE_COLUMNS = ('question_id', 'id', 'choice_text', 'is_correct')
+
+
+def _values(row, columns):
+    if isinstance(row, dict):
+        return tuple(row[column] for column in columns)
+    return tuple(row)
+
+
+def load_quiz_questions(cursor, quiz_id):
+    """Returns the quiz's questions in display order as a tuple of Question, each with its choices."""
+    cursor.execute("""
+        SELECT id, question_text, question_type, points, display_order
+        FROM questions WHERE quiz_id = %s
+        ORDER BY display_order ASC, id ASC
+    """, (quiz_id,))
+    question_rows = [_values(row, _QUESTION_COLUMNS) for row in cursor.fetchall()]
+    if not question_rows:
+        return ()
+
+    cursor.execute("""
+        SELECT c.question_id, c.id, c.choice_text, c.is_correct
+        FROM choices c
+        JOIN questions q ON c.question_id = q.id
+        WHERE q.quiz_id = %s
+        ORDER BY c.question_id ASC, c.id ASC
+    """, (quiz_id,))
+    choices_by_question = {}
+    for row in cursor.fetchall():
+        question_id, choice_id, choice_text, is_correct = _values(row, _CHOICE_COLUMNS)
+        choices_by_question.setdefault(question_id, []).append(Choice(choice_id, choice_text, bool(is_correct)))
+
+    return tuple(
+        Question(question_id, question_text, question_type, points, display_order,
+                 tuple(choices_by_question.get(question_id, ())))
+        for question_id, question_text, question_type, points, display_order in question_rows
+    )
+
@@ -0,0 +1,68 @@
+# quiz_snapshots.py
+"""Immutable, versioned quiz snapshots shared by quiz rendering and grading.
+
+`quizzes.content_version` is bumped in the same transaction as any edit to the quiz, its
+questions or their choices, so a snapshot cached under (quiz_id, version) never goes stale;
+old versions simply age out of the LRU."""
+
+import os
+from types import MappingProxyType
+
+from cache import LRUCache
+from question_loader import load_quiz_questions
+
+_snapshot_cache = LRUCache(maxsize=int(os.getenv('QUIZ_SNAPSHOT_CACHE_SIZE', '512')), ttl=0)
+
+
+class QuizSnapshot:
+    """Questions, choices, answer key and points of one quiz at one content version."""
+
+    __slots__ = ('quiz_id', 'version', 'passing_score_percentage', 'questions', 'questions_by_id', 'answer_key')
+
+    def __init__(self, quiz_id, version, passing_score_percentage, questions):
+        questions = tuple(questions)
+        object.__setattr__(self, 'quiz_id', quiz_id)
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'passing_score_percentage', passing_score_percentage)
+        object.__setattr__(self, 'questions', questions)
+        object.__setattr__(self, 'questions_by_id', MappingProxyType({q.id: q for q in questions}))
+        object.__setattr__(self, 'answer_key', MappingProxyType({
+            q.id: frozenset(c.id for c in q.choices if c.is_correct) for q in questions
+        }))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("QuizSnapshot is immutable")
+
+    @property
+    def max_score(self):
+        return sum(q.points for q in self.questions)
+
+
+def bump_quiz_version(cursor, quiz_id):
+    """Invalidates cached snapshots of quiz_id; call in the same transaction as the content edit."""
+    cursor.execute("UPDATE quizzes SET content_version = content_version + 1 WHERE id = %s", (quiz_id,))
+
+
+def load_quiz_snapshot(cursor, quiz_id):
+    """Builds a snapshot from the database. Returns None if the quiz does not exist."""
+    cursor.execute("SELECT content_version, passing_score_percentage FROM quizzes WHERE id = %s", (quiz_id,))
+    quiz_row = cursor.fetchone()
+    if quiz_row is None:
+        return None
+    if isinstance(quiz_row, dict):
+        quiz_row = (quiz_row['content_version'], quiz_row['passing_score_percentage'])
+    version, passing_score_percentage = quiz_row
+    return QuizSnapshot(quiz_id, version, passing_score_percentage, load_quiz_questions(cursor, quiz_id))
+
+
+def get_quiz_snapshot(cursor, quiz_id, version):
+    """Returns the snapshot for (quiz_id, version), loading and caching it on a miss.
+
+    `version` is the content_version the caller just read with the quiz row; if the quiz was
+    edited in between, the freshly loaded (newer) snapshot is returned and cached instead."""
+    snapshot = _snapshot_cache.get((quiz_id, version))
+    if snapshot is None:
+        snapshot = load_quiz_snapshot(cursor, quiz_id)
+        if snapshot is not None:
+            _snapshot_cache.set((quiz_id, snapshot.version), snapshot)
+    return snapshot
@@ -0,0 +1,171 @@
+# regrade.py
+"""Background re-grading of completed quiz attempts after a teacher changes a question.
+
+enqueue_regrade() records a job in `regrade_jobs` inside the editing transaction; run_regrade_job()
+re-scores the quiz's completed attempts in attempt-id chunks with the batch grading engine,
+committing and recording progress after each chunk so `student_answers` is never locked for long
+and an interrupted job resumes where it stopped.
+
+A runner claims a job by taking a lease: it writes a fresh `lease_token` and a `lease_expires_at`
+that it pushes forward with every chunk. A 'running' job can only be claimed again once its lease
+has run out, so `flask run-regrade-jobs` resumes jobs whose worker died without racing a web
+thread that is still grading. A runner that finds its token replaced rolls back its chunk and stops."""
+
+import uuid
+
+from grading import grade_attempts_batch
+from quiz_snapshots import load_quiz_snapshot
+
+
+def enqueue_regrade(cursor, quiz_id, reason=None):
+    """Queues a re-grade of quiz_id unless one is already pending. Returns (job id, created).
+
+    A pending job loads the quiz when it starts, so it already covers any later edits; only a newly
+    created job needs a worker started for it."""
+    cursor.execute("SELECT id FROM regrade_jobs WHERE quiz_id = %s AND status = 'pending' ORDER BY id ASC LIMIT 1", (quiz_id,))
+    row = cursor.fetchone()
+    if row is not None:
+        return (row['id'] if isinstance(row, dict) else row[0]), False
+    cursor.execute("INSERT INTO regrade_jobs (quiz_id, reason) VALUES (%s, %s)", (quiz_id, reason))
+    return cursor.lastrowid, True
+
+
+def get_regrade_job(cursor, job_id):
+    """Returns the job's status and progress counters as a dict, or None."""
+    cursor.execute("""
+        SELECT id, quiz_id, status, total_attempts, processed_attempts, error_message, created_at, started_at, finished_at
+        FROM regrade_jobs WHERE id = %s
+    """, (job_id,))
+    row = cursor.fetchone()
+    if row is None or isinstance(row, dict):
+        return row
+    return dict(zip(('id', 'quiz_id', 'status', 'total_attempts', 'processed_attempts', 'error_message',
+                     'created_at', 'started_at', 'finished_at'), row))
+
+
+_CLAIMABLE = "(status = 'pending' OR (status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)))"
+
+
+class LeaseLostError(Exception):
+    """Another runner claimed the job after this runner's lease expired."""
+
+
+def run_regrade_job(conn, job_id, chunk_size=200, lease_seconds=300, logger=None):
+    """Runs (or resumes) one job to completion. Returns the number of attempts re-graded, or None
+    if the job is not claimable (unknown, finished, leased by a live runner, or its quiz was deleted).
+
+    `lease_seconds` must comfortably exceed the time one chunk takes."""
+    cursor = conn.cursor(buffered=True)
+    lease_token = uuid.uuid4().hex
+    try:
+        cursor.execute(f"""
+            UPDATE regrade_jobs SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP),
+                lease_token = %s, lease_expires_at = CURRENT_TIMESTAMP + INTERVAL %s SECOND
+            WHERE id = %s AND {_CLAIMABLE}
+        """, (lease_token, lease_seconds, job_id))
+        conn.commit()
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute("SELECT quiz_id, last_attempt_id, processed_attempts FROM regrade_jobs WHERE id = %s", (job_id,))
+        quiz_id, last_attempt_id, processed = cursor.fetchone()
+
+        snapshot = load_quiz_snapshot(cursor, quiz_id)
+        if snapshot is None:
+            cursor.execute("""
+                UPDATE regrade_jobs SET status = 'failed', error_message = 'Quiz no longer exists.',
+                    finished_at = CURRENT_TIMESTAMP, lease_expires_at = NULL
+                WHERE id = %s AND lease_token = %s
+            """, (job_id, lease_token))
+            conn.commit()
+            return None
+
+        cursor.execute("SELECT COUNT(*) FROM quiz_attempts WHERE quiz_id = %s AND is_completed = TRUE", (quiz_id,))
+        total_attempts = cursor.fetchone()[0]
+        cursor.execute("UPDATE regrade_jobs SET total_attempts = %s WHERE id = %s AND lease_token = %s",
+                       (total_attempts, job_id, lease_token))
+        conn.commit()
+
+        while True:
+            cursor.execute("""
+                SELECT id FROM quiz_attempts
+                WHERE quiz_id = %s AND is_completed = TRUE AND id > %s
+                ORDER BY id ASC LIMIT %s
+            """, (quiz_id, last_attempt_id, chunk_size))
+            attempt_ids = [row[0] for row in cursor.fetchall()]
+            if not attempt_ids:
+                break
+
+            placeholders = ', '.join(['%s'] * len(attempt_ids))
+            cursor.execute(f"""
+                SELECT attempt_id, question_id, selected_choice_id FROM student_answers
+                WHERE attempt_id IN ({placeholders})
+            """, tuple(attempt_ids))
+            attempts = {attempt_id: {} for attempt_id in attempt_ids}
+            for attempt_id, question_id, selected_choice_id in cursor.fetchall():
+                attempts[attempt_id][question_id] = selected_choice_id
+
+            graded = grade_attempts_batch(snapshot, attempts)
+            answer_updates = [(r.is_mc_correct, r.points_awarded, attempt_id, r.question_id)
+                              for attempt_id, grade in graded.items()
+                              for r in grade.results if r.is_mc_correct is not None]
+            if answer_updates:
+                cursor.executemany("""
+                    UPDATE student_answers SET is_mc_correct = %s, points_awarded = %s
+                    WHERE attempt_id = %s AND question_id = %s
+                """, answer_updates)
+            cursor.executemany("""
+                UPDATE quiz_attempts SET score = %s, max_possible_score = %s, passed = %s WHERE id = %s
+            """, [(grade.score, grade.max_possible_score, grade.passed, attempt_id) for attempt_id, grade in graded.items()])
+
+            processed += len(attempt_ids)
+            last_attempt_id = attempt_ids[-1]
+            # Renews the lease; processed_attempts always grows, so rowcount is 0 only if the lease was taken
+            cursor.execute("""
+                UPDATE regrade_jobs SET processed_attempts = %s, last_attempt_id = %s,
+                    lease_expires_at = CURRENT_TIMESTAMP + INTERVAL %s SECOND
+                WHERE id = %s AND lease_token = %s
+            """, (processed, last_attempt_id, lease_seconds, job_id, lease_token))
+            if cursor.rowcount == 0:
+                raise LeaseLostError(f"Regrade job {job_id} was claimed by another runner.")
+            conn.commit()
+            if logger:
+                logger.info(f"REGRADE: job {job_id} quiz {quiz_id}: {processed}/{total_attempts} attempts re-graded.")
+
+        cursor.execute("""
+            UPDATE regrade_jobs SET status = 'completed', finished_at = CURRENT_TIMESTAMP, lease_expires_at = NULL
+            WHERE id = %s AND lease_token = %s
+        """, (job_id, lease_token))
+        conn.commit()
+        return processed
+    except LeaseLostError as e:
+        conn.rollback()  # The current chunk is left to the runner that holds the lease
+        if logger:
+            logger.warning(f"REGRADE: {e} Stopping.")
+        return None
+    except Exception as e:
+        conn.rollback()
+        cursor.execute("""
+            UPDATE regrade_jobs SET status = 'failed', error_message = %s, finished_at = CURRENT_TIMESTAMP,
+                lease_expires_at = NULL
+            WHERE id = %s AND lease_token = %s
+        """, (str(e)[:500], job_id, lease_token))
+        conn.commit()
+        raise
+    finally:
+        cursor.close()
+
+
+def run_pending_regrade_jobs(conn, chunk_size=200, lease_seconds=300, logger=None):
+    """Runs every pending job and every 'running' job whose lease expired, in id order.
+    Returns the number of jobs this call ran to completion."""
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute(f"SELECT id FROM regrade_jobs WHERE {_CLAIMABLE} ORDER BY id ASC")
+        job_ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    jobs_run = 0
+    for job_id in job_ids:
+        if run_regrade_job(conn, job_id, chunk_size=chunk_size, lease_seconds=lease_seconds, logger=logger) is not None:
+            jobs_run += 1
+    return jobs_run
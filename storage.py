@@ -0,0 +1,231 @@
+# storage.py
+"""Storage backends for uploaded media: the local static folder by default, S3 (or any
+S3-compatible service such as MinIO) when configured.
+
+Keys are the same static-relative paths already stored in the database (e.g.
+`uploads/media/ab/cd/<hash>.mp4`), so switching backends needs no data migration beyond copying
+the objects. LocalStorage serves files through the app (send_file/X-Accel-Redirect); S3Storage
+hands out presigned GET URLs so video bytes go straight from object storage to the browser and
+web workers need no shared disk."""
+
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # Optional dependency, only needed for STORAGE_BACKEND=s3
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+
+class LocalStorage:
+    """Keys are paths below `root` (the static folder). Scratch files go to `temp_root`, which must be
+    on the same filesystem but outside `root`, since everything under the static folder is public."""
+
+    is_local = True
+
+    def __init__(self, root, temp_root=None):
+        self.root = os.path.abspath(root)
+        # Defaults to <app root>/instance/media_tmp when root is the app's static folder
+        self.temp_root = os.path.abspath(temp_root or os.path.join(os.path.dirname(self.root), 'instance', 'media_tmp'))
+        if self.temp_root == self.root or self.temp_root.startswith(self.root + os.sep):
+            raise ValueError(f"Storage scratch directory must be outside the served root: {self.temp_root}")
+
+    def path(self, key):
+        """Absolute path for key; raises ValueError for keys that would escape the root."""
+        full_path = os.path.abspath(os.path.join(self.root, key))
+        if not full_path.startswith(self.root + os.sep):
+            raise ValueError(f"Storage key escapes the root: {key!r}")
+        return full_path
+
+    def temp_dir(self):
+        """Scratch directory on the same filesystem, so put_file() is a rename rather than a copy."""
+        os.makedirs(self.temp_root, exist_ok=True)
+        return self.temp_root
+
+    def put_file(self, local_path, key):
+        """Moves local_path to key, replacing any existing object."""
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(local_path, target)
+
+    def put_tree(self, local_dir, prefix):
+        """Moves a directory of files to prefix/, which should be a fresh prefix; callers switch their
+        references over once this returns and only then delete the previous prefix."""
+        target = self.path(prefix)
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(local_dir, target)
+
+    def take(self, key, local_path):
+        """Moves the object back out of storage to local_path."""
+        shutil.move(self.path(key), local_path)
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def get_bytes(self, key):
+        with self.open(key) as stored:
+            return stored.read()
+
+    def read_range(self, key, start, end):
+        """Bytes start..end inclusive, as in an HTTP Range header."""
+        with self.open(key) as stored:
+            stored.seek(start)
+            return stored.read(end - start + 1)
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix):
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+    @contextmanager
+    def local_copy(self, key):
+        yield self.path(key)
+
+    def presign(self, key, expires_in=None):
+        return None  # Served by the app
+
+    def public_url(self, key):
+        return None  # Served from /static
+
+
+class S3Storage:
+    """Objects live in `bucket` under `key_prefix`; works with AWS S3 and S3-compatible endpoints."""
+
+    is_local = False
+
+    def __init__(self, client, bucket, key_prefix='', public_base_url=None, presign_ttl=3600):
+        self.client = client
+        self.bucket = bucket
+        self.key_prefix = key_prefix.strip('/') + '/' if key_prefix.strip('/') else ''
+        self.public_base_url = (public_base_url or '').rstrip('/') or None
+        self.presign_ttl = presign_ttl
+
+    def _object_key(self, key):
+        if '..' in key.split('/'):
+            raise ValueError(f"Storage key escapes the root: {key!r}")
+        return self.key_prefix + key.lstrip('/')
+
+    def temp_dir(self):
+        return tempfile.gettempdir()
+
+    def put_file(self, local_path, key):
+        content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        self.client.upload_file(local_path, self.bucket, self._object_key(key), ExtraArgs={'ContentType': content_type})
+        os.remove(local_path)
+
+    def put_tree(self, local_dir, prefix):
+        """Uploads a directory of files under prefix/, which should be a fresh prefix. Objects already
+        uploaded are removed again if any upload fails, so a failed call leaves nothing behind."""
+        try:
+            for directory, _, filenames in os.walk(local_dir):
+                for filename in filenames:
+                    local_path = os.path.join(directory, filename)
+                    relative = os.path.relpath(local_path, local_dir).replace(os.sep, '/')
+                    self.put_file(local_path, f"{prefix.rstrip('/')}/{relative}")
+        except Exception:
+            try:
+                self.delete_prefix(prefix)
+            except ClientError as e:
+                logger.warning(f"STORAGE: Could not remove partial upload under '{prefix}': {e}")
+            raise
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+    def take(self, key, local_path):
+        self.client.download_file(self.bucket, self._object_key(key), local_path)
+        self.delete(key)
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))['Body']
+
+    def get_bytes(self, key):
+        return self.open(key).read()
+
+    def read_range(self, key, start, end):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key), Range=f"bytes={start}-{end}")
+        return response['Body'].read()
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))['ContentLength']
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def delete_prefix(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix.rstrip('/') + '/')):
+            objects = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if objects:  # A page holds at most 1000 keys, the delete_objects limit
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+    @contextmanager
+    def local_copy(self, key):
+        """Downloads the object to a temporary file for tools that need a path (ffmpeg)."""
+        handle, local_path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        os.close(handle)
+        try:
+            self.client.download_file(self.bucket, self._object_key(key), local_path)
+            yield local_path
+        finally:
+            os.remove(local_path)
+
+    def presign(self, key, expires_in=None):
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._object_key(key)},
+            ExpiresIn=int(expires_in or self.presign_ttl))
+
+    def public_url(self, key):
+        """Unsigned URL when the bucket (or a CDN in front of it) is public, else a presigned one."""
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self._object_key(key)}"
+        return self.presign(key)
+
+
+def create_storage(static_root):
+    """Builds the backend selected by STORAGE_BACKEND ('local' or 's3').
+
+    The local backend's scratch directory can be moved with STORAGE_TEMP_DIR (same mount as static_root)."""
+    backend = os.getenv('STORAGE_BACKEND', 'local').lower()
+    if backend == 's3':
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires the 'boto3' package.")
+        client = boto3.client(
+            's3',
+            endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,  # e.g. http://localhost:9000 for MinIO
+            region_name=os.getenv('S3_REGION') or None,
+            aws_access_key_id=os.getenv('S3_ACCESS_KEY_ID') or None,
+            aws_secret_access_key=os.getenv('S3_SECRET_ACCESS_KEY') or None,
+            config=BotoConfig(signature_version='s3v4', s3={'addressing_style': os.getenv('S3_ADDRESSING_STYLE', 'auto')}),
+        )
+        logger.info(f"STORAGE: Using S3 bucket '{os.getenv('S3_BUCKET')}'.")
+        return S3Storage(client, os.getenv('S3_BUCKET', 'ektbariny-media'), key_prefix=os.getenv('S3_KEY_PREFIX', ''),
+                         public_base_url=os.getenv('MEDIA_PUBLIC_BASE_URL'),
+                         presign_ttl=int(os.getenv('S3_PRESIGN_TTL_SECONDS', '3600')))
+    return LocalStorage(static_root, temp_root=os.getenv('STORAGE_TEMP_DIR') or None)
@@ -0,0 +1,52 @@
+# student_dashboard.py
+"""Loaders for the student dashboard.
+
+The latest attempt per quiz is picked in one pass with ROW_NUMBER() (MySQL 8+), which walks
+idx_attempt_student_quiz_submitted instead of running a correlated subquery per column per quiz.
+Subscriptions are not joined here: callers pass the teacher ids from the entitlement cache."""
+
+AVAILABLE_QUIZZES_SQL = """
+    WITH page_quizzes AS (
+        SELECT q.id, q.teacher_id, q.title, q.description, q.time_limit_minutes, q.passing_score_percentage, q.created_at
+        FROM quizzes q
+        WHERE q.is_active = TRUE AND q.teacher_id IN ({teacher_placeholders})
+        ORDER BY q.created_at DESC
+        LIMIT %s
+    ),
+    ranked_attempts AS (
+        SELECT qa.id, qa.quiz_id, qa.score, qa.max_possible_score, qa.passed, qa.submitted_at,
+               ROW_NUMBER() OVER (PARTITION BY qa.quiz_id ORDER BY qa.submitted_at DESC, qa.id DESC) AS attempt_rank
+        FROM quiz_attempts qa
+        JOIN page_quizzes pq ON qa.quiz_id = pq.id
+        WHERE qa.student_id = %s
+    ),
+    question_counts AS (
+        SELECT qs.quiz_id, COUNT(*) AS question_count
+        FROM questions qs
+        JOIN page_quizzes pq ON qs.quiz_id = pq.id
+        GROUP BY qs.quiz_id
+    )
+    SELECT pq.id, pq.title, pq.description, pq.time_limit_minutes, pq.passing_score_percentage,
+           u.first_name AS teacher_first_name, u.last_name AS teacher_last_name,
+           COALESCE(qc.question_count, 0) AS question_count,
+           ra.score AS last_attempt_score, ra.max_possible_score AS last_attempt_max_score,
+           ra.passed AS last_attempt_passed, ra.submitted_at AS last_attempt_date, ra.id AS last_attempt_id
+    FROM page_quizzes pq
+    JOIN users u ON pq.teacher_id = u.id
+    LEFT JOIN question_counts qc ON qc.quiz_id = pq.id
+    LEFT JOIN ranked_attempts ra ON ra.quiz_id = pq.id AND ra.attempt_rank = 1
+    ORDER BY pq.created_at DESC
+"""
+
+
+def load_available_quizzes(cursor, student_id, teacher_ids, limit=6):
+    """Returns the newest active quizzes from `teacher_ids` (the student's subscriptions) with their latest attempt.
+
+    Rows carry the same keys the dashboard template used before: question_count and the
+    last_attempt_* columns (NULL when the student has never attempted the quiz)."""
+    teacher_ids = list(teacher_ids)
+    if not teacher_ids:
+        return []
+    cursor.execute(AVAILABLE_QUIZZES_SQL.format(teacher_placeholders=', '.join(['%s'] * len(teacher_ids))),
+                   (*teacher_ids, limit, student_id))
+    return cursor.fetchall()
@@ -0,0 +1,91 @@
+# subscription_expiry.py
+"""Scheduled sweep that moves lapsed subscriptions from 'active' to 'expired'.
+
+run_expiry_sweep() fixes a cutoff (the database's NOW()) and walks
+idx_subscription_status_expiry with a keyset on (expiry_date, id), so each chunk is an index
+range scan. It locks only that chunk (FOR UPDATE SKIP LOCKED, so two sweepers never wait on each
+other), flips the rows, updates teacher_stats.subscribers_count and commits. Affected students are
+passed to `on_expired` after each commit so their cached entitlements can be dropped. Every run
+writes a `subscription_sweep_runs` row with its cutoff, counts and outcome.
+
+Access checks do not depend on the sweep, because entitlements.py already ignores rows whose
+expiry_date has passed. The sweep keeps `status` and the subscriber counters accurate."""
+
+from collections import Counter
+
+from teacher_stats import bump_teacher_stats
+
+
+def run_expiry_sweep(conn, chunk_size=500, on_expired=None, logger=None):
+    """Expires every active subscription whose expiry_date is at or before the cutoff.
+
+    Returns (run id, subscriptions expired). Only 'active' rows are unique per student and teacher
+    (uq_student_teacher_active), so any number of expired rows can pile up for a pair that renews."""
+    cursor = conn.cursor(buffered=True)
+    run_id = None
+    expired = chunks = 0
+    try:
+        cursor.execute("SELECT NOW()")
+        cutoff = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO subscription_sweep_runs (cutoff) VALUES (%s)", (cutoff,))
+        run_id = cursor.lastrowid
+        conn.commit()
+
+        last_expiry, last_id = None, 0
+        while True:
+            if last_expiry is None:
+                cursor.execute("""
+                    SELECT id, student_id, teacher_id, expiry_date FROM student_subscriptions
+                    WHERE status = 'active' AND expiry_date <= %s
+                    ORDER BY expiry_date ASC, id ASC LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (cutoff, chunk_size))
+            else:
+                cursor.execute("""
+                    SELECT id, student_id, teacher_id, expiry_date FROM student_subscriptions
+                    WHERE status = 'active' AND expiry_date <= %s
+                      AND (expiry_date > %s OR (expiry_date = %s AND id > %s))
+                    ORDER BY expiry_date ASC, id ASC LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (cutoff, last_expiry, last_expiry, last_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.commit()
+                break
+            last_id, last_expiry = rows[-1][0], rows[-1][3]
+
+            placeholders = ', '.join(['%s'] * len(rows))
+            chunk_ids = tuple(row[0] for row in rows)
+            # The chunk is locked, so every row is still 'active' and flips
+            cursor.execute(f"UPDATE student_subscriptions SET status = 'expired' WHERE id IN ({placeholders})", chunk_ids)
+
+            for teacher_id, count in sorted(Counter(row[2] for row in rows).items()):
+                bump_teacher_stats(cursor, teacher_id, subscribers=-count)
+            expired += len(rows)
+            chunks += 1
+            cursor.execute("""
+                UPDATE subscription_sweep_runs SET expired_count = %s, chunks = %s WHERE id = %s
+            """, (expired, chunks, run_id))
+            conn.commit()
+
+            if on_expired:
+                on_expired(sorted({row[1] for row in rows}))
+            if logger:
+                logger.info(f"SUBSCRIPTION_SWEEP: run {run_id}: chunk {chunks}, {expired} expired so far.")
+
+        cursor.execute("""
+            UPDATE subscription_sweep_runs SET status = 'completed', finished_at = CURRENT_TIMESTAMP WHERE id = %s
+        """, (run_id,))
+        conn.commit()
+        return run_id, expired
+    except Exception as e:
+        conn.rollback()
+        if run_id is not None:
+            cursor.execute("""
+                UPDATE subscription_sweep_runs SET status = 'failed', error_message = %s, finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (str(e)[:500], run_id))
+            conn.commit()
+        raise
+    finally:
+        cursor.close()
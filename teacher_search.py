@@ -0,0 +1,134 @@
+# teacher_search.py
+"""Relevance-ranked teacher search over a FULLTEXT (ngram parser) index.
+
+Each teacher row carries `users.search_text`, a normalized copy of their name, username and bio.
+It is written in the same transaction as every signup or profile edit, and its FULLTEXT index
+uses the ngram parser, so Arabic and English both match on substrings. Queries go through the
+same normalize_text() and run as a boolean-mode MATCH with each term as a required phrase. They
+are ordered by MATCH relevance and served from the index, so their cost does not grow with the
+number of teachers.
+
+normalize_text() folds the spellings Arabic users mix freely: alef with hamza or madda becomes
+bare alef, alef maqsura becomes ya, ta marbuta becomes ha. It also strips harakat and tatweel
+and maps Arabic-Indic digits to ASCII.
+
+The index must be built without a stopword list. The ngram parser drops every token that contains
+a stopword, and the default InnoDB list holds "a", "i", "in", "on" and similar, so most English
+bigrams ("ka", "ri", "im" in "karim") would never be indexed. InnoDB fixes the stopword setting
+when an index is created, so schema setup runs FULLTEXT_SESSION_SQL first and then verifies it
+with check_fulltext_config(). The server's ngram_token_size must equal NGRAM_TOKEN_SIZE."""
+
+import re
+import unicodedata
+
+NGRAM_TOKEN_SIZE = 2  # MySQL's ngram_token_size default; shorter terms cannot match the index
+NAME_WEIGHT = 2  # Names are repeated in search_text so they outrank a mention in someone's bio
+FULLTEXT_INDEX = 'ft_user_search_ngram'
+FULLTEXT_SESSION_SQL = "SET SESSION innodb_ft_enable_stopword = OFF"  # Before creating FULLTEXT_INDEX
+
+_ARABIC_FOLDS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+_DIACRITICS = re.compile('[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')  # Harakat, Quranic marks, tatweel
+_NON_WORD = re.compile(r'[^\w]+|_+')
+
+
+def normalize_text(text):
+    """Lowercased, Arabic-folded text with punctuation collapsed to single spaces."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text)
+    text = _DIACRITICS.sub('', text).translate(_ARABIC_FOLDS).lower()
+    return _NON_WORD.sub(' ', text).strip()
+
+
+def check_fulltext_config(cursor, logger=None):
+    """Verifies, on the schema-setup connection, that FULLTEXT indexes are being created without
+    stopwords and that ngram_token_size matches NGRAM_TOKEN_SIZE. Returns True if both hold."""
+    cursor.execute("SELECT @@SESSION.innodb_ft_enable_stopword, @@GLOBAL.ngram_token_size")
+    stopwords_enabled, token_size = cursor.fetchone()
+    problems = []
+    if int(stopwords_enabled):
+        problems.append("innodb_ft_enable_stopword is ON, so English name bigrams would be dropped from the index")
+    if int(token_size) != NGRAM_TOKEN_SIZE:
+        problems.append(f"ngram_token_size is {token_size}, expected {NGRAM_TOKEN_SIZE}")
+    for problem in problems:
+        if logger:
+            logger.error(f"TEACHER_SEARCH: {problem}.")
+    return not problems
+
+
+def build_search_text(first_name, last_name, username, bio):
+    names = ' '.join(normalize_text(part) for part in (first_name, last_name, username) if part)
+    return ' '.join([names] * NAME_WEIGHT + [normalize_text(bio)]).strip()
+
+
+def boolean_query(search_query):
+    """`+"term" +"term"` for MATCH ... IN BOOLEAN MODE, or None if no term is long enough for the index."""
+    terms = [term for term in normalize_text(search_query).split() if len(term) >= NGRAM_TOKEN_SIZE]
+    if not terms:
+        return None
+    return ' '.join(f'+"{term}"' for term in terms)
+
+
+def like_prefix(search_query):
+    """A LIKE pattern matching values that start with search_query, with its %, _ and \\ taken literally."""
+    escaped = search_query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+
+def refresh_search_text(cursor, user_id):
+    """Recomputes one user's search_text from their current row, in the caller's transaction."""
+    cursor.execute("SELECT first_name, last_name, username, bio FROM users WHERE id = %s", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+    if isinstance(row, dict):
+        row = (row['first_name'], row['last_name'], row['username'], row['bio'])
+    cursor.execute("UPDATE users SET search_text = %s WHERE id = %s", (build_search_text(*row), user_id))
+
+
+def search_teachers(cursor, search_query, columns, limit=50):
+    """The `limit` most relevant active teachers matching search_query; `columns` is the SELECT list.
+
+    Returns None when the query has no indexable term, so the caller can fall back."""
+    query = boolean_query(search_query)
+    if query is None:
+        return None
+    cursor.execute(f"""
+        SELECT {columns}, MATCH(search_text) AGAINST (%s IN BOOLEAN MODE) AS relevance
+        FROM users
+        WHERE role = 'teacher' AND is_active = TRUE AND MATCH(search_text) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY relevance DESC, id ASC
+        LIMIT %s
+    """, (query, query, limit))
+    return cursor.fetchall()
+
+
+def backfill_search_text(conn, chunk_size=1000, logger=None):
+    """Fills search_text for teachers that predate the column, in id-ordered chunks. Returns rows updated."""
+    cursor = conn.cursor(buffered=True)
+    updated = 0
+    last_id = 0
+    try:
+        while True:
+            cursor.execute("""
+                SELECT id, first_name, last_name, username, bio FROM users
+                WHERE role = 'teacher' AND search_text IS NULL AND id > %s
+                ORDER BY id ASC LIMIT %s
+            """, (last_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            cursor.executemany("UPDATE users SET search_text = %s WHERE id = %s",
+                               [(build_search_text(*row[1:]), row[0]) for row in rows])
+            conn.commit()
+            updated += len(rows)
+            last_id = rows[-1][0]
+        if logger and updated:
+            logger.info(f"TEACHER_SEARCH: search_text filled for {updated} teachers.")
+        return updated
+    finally:
+        cursor.close()
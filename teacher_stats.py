@@ -0,0 +1,96 @@
+# teacher_stats.py
+"""Materialized per-teacher dashboard counters kept in the `teacher_stats` table.
+
+Write paths call bump_teacher_stats() inside their own transaction; reconcile_teacher_stats()
+recomputes the counters from the source tables to correct any drift."""
+
+STATS_COLUMNS = ('subscribers_count', 'total_views', 'quizzes_count', 'questions_count')
+
+_RECONCILE_SQL = """
+    INSERT INTO teacher_stats (teacher_id, subscribers_count, total_views, quizzes_count, questions_count)
+    SELECT u.id,
+           (SELECT COUNT(*) FROM student_subscriptions ss WHERE ss.teacher_id = u.id AND ss.status = 'active'),
+           (SELECT COALESCE(SUM(v.views_count), 0) FROM videos v WHERE v.teacher_id = u.id),
+           (SELECT COUNT(*) FROM quizzes qz WHERE qz.teacher_id = u.id),
+           (SELECT COUNT(*) FROM questions q JOIN quizzes qz ON q.quiz_id = qz.id WHERE qz.teacher_id = u.id)
+    FROM users u
+    WHERE u.role = 'teacher' AND {teacher_filter}
+    ON DUPLICATE KEY UPDATE
+        subscribers_count = VALUES(subscribers_count), total_views = VALUES(total_views),
+        quizzes_count = VALUES(quizzes_count), questions_count = VALUES(questions_count),
+        reconciled_at = CURRENT_TIMESTAMP
+"""
+
+
+def bump_teacher_stats(cursor, teacher_id, subscribers=0, views=0, quizzes=0, questions=0):
+    """Applies counter deltas for one teacher in the caller's transaction.
+
+    If the teacher has no stats row yet it is seeded from the source tables, which already
+    include the caller's uncommitted write."""
+    cursor.execute("""
+        UPDATE teacher_stats SET
+        subscribers_count = GREATEST(subscribers_count + %s, 0),
+        total_views = GREATEST(total_views + %s, 0),
+        quizzes_count = GREATEST(quizzes_count + %s, 0),
+        questions_count = GREATEST(questions_count + %s, 0)
+        WHERE teacher_id = %s
+    """, (subscribers, views, quizzes, questions, teacher_id))
+    if cursor.rowcount == 0:
+        reconcile_teacher_stats(cursor, teacher_id=teacher_id)
+
+
+def get_teacher_stats(cursor, teacher_id):
+    """Returns the teacher's counters as a dict via a primary-key lookup, seeding the row if missing.
+
+    Callers should commit afterwards so a freshly seeded row is kept."""
+    cursor.execute(f"SELECT {', '.join(STATS_COLUMNS)} FROM teacher_stats WHERE teacher_id = %s", (teacher_id,))
+    row = cursor.fetchone()
+    if row is None:
+        reconcile_teacher_stats(cursor, teacher_id=teacher_id)
+        cursor.execute(f"SELECT {', '.join(STATS_COLUMNS)} FROM teacher_stats WHERE teacher_id = %s", (teacher_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return {column: 0 for column in STATS_COLUMNS}
+    if not isinstance(row, dict):
+        row = dict(zip(STATS_COLUMNS, row))
+    return {column: int(row[column] or 0) for column in STATS_COLUMNS}
+
+
+def reconcile_teacher_stats(cursor, teacher_id=None, id_range=None):
+    """Recomputes counters from source tables for one teacher, an inclusive id range, or everyone.
+
+    Returns the driver's affected-row count (1 per inserted row, 2 per corrected row)."""
+    if teacher_id is not None:
+        cursor.execute(_RECONCILE_SQL.format(teacher_filter="u.id = %s"), (teacher_id,))
+    elif id_range is not None:
+        cursor.execute(_RECONCILE_SQL.format(teacher_filter="u.id BETWEEN %s AND %s"), tuple(id_range))
+    else:
+        cursor.execute(_RECONCILE_SQL.format(teacher_filter="TRUE"))
+    return cursor.rowcount
+
+
+def reconcile_all_teacher_stats(conn, chunk_size=500, logger=None):
+    """Reconciles every teacher in id-ordered chunks, committing after each chunk.
+
+    Returns (teachers_processed, rows_affected)."""
+    cursor = conn.cursor()
+    teachers_processed = 0
+    rows_affected = 0
+    last_id = 0
+    try:
+        while True:
+            cursor.execute("""
+                SELECT id FROM users WHERE role = 'teacher' AND id > %s ORDER BY id ASC LIMIT %s
+            """, (last_id, chunk_size))
+            teacher_ids = [row[0] for row in cursor.fetchall()]
+            if not teacher_ids:
+                break
+            rows_affected += reconcile_teacher_stats(cursor, id_range=(teacher_ids[0], teacher_ids[-1]))
+            conn.commit()
+            teachers_processed += len(teacher_ids)
+            last_id = teacher_ids[-1]
+            if logger:
+                logger.info(f"TEACHER_STATS_RECONCILE: {teachers_processed} teachers processed (up to id {last_id}).")
+    finally:
+        cursor.close()
+    return teachers_processed, rows_affected
@@ -0,0 +1,174 @@
+# teacher_suggest.py
+"""In-memory prefix index of teacher names for the explore page's autocomplete.
+
+Each worker holds two parallel sorted lists: normalized keys (full name, last name and username,
+folded with teacher_search.normalize_text) and the owning teacher ids. A lookup is one
+bisect_left() to the first key at or after the prefix followed by a short forward scan, so no
+request touches MySQL. Ten thousand teachers take a few MB.
+
+The index is loaded on first use. The web process applies its own signups and profile edits with
+upsert() right after committing. Changes made by other workers arrive through sync(), which
+re-reads only the teachers whose users.updated_at moved since the last sync. It runs on a
+background thread at most every `refresh_seconds`. updated_at is stamped when the UPDATE runs, not
+when it commits, so each sync also re-reads the `overlap_seconds` before the watermark; an edit
+whose transaction commits later than that is still picked up."""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from teacher_search import normalize_text
+
+logger = logging.getLogger(__name__)
+
+_TEACHER_COLUMNS = "id, first_name, last_name, username, is_active, updated_at"
+
+
+def _keys_for(first_name, last_name, username):
+    full_name = normalize_text(f"{first_name or ''} {last_name or ''}")
+    keys = {full_name, normalize_text(last_name), normalize_text(username)}
+    keys.discard('')
+    return keys
+
+
+class TeacherNameIndex:
+    """Sorted-array prefix index. `connect` returns a new DB connection (closed after each sync)."""
+
+    def __init__(self, connect, refresh_seconds=60.0, overlap_seconds=300):
+        self.connect = connect
+        self.refresh_seconds = refresh_seconds
+        self.overlap_seconds = overlap_seconds
+        self._lock = threading.Lock()
+        self._keys = []
+        self._ids = []
+        self._teacher_keys = {}  # teacher id -> keys currently indexed for them
+        self._display = {}  # teacher id -> (display name, username)
+        self._watermark = None  # Largest users.updated_at seen so far
+        self._last_sync = 0.0
+        self._sync_thread = None
+
+    def _remove(self, teacher_id):
+        for key in self._teacher_keys.pop(teacher_id, ()):
+            position = bisect_left(self._keys, key)
+            while position < len(self._keys) and self._keys[position] == key:
+                if self._ids[position] == teacher_id:
+                    del self._keys[position]
+                    del self._ids[position]
+                    break
+                position += 1
+        self._display.pop(teacher_id, None)
+
+    def _add(self, teacher_id, first_name, last_name, username):
+        keys = _keys_for(first_name, last_name, username)
+        for key in keys:
+            position = bisect_left(self._keys, key)
+            self._keys.insert(position, key)
+            self._ids.insert(position, teacher_id)
+        self._teacher_keys[teacher_id] = keys
+        self._display[teacher_id] = (f"{first_name or ''} {last_name or ''}".strip() or username, username)
+
+    def upsert(self, teacher_id, first_name, last_name, username, is_active=True):
+        """Re-indexes one teacher (removing them if inactive)."""
+        with self._lock:
+            self._remove(teacher_id)
+            if is_active:
+                self._add(teacher_id, first_name, last_name, username)
+
+    def _apply_rows(self, rows):
+        for teacher_id, first_name, last_name, username, is_active, updated_at in rows:
+            self._remove(teacher_id)
+            if is_active:
+                self._add(teacher_id, first_name, last_name, username)
+            if updated_at is not None and (self._watermark is None or updated_at > self._watermark):
+                self._watermark = updated_at
+
+    def load(self, conn):
+        """Replaces the index with every active teacher, built in one sort rather than one insert per key."""
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SELECT {_TEACHER_COLUMNS} FROM users WHERE role = 'teacher'")
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        entries, teacher_keys, display, watermark = [], {}, {}, None
+        for teacher_id, first_name, last_name, username, is_active, updated_at in rows:
+            if updated_at is not None and (watermark is None or updated_at > watermark):
+                watermark = updated_at
+            if not is_active:
+                continue
+            keys = _keys_for(first_name, last_name, username)
+            entries.extend((key, teacher_id) for key in keys)
+            teacher_keys[teacher_id] = keys
+            display[teacher_id] = (f"{first_name or ''} {last_name or ''}".strip() or username, username)
+        entries.sort()
+        with self._lock:
+            self._keys = [key for key, _ in entries]
+            self._ids = [teacher_id for _, teacher_id in entries]
+            self._teacher_keys, self._display, self._watermark = teacher_keys, display, watermark
+            self._last_sync = time.monotonic()
+
+    def sync(self, conn):
+        """Applies teachers changed since the last load/sync. Returns the number of rows read."""
+        if self._watermark is None:
+            self.load(conn)
+            return len(self._display)
+        cursor = conn.cursor()
+        try:
+            # Rows stamped shortly before the watermark may have committed after the last sync;
+            # re-applying a row is harmless
+            cursor.execute(f"SELECT {_TEACHER_COLUMNS} FROM users WHERE role = 'teacher' AND updated_at >= %s - INTERVAL %s SECOND",
+                           (self._watermark, int(self.overlap_seconds)))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        with self._lock:
+            self._apply_rows(rows)
+            self._last_sync = time.monotonic()
+        return len(rows)
+
+    def _sync_in_background(self):
+        def run():
+            conn = self.connect()
+            if conn is None:
+                logger.error("TEACHER_SUGGEST: No DB connection for sync; will retry.")
+                return
+            try:
+                self.sync(conn)
+            except Exception as e:
+                logger.error(f"TEACHER_SUGGEST: Sync failed: {e}")
+            finally:
+                conn.close()
+        self._sync_thread = threading.Thread(target=run, name='teacher-suggest-sync', daemon=True)
+        self._sync_thread.start()
+
+    def ensure_fresh(self):
+        """Loads synchronously on first use; afterwards schedules a background sync when stale."""
+        if not self._last_sync:
+            conn = self.connect()
+            if conn is None:
+                return
+            try:
+                self.load(conn)
+            finally:
+                conn.close()
+        elif (time.monotonic() - self._last_sync > self.refresh_seconds
+              and (self._sync_thread is None or not self._sync_thread.is_alive())):
+            self._last_sync = time.monotonic()  # Claimed here so concurrent requests start one sync
+            self._sync_in_background()
+
+    def suggest(self, prefix, limit=8):
+        """Up to `limit` (teacher id, display name, username) whose name or username starts with prefix."""
+        prefix = normalize_text(prefix)
+        if not prefix:
+            return []
+        results, seen = [], set()
+        with self._lock:
+            position = bisect_left(self._keys, prefix)
+            while position < len(self._keys) and len(results) < limit and self._keys[position].startswith(prefix):
+                teacher_id = self._ids[position]
+                if teacher_id not in seen:
+                    seen.add(teacher_id)
+                    results.append((teacher_id,) + self._display[teacher_id])
+                position += 1
+        return results
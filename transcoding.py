@@ -0,0 +1,337 @@
+# transcoding.py
+"""Background transcoding of uploaded lectures into adaptive-bitrate HLS.
+
+Uploads are stored as 'processing' with a row in `transcode_jobs`. run_transcode_job() probes the
+source with ffprobe, decodes it once and encodes every rendition of the ladder that fits the
+source resolution in a single ffmpeg pass (split filter + var_stream_map), writes a poster frame,
+then fills in duration_seconds, thumbnail_path_or_url and hls_manifest_path and publishes the
+video. Output is written to a scratch directory and only then handed to the storage backend
+(see storage.py), so a crashed job never leaves a half-written rendition set behind.
+
+A runner claims a job with a lease (`lease_token`, `lease_expires_at`) and renews it while ffmpeg
+runs, so `flask run-transcode-jobs` only picks up 'running' jobs whose runner stopped heartbeating.
+A failed job goes back to 'pending' with the video still 'processing', so the next
+`flask run-transcode-jobs` retries it. Only after TRANSCODE_MAX_ATTEMPTS failures is the original
+upload published without an HLS manifest (the player then streams the original file). A source
+with no video stream fails at once and marks the video 'error'. Every change to the video row is
+made in the same transaction as a job update that still holds the lease, so a runner whose lease
+was taken over never touches the video."""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from collections import namedtuple
+
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+FFPROBE_BINARY = os.getenv('FFPROBE_BINARY', 'ffprobe')
+HLS_SEGMENT_SECONDS = int(os.getenv('HLS_SEGMENT_SECONDS', '6'))
+TRANSCODE_TIMEOUT_SECONDS = int(os.getenv('TRANSCODE_TIMEOUT_SECONDS', str(6 * 3600)))
+TRANSCODE_LEASE_SECONDS = int(os.getenv('TRANSCODE_LEASE_SECONDS', '300'))
+TRANSCODE_MAX_ATTEMPTS = int(os.getenv('TRANSCODE_MAX_ATTEMPTS', '3'))
+
+TRANSCODE_WORK_DIR = os.getenv('TRANSCODE_WORK_DIR') or None  # Defaults to the system temp dir
+HLS_DIRECTORY = 'hls'
+THUMBNAIL_DIRECTORY = 'video_thumbnails'
+MASTER_PLAYLIST = 'master.m3u8'
+
+Rendition = namedtuple('Rendition', 'name height video_bitrate_kbps audio_bitrate_kbps')
+
+# Ladder from lowest to highest; renditions taller than the source are skipped (the lowest is always kept)
+RENDITION_LADDER = (
+    Rendition('240p', 240, 400, 64),
+    Rendition('360p', 360, 800, 96),
+    Rendition('480p', 480, 1400, 128),
+    Rendition('720p', 720, 2800, 128),
+    Rendition('1080p', 1080, 5000, 160),
+)
+
+SourceInfo = namedtuple('SourceInfo', 'duration_seconds width height has_audio')
+
+
+class TranscodeError(RuntimeError):
+    """Raised when ffprobe/ffmpeg cannot be run or fails."""
+
+
+class InvalidSourceError(TranscodeError):
+    """Raised when the upload has no video stream, so publishing the original would not help."""
+
+
+class LeaseLostError(Exception):
+    """Another runner claimed the job after this runner's lease expired."""
+
+
+def tools_available():
+    """True if both the ffmpeg and ffprobe binaries can be found."""
+    return shutil.which(FFMPEG_BINARY) is not None and shutil.which(FFPROBE_BINARY) is not None
+
+
+def _run(command, heartbeat=None, heartbeat_seconds=60):
+    """Runs command to completion and returns its stdout, calling heartbeat() every heartbeat_seconds."""
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise TranscodeError(f"{command[0]} could not be run: {e}") from e
+    deadline = time.monotonic() + TRANSCODE_TIMEOUT_SECONDS
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TranscodeError(f"{command[0]} timed out after {TRANSCODE_TIMEOUT_SECONDS}s.")
+            try:
+                stdout, stderr = process.communicate(timeout=min(remaining, heartbeat_seconds) if heartbeat else remaining)
+                break
+            except subprocess.TimeoutExpired:
+                if heartbeat:
+                    heartbeat()
+    finally:
+        if process.poll() is None:  # Timed out or the lease was lost: don't leave ffmpeg running
+            process.kill()
+            process.communicate()
+    if process.returncode != 0:
+        stderr_tail = stderr.decode('utf-8', 'replace')[-500:]
+        raise TranscodeError(f"{command[0]} exited with {process.returncode}: {stderr_tail}")
+    return stdout
+
+
+def probe_video(source_path):
+    """Returns the source's duration, frame size and whether it has an audio track."""
+    output = _run([FFPROBE_BINARY, '-v', 'error', '-print_format', 'json',
+                   '-show_entries', 'format=duration:stream=codec_type,width,height', source_path])
+    info = json.loads(output or b'{}')
+    streams = info.get('streams', [])
+    video_stream = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    if video_stream is None:
+        raise InvalidSourceError("Source has no video stream.")
+    duration = float(info.get('format', {}).get('duration') or 0)
+    return SourceInfo(int(round(duration)), int(video_stream.get('width') or 0), int(video_stream.get('height') or 0),
+                      any(s.get('codec_type') == 'audio' for s in streams))
+
+
+def select_renditions(source_height):
+    """Renditions no taller than the source; the lowest one is kept even for tiny sources."""
+    selected = [r for r in RENDITION_LADDER if r.height <= source_height]
+    return tuple(selected or RENDITION_LADDER[:1])
+
+
+def build_hls_command(source_path, output_dir, renditions, has_audio):
+    """One ffmpeg invocation: decode once, split, scale and encode each rendition, write a master playlist."""
+    split = f"[0:v]split={len(renditions)}" + ''.join(f"[v{i}]" for i in range(len(renditions)))
+    scales = [f"[v{i}]scale=-2:{r.height}[v{i}out]" for i, r in enumerate(renditions)]
+    command = [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', '-i', source_path,
+               '-filter_complex', ';'.join([split] + scales)]
+    stream_map = []
+    for i, r in enumerate(renditions):
+        command += ['-map', f"[v{i}out]", f"-c:v:{i}", 'libx264', f"-b:v:{i}", f"{r.video_bitrate_kbps}k",
+                    f"-maxrate:v:{i}", f"{int(r.video_bitrate_kbps * 1.07)}k", f"-bufsize:v:{i}", f"{r.video_bitrate_kbps * 2}k"]
+        if has_audio:
+            command += ['-map', 'a:0', f"-c:a:{i}", 'aac', f"-b:a:{i}", f"{r.audio_bitrate_kbps}k", '-ac', '2']
+            stream_map.append(f"v:{i},a:{i},name:{r.name}")
+        else:
+            stream_map.append(f"v:{i},name:{r.name}")
+    # Fixed GOP aligned to the segment length so every rendition switches on the same boundaries
+    command += ['-preset', 'veryfast', '-profile:v', 'main', '-sc_threshold', '0',
+                '-force_key_frames', f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+                '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+                '-hls_flags', 'independent_segments',
+                '-hls_segment_filename', os.path.join(output_dir, '%v', 'segment_%05d.ts'),
+                '-master_pl_name', MASTER_PLAYLIST, '-var_stream_map', ' '.join(stream_map),
+                os.path.join(output_dir, '%v', 'index.m3u8')]
+    return command
+
+
+def extract_poster(source_path, poster_path, duration_seconds, heartbeat=None, heartbeat_seconds=60):
+    """Grabs one frame 10% into the video (at most 5 s in) as a 640 px wide JPEG."""
+    offset = min(duration_seconds * 0.1, 5.0)
+    _run([FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', '-ss', f"{offset:.2f}", '-i', source_path,
+          '-frames:v', '1', '-vf', 'scale=640:-2', '-q:v', '3', poster_path],
+         heartbeat=heartbeat, heartbeat_seconds=heartbeat_seconds)
+
+
+def hls_prefix_of(manifest_key):
+    """The storage prefix holding a manifest's renditions."""
+    return manifest_key.rsplit('/', 1)[0]
+
+
+def transcode_to_hls(storage, source_key, video_id, uploads_subdir='uploads', heartbeat=None, heartbeat_seconds=60):
+    """Writes renditions and poster for video_id to storage. Returns (SourceInfo, manifest key, thumbnail key).
+
+    Renditions go to a new prefix on every run, so a failed upload never touches the set the video
+    currently points at. heartbeat() is called every heartbeat_seconds while ffmpeg runs and before
+    the upload to storage."""
+    hls_prefix = '/'.join([uploads_subdir, 'videos', HLS_DIRECTORY, str(video_id), uuid.uuid4().hex])
+    thumbnail_key = '/'.join([uploads_subdir, THUMBNAIL_DIRECTORY, f"{video_id}.jpg"])
+    work_dir = tempfile.mkdtemp(prefix=f"transcode-{video_id}-", dir=TRANSCODE_WORK_DIR)
+    try:
+        with storage.local_copy(source_key) as source_path:
+            source = probe_video(source_path)
+            renditions = select_renditions(source.height)
+            hls_dir = os.path.join(work_dir, HLS_DIRECTORY)
+            for rendition in renditions:
+                os.makedirs(os.path.join(hls_dir, rendition.name), exist_ok=True)
+            _run(build_hls_command(source_path, hls_dir, renditions, source.has_audio),
+                 heartbeat=heartbeat, heartbeat_seconds=heartbeat_seconds)
+            poster_path = os.path.join(work_dir, 'poster.jpg')
+            extract_poster(source_path, poster_path, source.duration_seconds,
+                           heartbeat=heartbeat, heartbeat_seconds=heartbeat_seconds)
+        if heartbeat:
+            heartbeat()
+        storage.put_tree(hls_dir, hls_prefix)
+        storage.put_file(poster_path, thumbnail_key)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return source, f"{hls_prefix}/{MASTER_PLAYLIST}", thumbnail_key
+
+
+def enqueue_transcode(cursor, video_id):
+    """Queues video_id for transcoding and returns the job id."""
+    cursor.execute("INSERT INTO transcode_jobs (video_id) VALUES (%s)", (video_id,))
+    return cursor.lastrowid
+
+
+_CLAIMABLE = "(status = 'pending' OR (status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < CURRENT_TIMESTAMP)))"
+
+
+def run_transcode_job(conn, job_id, storage, uploads_subdir='uploads', lease_seconds=TRANSCODE_LEASE_SECONDS,
+                      max_attempts=TRANSCODE_MAX_ATTEMPTS, logger=None):
+    """Claims and runs one job. Returns True if the video was published with HLS renditions, None if
+    the job was not claimable (unknown, finished, or leased by a live runner) or the lease was lost.
+
+    On failure the exception is re-raised after the job is put back to 'pending' with the ffmpeg
+    message. Once it has run max_attempts times it is marked 'failed' instead and the video is
+    published as its original upload, or marked 'error' at once if the source has no video stream."""
+    cursor = conn.cursor(buffered=True)
+    lease_token = uuid.uuid4().hex
+    video_id = None
+    attempts = 0
+
+    def heartbeat():
+        cursor.execute("""
+            UPDATE transcode_jobs SET lease_expires_at = CURRENT_TIMESTAMP + INTERVAL %s SECOND
+            WHERE id = %s AND lease_token = %s
+        """, (lease_seconds, job_id, lease_token))
+        renewed = cursor.rowcount > 0
+        conn.commit()
+        if not renewed:  # rowcount is also 0 when renewed twice within a second, so check the owner
+            cursor.execute("SELECT lease_token FROM transcode_jobs WHERE id = %s", (job_id,))
+            row = cursor.fetchone()
+            conn.commit()
+            if row is None or row[0] != lease_token:
+                raise LeaseLostError(f"Transcode job {job_id} was claimed by another runner.")
+
+    try:
+        cursor.execute(f"""
+            UPDATE transcode_jobs SET status = 'running', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP,
+                lease_token = %s, lease_expires_at = CURRENT_TIMESTAMP + INTERVAL %s SECOND
+            WHERE id = %s AND {_CLAIMABLE}
+        """, (lease_token, lease_seconds, job_id))
+        conn.commit()
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute("""
+            SELECT v.id, v.video_path_or_url, v.hls_manifest_path, j.attempts FROM transcode_jobs j
+            JOIN videos v ON v.id = j.video_id WHERE j.id = %s
+        """, (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute("""
+                UPDATE transcode_jobs SET status = 'failed', error_message = 'Video no longer exists.',
+                    finished_at = CURRENT_TIMESTAMP, lease_expires_at = NULL
+                WHERE id = %s AND lease_token = %s
+            """, (job_id, lease_token))
+            conn.commit()
+            return None
+        video_id, video_path, previous_manifest_path, attempts = row
+
+        if logger:
+            logger.info(f"TRANSCODE: job {job_id} video {video_id}: starting.")
+        source, manifest_path, thumbnail_path = transcode_to_hls(storage, video_path, video_id, uploads_subdir,
+                                                                 heartbeat=heartbeat,
+                                                                 heartbeat_seconds=max(1, lease_seconds // 3))
+
+        cursor.execute("""
+            UPDATE transcode_jobs SET status = 'completed', finished_at = CURRENT_TIMESTAMP, lease_expires_at = NULL
+            WHERE id = %s AND lease_token = %s
+        """, (job_id, lease_token))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            _delete_renditions(storage, manifest_path, job_id, video_id, logger)
+            raise LeaseLostError(f"Transcode job {job_id} was claimed by another runner before it could publish.")
+        cursor.execute("""
+            UPDATE videos SET status = 'published', duration_seconds = %s, thumbnail_path_or_url = %s, hls_manifest_path = %s
+            WHERE id = %s AND status = 'processing'
+        """, (source.duration_seconds, thumbnail_path, manifest_path, video_id))
+        switched = cursor.rowcount > 0
+        conn.commit()
+        # Only now that the row points at the new renditions can the unreferenced set go. Sets written
+        # before per-run prefixes sit directly under the video's directory, which contains the new set.
+        stale_manifest_path = previous_manifest_path if switched else manifest_path
+        if stale_manifest_path and not hls_prefix_of(manifest_path).startswith(hls_prefix_of(stale_manifest_path) + '/'):
+            _delete_renditions(storage, stale_manifest_path, job_id, video_id, logger)
+        if not switched:
+            return None  # The video left 'processing' while this job ran; its new renditions were discarded
+        if logger:
+            logger.info(f"TRANSCODE: job {job_id} video {video_id}: published ({source.duration_seconds}s, {source.height}p source).")
+        return True
+    except LeaseLostError as e:
+        conn.rollback()
+        if logger:
+            logger.warning(f"TRANSCODE: {e} Stopping.")
+        return None
+    except Exception as e:
+        conn.rollback()
+        give_up = video_id is None or isinstance(e, InvalidSourceError) or attempts >= max_attempts
+        cursor.execute("""
+            UPDATE transcode_jobs SET status = %s, error_message = %s, finished_at = CURRENT_TIMESTAMP,
+                lease_token = NULL, lease_expires_at = NULL
+            WHERE id = %s AND lease_token = %s
+        """, ('failed' if give_up else 'pending', str(e)[:500], job_id, lease_token))
+        owned = cursor.rowcount > 0  # 0 if another runner took the job over; the video is then its to publish
+        if owned and not give_up:
+            if logger:
+                logger.warning(f"TRANSCODE: job {job_id} video {video_id}: attempt {attempts} of {max_attempts} failed; will retry.")
+        elif owned and video_id is not None:
+            # Without renditions the original upload is still playable, unless it has no video at all
+            fallback_status = 'error' if isinstance(e, InvalidSourceError) else 'published'
+            cursor.execute("UPDATE videos SET status = %s WHERE id = %s AND status = 'processing'", (fallback_status, video_id))
+            if logger and fallback_status == 'published':
+                logger.warning(f"TRANSCODE: job {job_id} video {video_id}: gave up after {attempts} attempts; "
+                               f"published the original upload without HLS.")
+        conn.commit()
+        raise
+    finally:
+        cursor.close()
+
+
+def _delete_renditions(storage, manifest_path, job_id, video_id, logger):
+    try:
+        storage.delete_prefix(hls_prefix_of(manifest_path))
+    except Exception as e:
+        if logger:
+            logger.warning(f"TRANSCODE: job {job_id} video {video_id}: could not delete unreferenced renditions: {e}")
+
+
+def run_pending_transcode_jobs(conn, storage, uploads_subdir='uploads', lease_seconds=TRANSCODE_LEASE_SECONDS,
+                               max_attempts=TRANSCODE_MAX_ATTEMPTS, logger=None):
+    """Runs every pending job (including failed attempts waiting for a retry) and every 'running' job
+    whose lease expired, once each. Returns (published, failed)."""
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute(f"SELECT id FROM transcode_jobs WHERE {_CLAIMABLE} ORDER BY id ASC")
+        job_ids = [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    published = failed = 0
+    for job_id in job_ids:
+        try:
+            if run_transcode_job(conn, job_id, storage, uploads_subdir, lease_seconds=lease_seconds,
+                                 max_attempts=max_attempts, logger=logger):
+                published += 1
+        except Exception as e:
+            failed += 1
+            if logger:
+                logger.error(f"TRANSCODE: job {job_id} failed: {e}")
+    return published, failed
@@ -0,0 +1,42 @@
+# video_streaming.py
+"""Byte-range video responses for the authenticated streaming endpoint.
+
+By default Flask's send_file answers Range/If-Range requests with 206 partial content and an
+ETag, and hands the open file to the WSGI server's file_wrapper (gunicorn uses sendfile(2)), so
+bytes never pass through Python. With VIDEO_ACCEL_REDIRECT_PREFIX (nginx) or VIDEO_USE_X_SENDFILE
+(Apache/lighttpd) set, the response is just a header and the front proxy sends the file."""
+
+import mimetypes
+import os
+
+from flask import Response, send_file
+
+# HLS playlists and segments are not in every platform's mime.types
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+mimetypes.add_type('video/mp2t', '.ts')
+
+VIDEO_ACCEL_REDIRECT_PREFIX = os.getenv('VIDEO_ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+VIDEO_USE_X_SENDFILE = os.getenv('VIDEO_USE_X_SENDFILE', 'False').lower() in ('true', '1', 'yes')
+VIDEO_STREAM_MAX_AGE = int(os.getenv('VIDEO_STREAM_MAX_AGE_SECONDS', '3600'))
+
+
+def send_video(file_path, relative_path):
+    """Returns a streaming response for file_path.
+
+    `relative_path` is the file's path below the uploads root; it is appended to
+    VIDEO_ACCEL_REDIRECT_PREFIX to form the proxy's internal location."""
+    mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    if VIDEO_ACCEL_REDIRECT_PREFIX or VIDEO_USE_X_SENDFILE:
+        response = Response(mimetype=mimetype)
+        if VIDEO_ACCEL_REDIRECT_PREFIX:
+            response.headers['X-Accel-Redirect'] = f"{VIDEO_ACCEL_REDIRECT_PREFIX}/{relative_path.replace(os.sep, '/')}"
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(file_path)
+        response.headers['Cache-Control'] = f"private, max-age={VIDEO_STREAM_MAX_AGE}"
+        return response
+
+    response = send_file(file_path, mimetype=mimetype, conditional=True, etag=True, max_age=VIDEO_STREAM_MAX_AGE)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.cache_control.private = True
+    response.cache_control.public = False
+    return response
@@ -0,0 +1,250 @@
+# view_counter.py
+"""Write-behind buffer for video view counts.
+
+record() appends one line to this process's log file and returns. It takes no database locks.
+A background thread periodically rotates the log, sums the rotated file per video and per
+teacher, and applies the totals to `videos.views_count` and `teacher_stats.total_views` in one
+transaction. That turns N single-row increments on a hot video into one UPDATE per flush.
+
+Each rotated batch has a unique id that is recorded in `view_count_batches` in the same
+transaction as its deltas. A batch left behind by a crash (before or after commit) is therefore
+applied exactly once on the next recovery. Those markers only need to outlive the batch files,
+so flushes delete ones older than `batch_retention_hours`.
+
+Files are named after their owner: the PID plus that process's start time from /proc (or a
+random token where /proc is unavailable). A worker restarted with a recycled PID, as after a
+container restart, therefore writes its own file and treats the dead worker's files as orphans."""
+
+import glob
+import logging
+import os
+import threading
+import uuid
+from collections import Counter
+
+from teacher_stats import bump_teacher_stats
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_SUFFIX = '.log'
+BATCH_SUFFIX = '.batch'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _process_start(pid):
+    """Start time of pid in clock ticks since boot (/proc/<pid>/stat field 22), or None without /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", 'r', encoding='ascii', errors='ignore') as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+_owner = (None, None)  # (pid, tag) of the current process
+
+
+def owner_tag():
+    """`<pid>-<start time>` for this process; recomputed after a fork."""
+    global _owner
+    pid = os.getpid()
+    if _owner[0] != pid:
+        _owner = (pid, f"{pid}-{_process_start(pid) or uuid.uuid4().hex[:16]}")
+    return _owner[1]
+
+
+def _owner_alive(tag):
+    """True if the process that wrote files tagged `tag` is still running."""
+    pid_text, _, start = tag.partition('-')
+    try:
+        pid = int(pid_text)
+    except ValueError:
+        return False
+    if not start or not _pid_alive(pid):
+        return False  # Files from before owner tags carry no start time: recover them
+    actual_start = _process_start(pid)
+    return actual_start is None or actual_start == start
+
+
+def read_batch(path):
+    """Sums a log file into ({video_id: views}, {teacher_id: views}), skipping a torn last line."""
+    per_video, per_teacher = Counter(), Counter()
+    with open(path, 'r', encoding='ascii', errors='ignore') as batch_file:
+        for line in batch_file:
+            parts = line.split()
+            if len(parts) != 2 or not line.endswith('\n'):
+                continue
+            video_id, teacher_id = int(parts[0]), int(parts[1])
+            per_video[video_id] += 1
+            per_teacher[teacher_id] += 1
+    return per_video, per_teacher
+
+
+def prune_applied_batches(conn, retention_hours, limit=1000):
+    """Deletes view_count_batches markers older than retention_hours. Returns rows deleted."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DELETE FROM view_count_batches WHERE applied_at < NOW() - INTERVAL %s HOUR LIMIT %s",
+                       (retention_hours, limit))
+        deleted = cursor.rowcount
+        conn.commit()
+        return deleted
+    finally:
+        cursor.close()
+
+
+def apply_batch(conn, path, batch_id):
+    """Applies one rotated log file in a single transaction and deletes it. Returns the views applied."""
+    per_video, per_teacher = read_batch(path)
+    cursor = conn.cursor(buffered=True)
+    try:
+        cursor.execute("INSERT IGNORE INTO view_count_batches (batch_id, views) VALUES (%s, %s)",
+                       (batch_id, sum(per_video.values())))
+        if cursor.rowcount == 0:  # Committed before a crash; only the file deletion was lost
+            conn.rollback()
+            os.remove(path)
+            return 0
+        # Sorted so concurrent flushes from several workers lock rows in the same order
+        if per_video:
+            cursor.executemany("UPDATE videos SET views_count = views_count + %s WHERE id = %s",
+                               [(views, video_id) for video_id, views in sorted(per_video.items())])
+        for teacher_id, views in sorted(per_teacher.items()):
+            bump_teacher_stats(cursor, teacher_id, views=views)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    os.remove(path)
+    return sum(per_video.values())
+
+
+class ViewCounter:
+    """Per-process view buffer. `connect` returns a new DB connection (closed after each flush).
+
+    batch_retention_hours must exceed the longest time a batch file may sit on disk unapplied."""
+
+    def __init__(self, log_dir, connect, flush_interval=10.0, batch_retention_hours=168):
+        self.log_dir = log_dir
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.batch_retention_hours = batch_retention_hours
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._fd = None
+        self._fd_pid = None
+        self._pending = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _active_path(self):
+        return os.path.join(self.log_dir, f"views-{owner_tag()}{ACTIVE_SUFFIX}")
+
+    def _open(self):
+        # Reopen after a fork so child workers never share the parent's file
+        if self._fd_pid != os.getpid():
+            self._fd = None
+            self._thread = None  # Threads do not survive fork()
+            self._pending = 0
+        if self._fd is None:
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._fd = os.open(self._active_path(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def record(self, video_id, teacher_id):
+        """Counts one view. Durable once the line is written; the database catches up on the next flush."""
+        with self._lock:
+            os.write(self._open(), f"{int(video_id)} {int(teacher_id)}\n".encode('ascii'))
+            self._pending += 1
+            if self._thread is None:
+                self._start_thread()
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name='view-counter-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"VIEW_COUNTER: Flush failed, will retry: {e}", exc_info=True)
+
+    def _rotate(self):
+        """Swaps the active log for a fresh one. Returns the rotated batch path, or None if empty."""
+        with self._lock:
+            if self._fd is None or self._fd_pid != os.getpid() or self._pending == 0:
+                return None
+            batch_path = os.path.join(self.log_dir, f"views-{owner_tag()}-{uuid.uuid4().hex[:16]}{BATCH_SUFFIX}")
+            os.close(self._fd)
+            os.replace(self._active_path(), batch_path)
+            self._fd = None
+            self._pending = 0
+            return batch_path
+
+    def flush(self):
+        """Applies everything recorded so far, plus batches left by earlier failed flushes. Returns views applied."""
+        with self._flush_lock:
+            self._rotate()
+            if not glob.glob(os.path.join(self.log_dir, 'views-*')):
+                return 0
+            conn = self.connect()
+            if conn is None:
+                return 0  # Batches stay on disk for the next attempt
+            try:
+                own_batches = sorted(glob.glob(os.path.join(self.log_dir, f"views-{owner_tag()}-*{BATCH_SUFFIX}")))
+                applied = sum(apply_batch(conn, path, os.path.basename(path)[:-len(BATCH_SUFFIX)]) for path in own_batches)
+                applied += recover_orphaned_logs(conn, self.log_dir)
+                prune_applied_batches(conn, self.batch_retention_hours)
+                return applied
+            finally:
+                conn.close()
+
+    def close(self):
+        """Stops the flush thread and flushes what is left (call at shutdown)."""
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"VIEW_COUNTER: Final flush failed; the log will be recovered on restart: {e}")
+
+
+def _file_owner(name):
+    """Owner tag from `views-<pid>-<start>.log` or `views-<pid>-<start>-<id>.batch` (older files: `views-<pid>...`)."""
+    stem = name[len('views-'):].split('.', 1)[0]
+    if name.endswith(BATCH_SUFFIX):
+        stem = stem.rsplit('-', 1)[0]
+    return stem
+
+
+def recover_orphaned_logs(conn, log_dir):
+    """Applies logs and batches left by processes that are no longer running (each flush also
+    does this, so a crashed worker's views are picked up by its siblings). Returns views applied."""
+    applied = 0
+    own_tag = owner_tag()
+    for path in sorted(glob.glob(os.path.join(log_dir, 'views-*'))):
+        name = os.path.basename(path)
+        if not (name.endswith(ACTIVE_SUFFIX) or name.endswith(BATCH_SUFFIX)):
+            continue
+        tag = _file_owner(name)
+        if tag == own_tag or _owner_alive(tag):
+            continue
+        try:
+            if name.endswith(ACTIVE_SUFFIX):
+                batch_path = os.path.join(log_dir, f"views-{tag}-{uuid.uuid4().hex[:16]}{BATCH_SUFFIX}")
+                os.replace(path, batch_path)
+                path, name = batch_path, os.path.basename(batch_path)
+            applied += apply_batch(conn, path, name[:-len(BATCH_SUFFIX)])
+        except FileNotFoundError:
+            continue  # Another worker recovered it first; view_count_batches kept it from applying twice
+    return applied